@@ -1,9 +1,13 @@
 from flask import Flask, send_from_directory
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 import argparse
 # Using direct import instead of package import
 from routes import routes
 
+# Reverse proxies in front of the app whose X-Forwarded-For entries are trusted
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+
 def create_app():
     """Create and configure the Flask application"""
     # Create Flask app
@@ -11,6 +15,10 @@ def create_app():
                 template_folder='templates',
                 static_folder='../static')
     
+    if TRUSTED_PROXIES:
+        # Take the client address from the last TRUSTED_PROXIES hops only, so clients cannot spoof it
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+    
     # Register blueprints
     app.register_blueprint(routes, url_prefix='')  # Add empty prefix to ensure routes work at root level
     
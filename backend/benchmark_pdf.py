@@ -0,0 +1,49 @@
+# Measure PDF rendering throughput in pages per second
+# Renders documents of mixed English, Hindi and Punjabi text in memory, once with the
+# shared font cache and once parsing the fonts for every document as FPDF.add_font does.
+import argparse
+import time
+from pdf_renderer import FontCache, pdf_renderer
+
+SAMPLE = (
+    "Photosynthesis turns light energy into chemical energy stored in glucose.\n"
+    "प्रकाश संश्लेषण में पौधे सूर्य के प्रकाश से भोजन बनाते हैं।\n"
+    "ਪ੍ਰਕਾਸ਼ ਸੰਸ਼ਲੇਸ਼ਣ ਵਿੱਚ ਪੌਦੇ ਸੂਰਜ ਦੀ ਰੋਸ਼ਨੀ ਨਾਲ ਭੋਜਨ ਬਣਾਉਂਦੇ ਹਨ।\n"
+)
+
+def document_text(pages):
+    """Enough paragraphs to fill about the requested number of pages"""
+    return '\n\n'.join(SAMPLE for _ in range(pages * 7))
+
+def run(documents, text, fresh_fonts):
+    pdf_renderer.documents = pdf_renderer.pages = 0
+    total_bytes = 0
+    started = time.perf_counter()
+    for index in range(documents):
+        if fresh_fonts:
+            pdf_renderer.fonts = FontCache()
+        total_bytes += len(pdf_renderer.render(f"Notes {index}", text))
+    elapsed = time.perf_counter() - started
+    return {
+        'documents': documents,
+        'pages': pdf_renderer.pages,
+        'seconds': round(elapsed, 3),
+        'pages_per_second': round(pdf_renderer.pages / elapsed, 1),
+        'ms_per_document': round(elapsed * 1000 / documents, 2),
+        'avg_kb': round(total_bytes / documents / 1024, 1)
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark SAHPAATHI PDF rendering')
+    parser.add_argument('--documents', type=int, default=50, help='Documents rendered per run')
+    parser.add_argument('--pages', type=int, default=3, help='Approximate pages per document')
+    args = parser.parse_args()
+
+    print(f"Font: {pdf_renderer.font_path}, fallbacks: {pdf_renderer.fallback_font_paths}")
+    text = document_text(args.pages)
+    # Warm up once so the cached run does not pay for the first font load
+    pdf_renderer.render('Warm up', text)
+    shared = pdf_renderer.fonts
+    print("cached fonts:     ", run(args.documents, text, fresh_fonts=False))
+    print("fonts per document:", run(args.documents, text, fresh_fonts=True))
+    pdf_renderer.fonts = shared
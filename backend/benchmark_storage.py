@@ -0,0 +1,83 @@
+# Compare chat history load latency and storage size for the document and bucketed layouts
+# Seeds a scratch database, so never point it at the live sahpaathi database.
+import argparse
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta
+import pymongo
+from bucket_store import BucketedMessageStore
+
+def seed(db, sessions, messages_per_session, bucket_size):
+    chats = db['chats']
+    store = BucketedMessageStore(db['chat_buckets'], bucket_size=bucket_size)
+    chats.create_index([('session_id', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+    store.ensure_indexes()
+    session_ids = []
+    start = datetime.now() - timedelta(days=1)
+    for _ in range(sessions):
+        session_id = str(uuid.uuid4())
+        session_ids.append(session_id)
+        docs = [
+            {
+                'session_id': session_id,
+                'role': 'user' if i % 2 == 0 else 'assistant',
+                'content': f"Message {i} about photosynthesis, light reactions and the Calvin cycle.",
+                'timestamp': start + timedelta(seconds=i)
+            }
+            for i in range(messages_per_session)
+        ]
+        chats.insert_many(docs)
+        store.buckets.insert_many(store.build_buckets(session_id, docs))
+    return session_ids, store
+
+def time_loads(load, session_ids, rounds):
+    samples = []
+    for _ in range(rounds):
+        for session_id in session_ids:
+            started = time.perf_counter()
+            load(session_id)
+            samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        'p50_ms': round(statistics.median(samples), 2),
+        'p95_ms': round(samples[int(len(samples) * 0.95) - 1], 2)
+    }
+
+def collection_size(db, name):
+    stats = db.command('collStats', name)
+    return {'documents': stats['count'], 'data_bytes': stats['size'], 'index_bytes': stats['totalIndexSize']}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark SAHPAATHI chat storage layouts')
+    parser.add_argument('--mongo-uri', type=str, default='mongodb://localhost:27017/', help='MongoDB connection string')
+    parser.add_argument('--database', type=str, default='sahpaathi_benchmark', help='Scratch database (dropped first)')
+    parser.add_argument('--sessions', type=int, default=50, help='Sessions to seed')
+    parser.add_argument('--messages', type=int, default=500, help='Messages per session')
+    parser.add_argument('--bucket-size', type=int, default=100, help='Messages per bucket')
+    parser.add_argument('--rounds', type=int, default=5, help='Times each session is loaded')
+    parser.add_argument('--limit', type=int, default=None, help='Load only the newest N messages')
+    args = parser.parse_args()
+
+    if args.database == 'sahpaathi':
+        parser.error('refusing to seed the live sahpaathi database')
+    client = pymongo.MongoClient(args.mongo_uri, serverSelectionTimeoutMS=5000)
+    client.drop_database(args.database)
+    db = client[args.database]
+    session_ids, store = seed(db, args.sessions, args.messages, args.bucket_size)
+
+    def load_documents(session_id):
+        cursor = db['chats'].find({'session_id': session_id}, {'_id': 0, 'session_id': 0})
+        if args.limit:
+            # Newest N, like ChatDatabase.get_chat_history(limit=N)
+            return list(cursor.sort([('timestamp', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]).limit(args.limit))[::-1]
+        return list(cursor.sort([('timestamp', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]))
+
+    def load_buckets(session_id):
+        return store.history(session_id, args.limit)
+
+    print(f"{args.sessions} sessions x {args.messages} messages, bucket size {args.bucket_size}")
+    for name, load, collection in (('document', load_documents, 'chats'), ('bucketed', load_buckets, 'chat_buckets')):
+        timings = time_loads(load, session_ids, args.rounds)
+        print(f"{name:>9}: load p50 {timings['p50_ms']} ms, p95 {timings['p95_ms']} ms, {collection_size(db, collection)}")
+    client.drop_database(args.database)
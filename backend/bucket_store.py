@@ -0,0 +1,306 @@
+# Bucketed message storage for SAHPAATHI
+# Packs a session's messages into bucket documents of up to bucket_size messages,
+# so loading a long session touches a handful of documents instead of hundreds.
+import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from search_index import score_documents, tokenize
+from write_buffer import DUPLICATE_KEY
+
+class BucketedMessageStore:
+    # Bucket document: {_id, session_id, bucket_no, count, first_ts, last_ts, messages: [{role, content, timestamp}],
+    #                   message_ids: [_id of each buffered message]}
+    INDEXES = [
+        # append: at most one bucket per number, so concurrent appends cannot open two buckets at once.
+        # Buckets written before bucket_no existed are left out of the index.
+        ([('session_id', pymongo.ASCENDING), ('bucket_no', pymongo.ASCENDING)],
+         {'name': 'session_id_bucket_no', 'unique': True,
+          'partialFilterExpression': {'bucket_no': {'$exists': True}}}),
+        # reads: a session's buckets oldest first by (first_ts, _id) and newest first by (last_ts, _id),
+        # sorted by the index itself
+        ([('session_id', pymongo.ASCENDING), ('first_ts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+         {'name': 'session_id_first_ts_id'}),
+        ([('session_id', pymongo.ASCENDING), ('last_ts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+         {'name': 'session_id_last_ts_id'}),
+        # retention: buckets holding messages older than a cutoff
+        ([('first_ts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], {'name': 'first_ts_id'}),
+        # capped history across every session reads the newest buckets off the end of this index
+        ([('last_ts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], {'name': 'last_ts_id'}),
+        # search: finds buckets holding a match; messages inside them are ranked locally
+        ([('messages.content', pymongo.TEXT)], {'name': 'messages_content_text'}),
+    ]
+    # Buckets fetched per search before ranking their messages
+    SEARCH_BUCKETS = 20
+
+    def __init__(self, collection, bucket_size=100):
+        """
+        Args:
+            collection: The chat_buckets collection
+            bucket_size (int): Messages per bucket before a new one is started
+        """
+        self.buckets = collection
+        self.bucket_size = bucket_size
+
+    # Replaced by the indexes above
+    OBSOLETE_INDEXES = ['session_id_first_ts', 'session_id_count']
+
+    def ensure_indexes(self):
+        for keys, options in self.INDEXES:
+            self.buckets.create_index(keys, **options)
+        existing = self.buckets.index_information()
+        for name in self.OBSOLETE_INDEXES:
+            if name in existing:
+                self.buckets.drop_index(name)
+
+    def _open_bucket_no(self, session_id):
+        """Number of the session's newest bucket, which is the one still open if any is"""
+        newest = self.buckets.find_one({'session_id': session_id, 'bucket_no': {'$exists': True}},
+                                        {'bucket_no': 1}, sort=[('bucket_no', pymongo.DESCENDING)])
+        return newest['bucket_no'] if newest else 0
+
+    def _retry_bucket_no(self, session_id, bucket_no):
+        """Where to retry after a duplicate key on bucket_no: the same bucket if a concurrent append only just created it"""
+        if self.buckets.find_one({'session_id': session_id, 'bucket_no': bucket_no,
+                                  'count': {'$lt': self.bucket_size}}, {'_id': 1}):
+            return bucket_no
+        return bucket_no + 1
+
+    def _append_update(self, message, bucket_no):
+        """(filter, update) that push one message into bucket bucket_no, upserting it if it does not exist yet"""
+        entry = {'role': message['role'], 'content': message['content'], 'timestamp': message['timestamp']}
+        push = {'messages': entry}
+        if '_id' in message:
+            # Buffered messages carry an id, recorded so a retried batch can skip them
+            push['message_ids'] = message['_id']
+        # Upserting into a full bucket collides with it on the unique index; the caller moves to the next number
+        return (
+            {'session_id': message['session_id'], 'bucket_no': bucket_no, 'count': {'$lt': self.bucket_size}},
+            {
+                '$push': push,
+                '$inc': {'count': 1},
+                '$min': {'first_ts': entry['timestamp']},
+                '$max': {'last_ts': entry['timestamp']},
+            }
+        )
+
+    def append(self, message):
+        """Append one message to the session's open bucket, starting a new bucket when full"""
+        bucket_no = self._open_bucket_no(message['session_id'])
+        while True:
+            try:
+                self.buckets.update_one(*self._append_update(message, bucket_no), upsert=True)
+                return
+            except DuplicateKeyError:
+                bucket_no = self._retry_bucket_no(message['session_id'], bucket_no)
+
+    def append_many(self, messages, skip_applied=False):
+        """
+        Append messages in order.
+
+        With skip_applied, messages whose '_id' an earlier, failed attempt already pushed
+        are left out, so retrying a batch never stores a message twice.
+        """
+        ids = [m['_id'] for m in messages if '_id' in m] if skip_applied else []
+        if ids:
+            applied = set()
+            query = {'session_id': {'$in': list({m['session_id'] for m in messages})}, 'message_ids': {'$in': ids}}
+            for bucket in self.buckets.find(query, {'message_ids': 1}):
+                applied.update(bucket['message_ids'])
+            messages = [m for m in messages if '_id' not in m or m['_id'] not in applied]
+        bucket_nos = {sid: self._open_bucket_no(sid) for sid in {m['session_id'] for m in messages}}
+        while messages:
+            # Ordered, so each upsert sees the bucket the one before it filled: the same result as appending one by one
+            requests = [UpdateOne(*self._append_update(m, bucket_nos[m['session_id']]), upsert=True) for m in messages]
+            try:
+                self.buckets.bulk_write(requests, ordered=True)
+                return
+            except BulkWriteError as e:
+                error = e.details['writeErrors'][0]
+                if error.get('code') != DUPLICATE_KEY:
+                    raise
+                # Everything before the failed write was applied; resume from it in the session's next bucket
+                messages = messages[error['index']:]
+                session_id = messages[0]['session_id']
+                bucket_nos[session_id] = self._retry_bucket_no(session_id, bucket_nos[session_id])
+
+    def iter_messages(self, batch_size=100):
+        """Every message with its session_id, grouped by session and oldest first, streamed bucket by bucket"""
+        cursor = self.buckets.find({}).sort([('session_id', 1), ('first_ts', 1)]).batch_size(batch_size)
+        for bucket in cursor:
+            for msg in bucket.get('messages', []):
+                yield {'session_id': bucket['session_id'], 'role': msg['role'], 'content': msg['content'],
+                       'timestamp': msg['timestamp']}
+
+    def _rows(self, bucket):
+        """Flatten a bucket into rows carrying a (timestamp, tiebreak) sort key"""
+        bucket_id = str(bucket['_id'])
+        return [
+            {
+                'role': msg['role'],
+                'content': msg['content'],
+                'timestamp': msg['timestamp'],
+                'tiebreak': f"{bucket_id}.{index:06d}"
+            }
+            for index, msg in enumerate(bucket.get('messages', []))
+        ]
+
+    @staticmethod
+    def _key(row):
+        return (row['timestamp'], row['tiebreak'])
+
+    def _find(self, query, newest_first=False):
+        """Buckets matching query, oldest first by first_ts or newest first by last_ts; every read goes through here"""
+        if newest_first:
+            return self.buckets.find(query).sort([('last_ts', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)])
+        return self.buckets.find(query).sort([('first_ts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+
+    def hot_queries(self, session_id, timestamp):
+        """The cursors history(), page() and since() open, keyed like MongoChatStorage.explain_hot_queries"""
+        return {
+            'get_chat_history': self._find({'session_id': session_id}),
+            'get_recent_history': self._find({'session_id': session_id}, newest_first=True),
+            'get_all_history': self._find({}, newest_first=True),
+            'get_older_messages_page': self._find({'session_id': session_id, 'first_ts': {'$lte': timestamp}},
+                                                  newest_first=True),
+            'get_newer_messages_page': self._find({'session_id': session_id, 'last_ts': {'$gte': timestamp}}),
+            'get_messages_since': self._find({'session_id': session_id, 'last_ts': {'$gt': timestamp}}),
+        }
+
+    def _nearest(self, query, limit, newest_first, keep=None):
+        """
+        The limit rows passing keep that come first in the walk order, sorted in that order.
+
+        Appends racing at a bucket boundary can leave a session's buckets overlapping in time.
+        Walking newest first by last_ts (oldest first by first_ts) means that once a bucket lies
+        wholly beyond the limit-th row, so does every bucket after it, and the walk can stop.
+        """
+        rows = []
+        edge = None
+        for bucket in self._find(query, newest_first=newest_first):
+            if edge is not None and (bucket['last_ts'] < edge if newest_first else bucket['first_ts'] > edge):
+                break
+            rows.extend(row for row in self._rows(bucket) if keep is None or keep(row))
+            if len(rows) >= limit:
+                rows.sort(key=self._key, reverse=newest_first)
+                del rows[limit:]
+                edge = rows[-1]['timestamp']
+        rows.sort(key=self._key, reverse=newest_first)
+        return rows
+
+    def history(self, session_id=None, limit=None):
+        """Messages for a session (or every session), oldest first, optionally only the newest `limit`"""
+        query = {'session_id': session_id} if session_id else {}
+        if limit:
+            # Walk buckets newest first and stop once enough messages are collected
+            return self._nearest(query, limit, newest_first=True)[::-1]
+        rows = []
+        for bucket in self._find(query):
+            rows.extend(self._rows(bucket))
+        rows.sort(key=self._key)
+        return rows
+
+    def since(self, session_id, timestamp=None):
+        """Messages strictly newer than timestamp, oldest first"""
+        query = {'session_id': session_id}
+        if timestamp is not None:
+            query['last_ts'] = {'$gt': timestamp}
+        rows = []
+        for bucket in self._find(query):
+            rows.extend(row for row in self._rows(bucket) if timestamp is None or row['timestamp'] > timestamp)
+        rows.sort(key=self._key)
+        return rows
+
+    def page(self, session_id, limit, cursor_value=None, newer=False):
+        """
+        One keyset page, oldest first. cursor_value is (timestamp, tiebreak) or None.
+
+        Returns (rows, has_more) like ChatStorage.page.
+        """
+        query = {'session_id': session_id}
+        cursor_key = (cursor_value[0], cursor_value[1]) if cursor_value else None
+        if newer:
+            if cursor_key:
+                query['last_ts'] = {'$gte': cursor_key[0]}
+        else:
+            if cursor_key:
+                query['first_ts'] = {'$lte': cursor_key[0]}
+
+        def keep(row):
+            key = self._key(row)
+            return cursor_key is None or (key > cursor_key if newer else key < cursor_key)
+
+        # One extra row tells whether there is another page
+        collected = self._nearest(query, limit + 1, newest_first=not newer, keep=keep)
+        has_more = len(collected) > limit
+        rows = collected[:limit]
+        if not newer:
+            rows.reverse()
+        return rows, has_more
+
+    def search(self, query, session_id=None, limit=20, offset=0):
+        """
+        Rank individual messages from the best matching buckets.
+
+        The text index scores whole buckets, so the top SEARCH_BUCKETS are scored
+        again per message with BM25; very deep pages may miss weaker matches.
+        """
+        criteria = {'$text': {'$search': query}}
+        if session_id:
+            criteria['session_id'] = session_id
+        cursor = self.buckets.find(criteria, {'score': {'$meta': 'textScore'}, 'session_id': 1, 'messages': 1}) \
+            .sort([('score', {'$meta': 'textScore'})]).limit(self.SEARCH_BUCKETS)
+        messages = {}
+        for bucket in cursor:
+            for index, msg in enumerate(bucket.get('messages', [])):
+                messages[(str(bucket['_id']), index)] = dict(msg, session_id=bucket['session_id'])
+        ranked = score_documents(tokenize(query), [(key, msg['content']) for key, msg in messages.items()])
+        page = ranked[offset:offset + limit + 1]
+        rows = [dict(messages[key], score=score) for score, key in page]
+        return rows[:limit], len(rows) > limit
+
+    def delete(self, session_id=None):
+        """Delete a session's buckets (or all); returns the number of messages removed"""
+        query = {'session_id': session_id} if session_id else {}
+        removed = sum(bucket.get('count', 0) for bucket in self.buckets.find(query, {'count': 1}))
+        self.buckets.delete_many(query)
+        return removed
+
+    def delete_chunk(self, session_id=None, before=None, limit=1000):
+        """
+        Delete the oldest whole buckets, about limit messages' worth, whose newest message is older than before.
+
+        Returns the number of messages removed.
+        """
+        query = {'session_id': session_id} if session_id else {}
+        if before is not None:
+            query['last_ts'] = {'$lt': before}
+        buckets = list(self.buckets.find(query, {'count': 1}).sort('first_ts', 1)
+                       .limit(max(1, limit // self.bucket_size)))
+        if not buckets:
+            return 0
+        self.buckets.delete_many({'_id': {'$in': [bucket['_id'] for bucket in buckets]}})
+        return sum(bucket.get('count', 0) for bucket in buckets)
+
+    def build_buckets(self, session_id, messages):
+        """
+        Pack an ordered list of a session's chat documents into bucket documents.
+
+        Each bucket takes the _id of its first message, so re-running a migration
+        produces the same buckets.
+        """
+        buckets = []
+        for start in range(0, len(messages), self.bucket_size):
+            chunk = messages[start:start + self.bucket_size]
+            buckets.append({
+                '_id': chunk[0]['_id'],
+                'session_id': session_id,
+                'bucket_no': start // self.bucket_size,
+                'count': len(chunk),
+                'first_ts': chunk[0]['timestamp'],
+                'last_ts': chunk[-1]['timestamp'],
+                'messages': [
+                    {'role': m['role'], 'content': m['content'], 'timestamp': m['timestamp']}
+                    for m in chunk
+                ]
+            })
+        return buckets
@@ -0,0 +1,237 @@
+# Export and import SAHPAATHI chat data as NDJSON
+# One JSON record per line: a header, then teachers, sessions and messages, then an end
+# record with the counts. Export streams straight from the backend's cursors and import
+# writes fixed-size batches, so memory use does not grow with the size of the history.
+#
+#   python chat_transfer.py export --backend mongodb --output chats.ndjson.gz
+#   python chat_transfer.py import --backend sqlite --input chats.ndjson.gz
+#   python chat_transfer.py copy --source mongodb --target sqlite
+import argparse
+import calendar
+import gzip
+import hashlib
+import json
+import os
+import sys
+from datetime import datetime
+
+EXPORT_FORMAT = 'sahpaathi-chat-export'
+EXPORT_VERSION = 1
+IMPORT_BATCH_SIZE = 1000
+
+# Record type -> (ChatStorage export method, ChatStorage import method, count key), in export order
+RECORD_TYPES = {
+    'teacher': ('export_teachers', 'import_teachers', 'teachers'),
+    'session': ('export_sessions', 'import_sessions', 'sessions'),
+    'message': ('export_messages', 'import_messages', 'messages'),
+}
+DATETIME_FIELDS = ('created_at', 'updated_at', 'timestamp')
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot export {type(value).__name__}")
+
+def _line(record_type, record):
+    return json.dumps(dict(record, type=record_type), default=_json_default, ensure_ascii=False) + '\n'
+
+def _parse_record(record):
+    """Turn a decoded line back into a storage record, restoring its datetimes"""
+    record.pop('type')
+    for key in DATETIME_FIELDS:
+        if record.get(key) is not None:
+            record[key] = datetime.fromisoformat(record[key])
+    context = record.get('context')
+    if context and context.get('summarized_until') is not None:
+        context['summarized_until'] = datetime.fromisoformat(context['summarized_until'])
+    return record
+
+def message_import_id(record, line_number):
+    """
+    A deterministic, ObjectId-shaped id for the message on line_number.
+
+    Importing the same file again yields the same ids, so the backend skips messages
+    an interrupted run already wrote. The id starts with the timestamp's seconds, then
+    the line number, so messages with equal timestamps keep their order in the file.
+    """
+    digest = hashlib.sha1('\x00'.join(
+        (record['session_id'], record['timestamp'].isoformat(), record['role'], record['content'])
+    ).encode('utf-8')).digest()
+    seconds = calendar.timegm(record['timestamp'].utctimetuple()) & 0xFFFFFFFF
+    return (seconds.to_bytes(4, 'big') + line_number.to_bytes(5, 'big') + digest[:3]).hex()
+
+def export_ndjson(storage, skip_message=None):
+    """Yield every teacher, session and message in storage as NDJSON lines, leaving out messages skip_message flags"""
+    counts = {}
+    yield _line('header', {'format': EXPORT_FORMAT, 'version': EXPORT_VERSION,
+                           'exported_at': datetime.now(), 'source': storage.name})
+    for record_type, (export_method, _, count_key) in RECORD_TYPES.items():
+        counts[count_key] = 0
+        for record in getattr(storage, export_method)():
+            if record_type == 'message' and skip_message and skip_message(record):
+                continue
+            counts[count_key] += 1
+            yield _line(record_type, record)
+    # A missing end record means the export was cut short
+    yield _line('end', {'counts': counts})
+
+def import_ndjson(storage, lines, batch_size=IMPORT_BATCH_SIZE, start_line=0, on_checkpoint=None):
+    """
+    Write the records in an NDJSON export into storage, batch_size records at a time.
+
+    Args:
+        storage: The ChatStorage to import into
+        lines: Iterable of NDJSON lines (str or bytes)
+        start_line (int): Skip lines up to and including this one, to resume an import
+        on_checkpoint: Called with (line_number, counts) once every line up to line_number is written
+
+    Returns (counts, complete); complete is False if the input had no end record.
+    Raises ValueError on malformed input; lines before the last checkpoint are already written.
+    """
+    counts = {count_key: 0 for _, _, count_key in RECORD_TYPES.values()}
+    pending = []
+    pending_type = None
+    last_line = start_line
+    complete = False
+
+    def flush(line_number):
+        if pending:
+            _, import_method, count_key = RECORD_TYPES[pending_type]
+            getattr(storage, import_method)(pending)
+            counts[count_key] += len(pending)
+            pending.clear()
+        if on_checkpoint and line_number > start_line:
+            on_checkpoint(line_number, dict(counts))
+
+    for line_number, line in enumerate(lines, 1):
+        if line_number <= start_line or not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            record_type = record['type']
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"Line {line_number}: not an export record ({e})") from e
+        if record_type == 'header':
+            if record.get('format') != EXPORT_FORMAT or record.get('version', 0) > EXPORT_VERSION:
+                raise ValueError(f"Line {line_number}: unsupported export format {record.get('format')} "
+                                 f"version {record.get('version')}")
+            continue
+        if record_type == 'end':
+            complete = True
+            continue
+        if record_type not in RECORD_TYPES:
+            raise ValueError(f"Line {line_number}: unknown record type {record_type}")
+        # Batches hold one record type, so sessions are written before the messages that follow them
+        if pending and (record_type != pending_type or len(pending) >= batch_size):
+            flush(last_line)
+        try:
+            record = _parse_record(record)
+            if record_type == 'message':
+                record['import_id'] = message_import_id(record, line_number)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            raise ValueError(f"Line {line_number}: bad {record_type} record ({e})") from e
+        pending.append(record)
+        pending_type = record_type
+        last_line = line_number
+    flush(last_line)
+    return counts, complete
+
+def open_backend(name, args):
+    """Open a storage backend for the CLI; MongoDB must answer a ping first"""
+    if name == 'sqlite':
+        from sqlite_storage import SQLiteChatStorage
+        return SQLiteChatStorage(args.sqlite_path) if args.sqlite_path else SQLiteChatStorage()
+    if name == 'mongodb':
+        from mongo_storage import MongoChatStorage
+        # Imports write their own batches, so skip the write-behind buffer
+        storage = MongoChatStorage(uri=args.mongo_uri, database=args.database, durability='sync')
+        storage.ping()
+        return storage
+    raise ValueError(f"Unknown backend: {name}")
+
+def _open_file(path, mode):
+    if path == '-':
+        return sys.stdout if 'w' in mode else sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def run_export(args):
+    storage = open_backend(args.backend, args)
+    out = _open_file(args.output, 'w')
+    try:
+        for line in export_ndjson(storage):
+            out.write(line)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        storage.close()
+
+def run_import(args):
+    """Import a file, checkpointing to <input>.checkpoint so an interrupted run can resume"""
+    checkpoint_path = args.input + '.checkpoint'
+    size = os.path.getsize(args.input)
+    checkpoint = {}
+    if os.path.exists(checkpoint_path) and not args.restart:
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('size') != size:
+            sys.exit(f"{checkpoint_path} belongs to a different file; use --restart to import from the start")
+        print(f"Resuming after line {checkpoint['line']}")
+
+    start_line = checkpoint.get('line', 0)
+    previous = checkpoint.get('counts', {})
+
+    def save_checkpoint(line_number, counts):
+        total = {key: previous.get(key, 0) + value for key, value in counts.items()}
+        tmp_path = checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': size, 'line': line_number, 'counts': total}, f)
+        os.replace(tmp_path, checkpoint_path)
+
+    storage = open_backend(args.backend, args)
+    try:
+        with _open_file(args.input, 'r') as lines:
+            counts, complete = import_ndjson(storage, lines, args.batch_size, start_line, save_checkpoint)
+    finally:
+        storage.close()
+    print("Imported " + ", ".join(f"{value} {key}" for key, value in counts.items()))
+    if not complete:
+        print("Warning: the input has no end record, so the export it came from may be incomplete")
+
+def run_copy(args):
+    source = open_backend(args.source, args)
+    target = open_backend(args.target, args)
+    try:
+        counts, _ = import_ndjson(target, export_ndjson(source), args.batch_size)
+    finally:
+        source.close()
+        target.close()
+    print("Copied " + ", ".join(f"{value} {key}" for key, value in counts.items()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export, import or copy SAHPAATHI chat data as NDJSON')
+    parser.add_argument('--mongo-uri', type=str, default='mongodb://localhost:27017/', help='MongoDB connection string')
+    parser.add_argument('--database', type=str, default='sahpaathi', help='MongoDB database name')
+    parser.add_argument('--sqlite-path', type=str, default=None, help='SQLite file (default: SQLITE_PATH)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help='Write every teacher, session and message to NDJSON')
+    export_parser.add_argument('--backend', choices=['mongodb', 'sqlite'], default='mongodb')
+    export_parser.add_argument('--output', type=str, default='-', help='File to write (.gz is compressed; - for stdout)')
+
+    import_parser = commands.add_parser('import', help='Load an NDJSON export, resuming from its checkpoint')
+    import_parser.add_argument('--backend', choices=['mongodb', 'sqlite'], default='mongodb')
+    import_parser.add_argument('--input', type=str, required=True, help='Export file to read (.gz is decompressed)')
+    import_parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='Records written per batch')
+    import_parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and import from the start')
+
+    copy_parser = commands.add_parser('copy', help='Stream everything from one backend into another')
+    copy_parser.add_argument('--source', choices=['mongodb', 'sqlite'], required=True)
+    copy_parser.add_argument('--target', choices=['mongodb', 'sqlite'], required=True)
+    copy_parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='Records written per batch')
+
+    args = parser.parse_args()
+    if args.command == 'copy' and args.source == args.target:
+        parser.error('--source and --target must be different backends')
+    {'export': run_export, 'import': run_import, 'copy': run_copy}[args.command](args)
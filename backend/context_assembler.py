@@ -0,0 +1,170 @@
+# Multi-turn context assembly for SAHPAATHI chat
+# Builds each chat prompt from a rolling summary of older turns plus a bounded
+# window of recent turns, trimmed to fit a token budget.
+import logging
+import math
+import os
+import threading
+
+from resilience import LLMError
+
+logger = logging.getLogger(__name__)
+
+def estimate_tokens(text):
+    """Rough token estimate (about four characters per token for English text)"""
+    if not text:
+        return 0
+    return max(1, math.ceil(len(text) / 4))
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text down to roughly max_tokens, keeping the end (the most recent part)"""
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    return "..." + text[-max_chars:]
+
+_ROLE_LABELS = {'user': 'Student', 'assistant': 'SAHPAATHI'}
+
+def format_turn(message):
+    return f"{_ROLE_LABELS.get(message['role'], message['role'])}: {message['content']}"
+
+class ContextAssembler:
+    def __init__(self, db, generate, window_messages=6, token_budget=3000, summary_tokens=300):
+        """
+        Args:
+            db (ChatDatabase): Where messages and the rolling summary are stored
+            generate (callable): generate_response-compatible function used for summaries
+            window_messages (int): Recent messages kept verbatim
+            token_budget (int): Upper bound on the estimated size of an assembled prompt
+            summary_tokens (int): Upper bound on the size of the rolling summary
+        """
+        self.db = db
+        self.generate = generate
+        self.window_messages = window_messages
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        # Sessions with a fold queued or running
+        self._folding = set()
+        self._lock = threading.Lock()
+
+    def build_prompt(self, session_id, user_prompt):
+        """Return the prompt to send for user_prompt, including conversation context"""
+        if not session_id:
+            return user_prompt
+        context = self.db.get_session_context(session_id)
+        # Only messages newer than the summary are read, so this stays bounded as sessions grow
+        recent = self.db.get_messages_since(session_id, context.get('summarized_until'))
+        summary = context.get('summary') or ''
+        if not recent and not summary:
+            return user_prompt
+
+        question = f"Student: {user_prompt}"
+        budget = self.token_budget - estimate_tokens(question)
+        summary_block = ""
+        if summary:
+            summary_block = f"Summary of the earlier conversation:\n{truncate_to_tokens(summary, self.summary_tokens)}\n\n"
+            budget -= estimate_tokens(summary_block)
+
+        # Walk back from the newest turn until the budget is spent
+        turns = []
+        for message in reversed(recent[-self.window_messages:]):
+            turn = format_turn(message)
+            cost = estimate_tokens(turn)
+            if cost > budget:
+                if not turns:
+                    turns.append(truncate_to_tokens(turn, max(budget, 0)))
+                break
+            turns.append(turn)
+            budget -= cost
+        turns.reverse()
+
+        recent_block = ""
+        if turns:
+            recent_block = "Recent conversation:\n" + "\n\n".join(turns) + "\n\n"
+        return (
+            f"{summary_block}{recent_block}"
+            f"Continue the conversation by answering the student's latest message.\n\n{question}"
+        )
+
+    def _foldable(self, session_id):
+        """(context, messages to fold) once enough turns have left the recent window, else None"""
+        context = self.db.get_session_context(session_id)
+        recent = self.db.get_messages_since(session_id, context.get('summarized_until'))
+        if len(recent) < 2 * self.window_messages:
+            return None
+        return context, recent[:-self.window_messages]
+
+    def fold(self, session_id):
+        """
+        Fold messages that have left the recent window into the rolling summary.
+
+        Folding happens in batches of window_messages, so the summary is only rewritten
+        every few turns. It costs an LLM call; use fold_later from request handlers.
+        """
+        if not session_id:
+            return False
+        foldable = self._foldable(session_id)
+        if foldable is None:
+            return False
+        context, to_fold = foldable
+        summary = self._summarize(context.get('summary') or '', to_fold)
+        self.db.update_session_context(session_id, summary, to_fold[-1]['timestamp'])
+        logger.info(f"Folded {len(to_fold)} messages into the summary for session {session_id}")
+        return True
+
+    def fold_later(self, session_id, submit):
+        """
+        Hand a due fold to submit(fold) to run off the request path; returns True if it was handed over.
+
+        Prompts built before it finishes use the previous summary. At most one fold per
+        session is outstanding; errors from submit propagate.
+        """
+        if not session_id or self._foldable(session_id) is None:
+            return False
+        with self._lock:
+            if session_id in self._folding:
+                return False
+            self._folding.add(session_id)
+
+        def fold():
+            try:
+                return self.fold(session_id)
+            finally:
+                with self._lock:
+                    self._folding.discard(session_id)
+
+        try:
+            submit(fold)
+        except Exception:
+            with self._lock:
+                self._folding.discard(session_id)
+            raise
+        return True
+
+    def _summarize(self, previous_summary, messages):
+        transcript = "\n".join(format_turn(m) for m in messages)
+        prompt = (
+            "You maintain a running summary of a tutoring conversation. "
+            f"Update the summary below with the new turns, keeping it under {self.summary_tokens * 3 // 4} words. "
+            "Keep the topics covered, the student's goals and anything they struggled with. "
+            "Return only the updated summary.\n\n"
+            f"CURRENT SUMMARY:\n{previous_summary or '(none)'}\n\n"
+            f"NEW TURNS:\n{truncate_to_tokens(transcript, self.token_budget)}"
+        )
+        try:
+            summary = self.generate(prompt, endpoint='chat')
+        except LLMError as e:
+            # Keep the conversation going with a crude extractive summary instead
+            logger.warning(f"Summary generation failed, using extractive summary: {str(e)}")
+            summary = (previous_summary + "\n" + transcript).strip()
+        return truncate_to_tokens(summary.strip(), self.summary_tokens)
+
+def create_context_assembler(db, generate):
+    """Build a ContextAssembler configured from the environment"""
+    return ContextAssembler(
+        db,
+        generate,
+        window_messages=int(os.getenv("CHAT_CONTEXT_MESSAGES", "6")),
+        token_budget=int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "3000")),
+        summary_tokens=int(os.getenv("CHAT_SUMMARY_TOKENS", "300"))
+    )
@@ -1,50 +1,336 @@
 # Database connection module for SAHPAATHI
-# This file will handle database connections and operations
-import pymongo
-from datetime import datetime
+# ChatDatabase is the single entry point the routes use. It delegates to a storage
+# backend (MongoDB, SQLite or in-memory) and falls back to memory if MongoDB fails.
+from datetime import datetime, timedelta
+import base64
+import os
+import threading
+import time
 import uuid
+from collections import deque
+from memory_store import InMemoryChatStore
+from storage import EMPTY_SESSION_STATS
+from search_index import make_snippet, tokenize
+import chat_transfer
+from jobs import JobManager
+
+# Unscoped history requests (no session_id) never return more than this many messages
+MAX_UNSCOPED_HISTORY = int(os.getenv("HISTORY_UNSCOPED_LIMIT", "1000"))
+MAX_HISTORY_PAGE = 200
+MAX_SEARCH_PAGE = 50
+
+# "mongodb" (default), "sqlite" or "memory"
+CHAT_STORAGE_BACKEND = os.getenv("CHAT_STORAGE_BACKEND", "mongodb").lower()
+
+# Cached teacher/session lists expire after this long even without a local write,
+# so changes made by other worker processes show up
+LIST_CACHE_TTL_SECONDS = float(os.getenv("DB_LIST_CACHE_TTL_SECONDS", "5"))
+
+# How often the primary backend is health-checked, and how many writes made in memory
+# while it is down are kept for replay when it comes back
+HEALTH_CHECK_SECONDS = float(os.getenv("DB_HEALTH_CHECK_SECONDS", "5"))
+REPLAY_MAX_OPS = int(os.getenv("DB_REPLAY_MAX_OPS", "10000"))
+
+# Retention: sessions and messages older than CHAT_RETENTION_DAYS, and sessions beyond the newest
+# CHAT_RETENTION_MAX_SESSIONS, are deleted (0 disables either). MongoDB expires by age with TTL
+# indexes; everything else is done by a sweep every CHAT_RETENTION_SWEEP_SECONDS.
+CHAT_RETENTION_DAYS = float(os.getenv("CHAT_RETENTION_DAYS", "0"))
+CHAT_RETENTION_MAX_SESSIONS = int(os.getenv("CHAT_RETENTION_MAX_SESSIONS", "0"))
+CHAT_RETENTION_SWEEP_SECONDS = float(os.getenv("CHAT_RETENTION_SWEEP_SECONDS", "3600"))
+
+# Sweeps and clear_history delete messages this many at a time, pausing in between so
+# other queries keep getting through
+CHAT_DELETE_BATCH_SIZE = int(os.getenv("CHAT_DELETE_BATCH_SIZE", "1000"))
+CHAT_DELETE_PAUSE_SECONDS = float(os.getenv("CHAT_DELETE_PAUSE_SECONDS", "0.05"))
+# Sessions whose summary fields a sweep recomputes per call
+REBUILD_BATCH_SIZE = 500
+
+def encode_history_cursor(timestamp, tiebreak):
+    """Build an opaque pagination cursor from a message's timestamp and tie-breaker"""
+    raw = f"{timestamp.isoformat()}|{tiebreak}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_history_cursor(cursor):
+    """Split a cursor back into (timestamp, tiebreak); raises ValueError if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, tiebreak = raw.split('|', 1)
+        return datetime.fromisoformat(timestamp), tiebreak
+    except Exception as e:
+        raise ValueError(f"Invalid history cursor: {cursor}") from e
+
+def open_storage(name):
+    """Open the named storage backend; raises if it cannot be reached"""
+    if name == 'sqlite':
+        from sqlite_storage import SQLiteChatStorage
+        return SQLiteChatStorage()
+    if name == 'mongodb':
+        from mongo_storage import MongoChatStorage
+        return MongoChatStorage(retention_seconds=CHAT_RETENTION_DAYS * 86400)
+    raise ValueError(f"Unknown CHAT_STORAGE_BACKEND: {name}")
+
+def _isoformat(record):
+    """Copy a session or teacher with its timestamps formatted for JSON"""
+    record = dict(record)
+    for key in ('created_at', 'updated_at'):
+        if isinstance(record.get(key), datetime):
+            record[key] = record[key].isoformat()
+    return record
+
+class ListCache:
+    """Read-through cache for serialised list queries, invalidated by writes"""
+
+    def __init__(self, ttl_seconds=LIST_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}      # key -> (expires_at, value)
+        self._generations = {}  # key -> bumped on every invalidation
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, load):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.hits += 1
+                return list(entry[1])
+            self.misses += 1
+            generation = self._generations.get(key, 0)
+        value = load()
+        with self._lock:
+            # A write that landed while loading makes this result stale; don't keep it
+            if self.ttl_seconds > 0 and self._generations.get(key, 0) == generation:
+                self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        return list(value)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys or list(self._generations.keys() | self._entries.keys()):
+                self._entries.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'ttl_seconds': self.ttl_seconds}
 
 class ChatDatabase:
-    def __init__(self):
-        # Connect to MongoDB - we'll use a database named sahpaathi
-        # Note: This assumes MongoDB is running on the default localhost:27017
-        # In production, you would use environment variables for the connection string
+    DEFAULT_TEACHERS = [
+        ("General Assistant", "You are a helpful general assistant."),
+        ("Math Tutor", "You are an expert math tutor. Explain concepts clearly and help solve problems step-by-step."),
+        ("History Buff", "You are a history enthusiast. Provide detailed historical context and answer questions about historical events and figures."),
+    ]
+
+    def __init__(self, backend=CHAT_STORAGE_BACKEND, health_check_seconds=HEALTH_CHECK_SECONDS,
+                 retention_days=CHAT_RETENTION_DAYS, retention_max_sessions=CHAT_RETENTION_MAX_SESSIONS,
+                 retention_sweep_seconds=CHAT_RETENTION_SWEEP_SECONDS):
+        # Callbacks notified with a teacher_id when that teacher's prompt changes or it is deleted
+        self._teacher_listeners = []
+        # Bounded in-memory storage, used as the memory backend and as the fallback when the primary fails
+        self.memory = InMemoryChatStore()
+        self.current_session_id = str(uuid.uuid4())
+        # Serialised get_all_teachers / get_all_sessions results
+        self.list_cache = ListCache()
+        # Writes made in memory while the primary is down, replayed in order when it recovers
+        self._replay = deque()
+        self._replay_lock = threading.RLock()
+        self.dropped_replay_ops = 0
+        # Background message deletion (clear_history) runs one job at a time, apart from the shared job pool
+        self.deletions = JobManager(max_workers=1, max_pending=8)
+        # session_id (None for every session) -> cutoff of a clear whose messages are still being deleted;
+        # search and export hide those messages meanwhile
+        self._clearing = {}
+        self._clearing_lock = threading.Lock()
+        self.retention_days = retention_days
+        self.retention_max_sessions = retention_max_sessions
+        self.last_sweep = None
+        self._connected = False
+        self.primary = self.memory
+        self.storage = self.memory
+        if backend != 'memory':
+            try:
+                self.primary = open_storage(backend)
+            except Exception as e:
+                print(f"{backend} storage error: {e}")
+                # Fallback to in-memory if the backend cannot be opened
+                print("Falling back to in-memory storage")
+        if self.primary.lazy:
+            # Serve from memory until the health check reaches the primary, so startup never blocks on it
+            print(f"Connecting to {self.primary.name} in the background")
+        else:
+            self._on_connected()
+        if self.primary is not self.memory:
+            self._health_thread = threading.Thread(
+                target=self._health_loop, args=(health_check_seconds,), name='db-health-check', daemon=True
+            )
+            self._health_thread.start()
+        if retention_days or retention_max_sessions:
+            self._retention_thread = threading.Thread(
+                target=self._retention_loop, args=(retention_sweep_seconds,), name='db-retention-sweep', daemon=True
+            )
+            self._retention_thread.start()
+
+    @property
+    def use_mongodb(self):
+        return self.storage.name == 'mongodb'
+
+    @property
+    def degraded(self):
+        """True while a primary backend is configured but requests are served from memory"""
+        return self.primary is not self.memory and self.storage is self.memory
+
+    def _on_connected(self):
+        self.storage = self.primary
+        if not self._connected:
+            self._connected = True
+            self._initialize_default_teachers()
+
+    def _health_loop(self, interval):
+        while True:
+            self.check_health()
+            time.sleep(interval)
+
+    def check_health(self):
+        """Ping the primary backend; fail over to memory or back to the primary as needed"""
         try:
-            # Set a server timeout to avoid hanging on connection issues
-            self.client = pymongo.MongoClient("mongodb://localhost:27017/", serverSelectionTimeoutMS=5000)
-            # Test the connection
-            self.client.server_info()
-            self.db = self.client["sahpaathi"]
-            self.chats = self.db["chats"]
-            self.chat_sessions = self.db["chat_sessions"]  # New collection for chat sessions
-            self.teachers = self.db["teachers"] # New collection for teachers
-            print("MongoDB connection successful")
-            self.use_mongodb = True
+            healthy = self.primary.ping()
         except Exception as e:
-            print(f"MongoDB connection error: {e}")
-            # Fallback to in-memory if MongoDB connection fails
-            self.client = None
-            self.chat_history = []
-            self.current_session_id = str(uuid.uuid4())
-            self.sessions = {}
-            self.use_mongodb = False
-            self._initialize_default_teachers()
+            healthy = False
+            if not self.degraded:
+                print(f"{self.primary.name} health check failed: {e}")
+        if healthy and self.degraded:
+            self._fail_back()
+        elif not healthy and not self.degraded:
+            self._degrade(f"{self.primary.name} health check failed")
+        return healthy
+
+    def _degrade(self, reason):
+        with self._replay_lock:
+            if self.storage is self.memory:
+                return
+            print(f"{reason}; serving from in-memory storage until it recovers")
+            self.storage = self.memory
+        self.list_cache.invalidate()
+
+    def _fail_back(self):
+        """Replay the writes made in memory into the primary, then switch back to it"""
+        replayed = 0
+        first_connect = not self._connected
+        while True:
+            with self._replay_lock:
+                if not self._replay:
+                    # Nothing can be journaled between this check and the switch: writes take the same lock
+                    self._on_connected()
+                    # Everything in memory is now in the primary too
+                    self.memory.reset()
+                    break
+                method, args = self._replay[0]
+            try:
+                getattr(self.primary, method)(*args)
+            except Exception as e:
+                print(f"Replay to {self.primary.name} stopped after {replayed} writes: {e}")
+                return False
+            with self._replay_lock:
+                self._replay.popleft()
+            replayed += 1
+        self.list_cache.invalidate()
+        if first_connect:
+            print(f"Connected to {self.primary.name}; replayed {replayed} writes made while connecting")
+        else:
+            print(f"Failed back to {self.primary.name}; replayed {replayed} writes")
+        return True
+
+    def _run(self, action, operation, default=None, fall_back=False):
+        """
+        Run operation(storage) against the active backend.
+
+        On failure the error is logged and default is returned, or with fall_back the
+        database switches to in-memory storage and retries there.
+        """
+        storage = self.storage
+        try:
+            return operation(storage)
+        except Exception as e:
+            if storage is self.memory:
+                raise
+            print(f"Error {action} in {storage.name}: {e}")
+            if not fall_back:
+                return default
+            self._degrade(f"Error {action}")
+            return operation(self.memory)
+
+    def _write(self, action, method, args, default=None, fall_back=False):
+        """
+        Run a storage write; one made in memory while the primary is down is journaled for replay.
+
+        Writes that fail in memory (returning False, e.g. an unknown session) are not replayed.
+        """
+        def operation(storage):
+            if storage is not self.memory or self.primary is self.memory:
+                return getattr(storage, method)(*args)
+            with self._replay_lock:
+                if self.storage is not self.memory:
+                    # Failed back while this write was on its way
+                    return getattr(self.storage, method)(*args)
+                result = getattr(self.memory, method)(*args)
+                if result is not False:
+                    self._replay.append((method, args))
+                    if len(self._replay) > REPLAY_MAX_OPS:
+                        self._replay.popleft()
+                        self.dropped_replay_ops += 1
+                return result
+        return self._run(action, operation, default=default, fall_back=fall_back)
+
+    def flush_writes(self):
+        """Flush buffered writes, if the backend buffers any"""
+        return self._run("flushing writes", lambda s: s.flush(), default=False)
+
+    def explain_hot_queries(self):
+        """Explain the hot queries and flag any full scans"""
+        return self._run("explaining queries", lambda s: s.explain_hot_queries(), default={})
+
+    def stats(self):
+        return {
+            'backend': self.storage.name,
+            'storage': self._run("reading stats", lambda s: s.stats(), default={}),
+            'primary': self.primary.name,
+            'degraded': self.degraded,
+            'replay_pending': len(self._replay),
+            'dropped_replay_ops': self.dropped_replay_ops,
+            'memory_store': self.memory.stats(),
+            'list_cache': self.list_cache.stats(),
+            'retention': {
+                'max_age_days': self.retention_days,
+                'max_sessions': self.retention_max_sessions,
+                'expires_by_ttl': self.primary.expires_by_ttl,
+                'last_sweep': self.last_sweep
+            },
+            'deletions': self.deletions.stats()
+        }
 
     def _initialize_default_teachers(self):
         """Initialize default teachers if they don't exist."""
-        if self.use_mongodb:
+        try:
+            if self.primary.count_teachers() == 0:
+                for name, prompt in self.DEFAULT_TEACHERS:
+                    self.primary.create_teacher({
+                        "teacher_id": str(uuid.uuid4()), "name": name, "prompt": prompt,
+                        "is_custom": False, "created_at": datetime.now(), "updated_at": datetime.now()
+                    })
+                print("Initialized default teachers.")
+        except Exception as e:
+            print(f"Error initializing default teachers: {e}")
+
+    def add_teacher_listener(self, callback):
+        """Register a callback(teacher_id) run after a teacher is updated or deleted."""
+        self._teacher_listeners.append(callback)
+
+    def _notify_teacher_changed(self, teacher_id):
+        for callback in self._teacher_listeners:
             try:
-                if self.teachers.count_documents({}) == 0:
-                    default_teachers = [
-                        {"teacher_id": str(uuid.uuid4()), "name": "General Assistant", "prompt": "You are a helpful general assistant.", "is_custom": False, "created_at": datetime.now(), "updated_at": datetime.now()},
-                        {"teacher_id": str(uuid.uuid4()), "name": "Math Tutor", "prompt": "You are an expert math tutor. Explain concepts clearly and help solve problems step-by-step.", "is_custom": False, "created_at": datetime.now(), "updated_at": datetime.now()},
-                        {"teacher_id": str(uuid.uuid4()), "name": "History Buff", "prompt": "You are a history enthusiast. Provide detailed historical context and answer questions about historical events and figures.", "is_custom": False, "created_at": datetime.now(), "updated_at": datetime.now()}
-                    ]
-                    self.teachers.insert_many(default_teachers)
-                    print("Initialized default teachers.")
+                callback(teacher_id)
             except Exception as e:
-                print(f"Error initializing default teachers: {e}")
-        # In-memory default teachers can be handled if needed, but primary focus is MongoDB
+                print(f"Error in teacher listener for {teacher_id}: {e}")
 
     def create_teacher(self, name, prompt, is_custom=True):
         """Create a new teacher."""
@@ -57,90 +343,42 @@ class ChatDatabase:
             'created_at': datetime.now(),
             'updated_at': datetime.now()
         }
-        if self.use_mongodb:
-            try:
-                self.teachers.insert_one(teacher)
-                print(f"Created new teacher: {name} ({teacher_id})")
-                return teacher_id
-            except Exception as e:
-                print(f"Error creating teacher: {e}")
-                return None
-        else:
-            # In-memory implementation (simplified)
-            if not hasattr(self, 'in_memory_teachers'):
-                self.in_memory_teachers = {}
-            self.in_memory_teachers[teacher_id] = teacher
-            print(f"Created new teacher (in-memory): {name} ({teacher_id})")
-            return teacher_id
+        created = self._write("creating teacher", 'create_teacher', (teacher,), default=False)
+        self.list_cache.invalidate('teachers')
+        if created is False:
+            return None
+        print(f"Created new teacher: {name} ({teacher_id})")
+        return teacher_id
 
     def get_teacher(self, teacher_id):
         """Get a specific teacher by ID."""
-        if self.use_mongodb:
-            try:
-                teacher = self.teachers.find_one({'teacher_id': teacher_id})
-                if teacher:
-                    teacher['_id'] = str(teacher['_id']) # Convert ObjectId
-                    teacher['created_at'] = teacher['created_at'].isoformat()
-                    teacher['updated_at'] = teacher['updated_at'].isoformat()
-                return teacher
-            except Exception as e:
-                print(f"Error getting teacher {teacher_id}: {e}")
-                return None
-        else:
-            return self.in_memory_teachers.get(teacher_id)
+        teacher = self._run(f"getting teacher {teacher_id}", lambda s: s.get_teacher(teacher_id))
+        return _isoformat(teacher) if teacher else None
 
     def get_all_teachers(self):
         """Get all teachers."""
-        if self.use_mongodb:
-            try:
-                cursor = self.teachers.find({}).sort('name', 1)
-                teachers_list = []
-                for teacher in cursor:
-                    teacher['_id'] = str(teacher['_id'])
-                    teacher['created_at'] = teacher['created_at'].isoformat()
-                    teacher['updated_at'] = teacher['updated_at'].isoformat()
-                    teachers_list.append(teacher)
-                return teachers_list
-            except Exception as e:
-                print(f"Error getting all teachers: {e}")
-                return []
-        else:
-            return list(self.in_memory_teachers.values()) if hasattr(self, 'in_memory_teachers') else []
+        return self.list_cache.get_or_load('teachers', lambda: [
+            _isoformat(t) for t in self._run("getting all teachers", lambda s: s.get_teachers(), default=[])
+        ])
 
     def update_teacher_prompt(self, teacher_id, prompt):
         """Update a teacher's prompt."""
-        if self.use_mongodb:
-            try:
-                result = self.teachers.update_one(
-                    {'teacher_id': teacher_id},
-                    {'$set': {'prompt': prompt, 'updated_at': datetime.now()}}
-                )
-                return result.modified_count > 0
-            except Exception as e:
-                print(f"Error updating teacher {teacher_id}: {e}")
-                return False
-        else:
-            if hasattr(self, 'in_memory_teachers') and teacher_id in self.in_memory_teachers:
-                self.in_memory_teachers[teacher_id]['prompt'] = prompt
-                self.in_memory_teachers[teacher_id]['updated_at'] = datetime.now()
-                return True
-            return False
+        updated = self._write(
+            f"updating teacher {teacher_id}", 'update_teacher_prompt', (teacher_id, prompt, datetime.now()),
+            default=False
+        )
+        self.list_cache.invalidate('teachers')
+        if updated:
+            self._notify_teacher_changed(teacher_id)
+        return updated
 
     def delete_teacher(self, teacher_id):
         """Delete a custom teacher."""
-        if self.use_mongodb:
-            try:
-                # Ensure we only delete custom teachers for safety, or allow deleting any if needed
-                result = self.teachers.delete_one({'teacher_id': teacher_id, 'is_custom': True})
-                return result.deleted_count > 0
-            except Exception as e:
-                print(f"Error deleting teacher {teacher_id}: {e}")
-                return False
-        else:
-            if hasattr(self, 'in_memory_teachers') and teacher_id in self.in_memory_teachers and self.in_memory_teachers[teacher_id]['is_custom']:
-                del self.in_memory_teachers[teacher_id]
-                return True
-            return False
+        deleted = self._write(f"deleting teacher {teacher_id}", 'delete_teacher', (teacher_id,), default=False)
+        self.list_cache.invalidate('teachers')
+        if deleted:
+            self._notify_teacher_changed(teacher_id)
+        return deleted
 
     def create_new_session(self, name=None):
         """Create a new chat session and return its ID"""
@@ -151,219 +389,305 @@ class ChatDatabase:
             'created_at': datetime.now(),
             'updated_at': datetime.now()
         }
-        
-        if self.use_mongodb:
-            try:
-                self.chat_sessions.insert_one(session)
-                print(f"Created new chat session: {session_id}")
-                return session_id
-            except Exception as e:
-                print(f"Error creating chat session: {e}")
-                # Fall back to in-memory
-                self.use_mongodb = False
-                self.sessions[session_id] = session
-                return session_id
-        else:
-            # In-memory implementation
-            self.sessions[session_id] = session
-            return session_id
-    
+        self._write("creating chat session", 'create_session', (session,), fall_back=True)
+        self.list_cache.invalidate('sessions')
+        print(f"Created new chat session: {session_id}")
+        return session_id
+
     def get_all_sessions(self):
-        """Get all chat sessions"""
-        if self.use_mongodb:
-            try:
-                # Get all sessions sorted by update time (newest first)
-                cursor = self.chat_sessions.find({}).sort('updated_at', -1)
-                sessions = list(cursor)
-                # Convert ObjectId to string for JSON serialization
-                for session in sessions:
-                    session['_id'] = str(session['_id'])
-                    # Format timestamps as strings
-                    session['created_at'] = session['created_at'].isoformat()
-                    session['updated_at'] = session['updated_at'].isoformat()
-                return sessions
-            except Exception as e:
-                print(f"Error getting chat sessions: {e}")
-                self.use_mongodb = False
-                return list(self.sessions.values())
-        else:
-            return list(self.sessions.values())
-    
+        """
+        Get all chat sessions, most recently updated first
+
+        Each session carries message_count, total_chars, last_role and last_message_preview,
+        maintained by add_message, so the sidebar needs no per-session history query.
+        """
+        return self.list_cache.get_or_load('sessions', lambda: [
+            # Sessions written before the summary fields existed read as empty until rebuilt
+            _isoformat(dict(EMPTY_SESSION_STATS, **session))
+            for session in self._run("getting chat sessions", lambda s: s.get_sessions(), fall_back=True)
+        ])
+
     def update_session_name(self, session_id, name):
         """Update the name of a chat session"""
-        if self.use_mongodb:
-            try:
-                self.chat_sessions.update_one(
-                    {'session_id': session_id},
-                    {'$set': {'name': name, 'updated_at': datetime.now()}}
-                )
-                return True
-            except Exception as e:
-                print(f"Error updating session name: {e}")
-                return False
-        else:
-            if session_id in self.sessions:
-                self.sessions[session_id]['name'] = name
-                self.sessions[session_id]['updated_at'] = datetime.now()
-                return True
-            return False
-    
+        renamed = self._write("updating session name", 'rename_session', (session_id, name), default=False)
+        self.list_cache.invalidate('sessions')
+        return renamed
+
     def add_message(self, session_id, role, content):
         """
         Add a new message to a specific chat session
-        
+
         Args:
             session_id (str): The session ID
             role (str): 'user' or 'assistant'
             content (str): The message content
         """
-        message = {
-            'session_id': session_id,
-            'role': role,
-            'content': content,
-            'timestamp': datetime.now()
+        timestamp = datetime.now()
+        self._write("adding message", 'add_message', (session_id, role, content, timestamp), fall_back=True)
+        # The session's updated_at moved, so the list order may have changed
+        self.list_cache.invalidate('sessions')
+        print(f"Message added to {self.storage.name} session {session_id}: {role}")
+        return True
+
+    def get_chat_history(self, session_id=None, limit=None):
+        """
+        Get chat messages for a specific session or all messages if no session specified
+
+        Args:
+            session_id (str): The session ID; when omitted, messages from every session are
+                returned, capped at MAX_UNSCOPED_HISTORY
+            limit (int): Only return the newest `limit` messages (still oldest first)
+        """
+        if not session_id:
+            limit = min(limit or MAX_UNSCOPED_HISTORY, MAX_UNSCOPED_HISTORY)
+        messages = self._run("getting chat history", lambda s: s.history(session_id, limit), fall_back=True)
+        # Only role and content, without timestamps
+        history = [{'role': msg['role'], 'content': msg['content']} for msg in messages]
+        print(f"Retrieved {len(history)} messages from {self.storage.name}" +
+              (f" for session {session_id}" if session_id else ""))
+        return history
+
+    def get_chat_history_page(self, session_id, limit=50, before=None, after=None):
+        """
+        Get one page of a session's messages using keyset pagination
+
+        Args:
+            session_id (str): The session ID
+            limit (int): Page size (capped at MAX_HISTORY_PAGE)
+            before (str): Cursor; return the messages just older than it
+            after (str): Cursor; return the messages just newer than it
+
+        With neither cursor, the newest page is returned. Messages are always oldest first.
+        Returns a dict with 'messages', 'has_more' (more pages in the direction requested),
+        and 'before_cursor' / 'after_cursor' for fetching the neighbouring pages.
+        """
+        limit = max(1, min(int(limit or 50), MAX_HISTORY_PAGE))
+        newer = after is not None
+        cursor_value = decode_history_cursor(after if newer else before) if (before or after) else None
+        rows, has_more = self._run(
+            "getting chat history page",
+            lambda s: s.page(session_id, limit, cursor_value, newer),
+            default=([], False)
+        )
+        messages = [{'role': row['role'], 'content': row['content']} for row in rows]
+        return {
+            'messages': messages,
+            'has_more': has_more,
+            'before_cursor': encode_history_cursor(rows[0]['timestamp'], rows[0]['tiebreak']) if rows else before,
+            'after_cursor': encode_history_cursor(rows[-1]['timestamp'], rows[-1]['tiebreak']) if rows else after
         }
-        
-        # Update the session's updated_at timestamp
-        if self.use_mongodb:
-            try:
-                # Insert the message
-                self.chats.insert_one(message)
-                
-                # Update the session's last update time
-                self.chat_sessions.update_one(
-                    {'session_id': session_id},
-                    {'$set': {'updated_at': datetime.now()}}
-                )
-                
-                print(f"Message added to MongoDB session {session_id}: {role}")
-                return True
-            except Exception as e:
-                print(f"Error adding message to MongoDB: {e}")
-                # Fall back to in-memory if MongoDB operation fails
-                self.use_mongodb = False
-                if session_id not in self.sessions:
-                    self.sessions[session_id] = {
-                        'session_id': session_id,
-                        'name': "New Chat",
-                        'created_at': datetime.now(),
-                        'updated_at': datetime.now()
-                    }
-                if session_id not in self.chat_history:
-                    self.chat_history[session_id] = []
-                self.chat_history[session_id].append(message)
-                return True
-        else:
-            # In-memory implementation
-            if session_id not in self.sessions:
-                self.sessions[session_id] = {
-                    'session_id': session_id,
-                    'name': "New Chat",
-                    'created_at': datetime.now(),
-                    'updated_at': datetime.now()
-                }
-            if not hasattr(self, 'chat_history') or not isinstance(self.chat_history, dict):
-                self.chat_history = {}
-            if session_id not in self.chat_history:
-                self.chat_history[session_id] = []
-            
-            self.chat_history[session_id].append(message)
-            self.sessions[session_id]['updated_at'] = datetime.now()
-            
-            print(f"Message added to in-memory storage for session {session_id}: {role}")    
-            return True
-    
-    def get_chat_history(self, session_id=None):
-        """Get chat messages for a specific session or all messages if no session specified"""
-        if self.use_mongodb:
-            try:
-                # MongoDB implementation
-                # Get messages sorted by timestamp
-                query = {'session_id': session_id} if session_id else {}
-                cursor = self.chats.find(query, {'_id': 0, 'session_id': 0}).sort('timestamp', 1)
-                history = list(cursor)
-                # Remove timestamps from the output
-                for msg in history:
-                    if 'timestamp' in msg:
-                        del msg['timestamp']
-                print(f"Retrieved {len(history)} messages from MongoDB" + 
-                      (f" for session {session_id}" if session_id else ""))
-                return history
-            except Exception as e:
-                print(f"Error getting chat history from MongoDB: {e}")
-                # Fall back to in-memory if MongoDB operation fails
-                self.use_mongodb = False
-                return self._get_in_memory_history(session_id)
-        else:
-            return self._get_in_memory_history(session_id)
-    
-    def _get_in_memory_history(self, session_id=None):
-        """Helper method to get history from in-memory storage"""
-        if not hasattr(self, 'chat_history') or not isinstance(self.chat_history, dict):
-            return []
-        
-        # If session_id provided, return just that session's messages
-        if session_id:
-            if session_id not in self.chat_history:
-                return []
-            # Remove timestamps and session_id for consistency with the MongoDB output
-            cleaned_history = []
-            for msg in self.chat_history[session_id]:
-                cleaned_msg = {'role': msg['role'], 'content': msg['content']}
-                cleaned_history.append(cleaned_msg)
-            print(f"Retrieved {len(cleaned_history)} messages from in-memory storage for session {session_id}")
-            return cleaned_history
-        
-        # If no session_id, return all messages
-        all_messages = []
-        for session_messages in self.chat_history.values():
-            for msg in session_messages:
-                cleaned_msg = {'role': msg['role'], 'content': msg['content']}
-                all_messages.append(cleaned_msg)
-        
-        print(f"Retrieved {len(all_messages)} total messages from in-memory storage")
-        return all_messages
-    
+
+    def get_messages_since(self, session_id, since=None):
+        """
+        Get a session's messages newer than a timestamp, oldest first, with timestamps kept
+
+        Args:
+            session_id (str): The session ID
+            since (datetime): Only messages strictly after this time; all messages if None
+        """
+        return self._run("getting recent messages", lambda s: s.since(session_id, since), default=[])
+
+    def search_messages(self, query, session_id=None, limit=20, offset=0):
+        """
+        Full-text search over chat messages, best match first
+
+        Args:
+            query (str): Words to look for; a message matching any of them is a hit
+            session_id (str): Only search this session
+            limit (int): Page size (capped at MAX_SEARCH_PAGE)
+            offset (int): Number of results to skip
+
+        Returns a dict with 'results' (session_id, role, snippet, timestamp, score),
+        'has_more' and 'next_offset'.
+        """
+        limit = max(1, min(int(limit or 20), MAX_SEARCH_PAGE))
+        offset = max(0, int(offset or 0))
+        rows, has_more = self._run(
+            "searching messages",
+            lambda s: s.search(query, session_id, limit, offset),
+            default=([], False)
+        )
+        skipped = len(rows)
+        rows = [row for row in rows if not self._being_cleared(row)]
+        skipped -= len(rows)
+        terms = tokenize(query)
+        results = [
+            {
+                'session_id': row['session_id'],
+                'role': row['role'],
+                'snippet': make_snippet(row['content'], terms),
+                'timestamp': row['timestamp'].isoformat(),
+                'score': round(row['score'], 6)
+            }
+            for row in rows
+        ]
+        next_offset = offset + len(results) + skipped if has_more else None
+        return {'results': results, 'has_more': has_more, 'next_offset': next_offset}
+
+    def export_ndjson(self):
+        """Stream every teacher, session and message from the active backend as NDJSON lines"""
+        return chat_transfer.export_ndjson(self.storage, skip_message=self._being_cleared)
+
+    def import_ndjson(self, lines, batch_size=chat_transfer.IMPORT_BATCH_SIZE, start_line=0, on_checkpoint=None):
+        """
+        Load an NDJSON export into the active backend; see chat_transfer.import_ndjson
+
+        Raises RuntimeError while degraded: memory is reset on fail back, so the import would be lost.
+        """
+        if self.degraded:
+            raise RuntimeError(f"{self.primary.name} is unavailable; try the import again once it is back")
+        try:
+            return chat_transfer.import_ndjson(self.storage, lines, batch_size, start_line, on_checkpoint)
+        finally:
+            self.list_cache.invalidate()
+
+    def get_session_context(self, session_id):
+        """Get the rolling conversation summary stored alongside a session"""
+        empty = {'summary': '', 'summarized_until': None}
+        return self._run("getting session context", lambda s: s.get_context(session_id)) or empty
+
+    def update_session_context(self, session_id, summary, summarized_until):
+        """
+        Store the rolling summary for a session
+
+        Args:
+            session_id (str): The session ID
+            summary (str): Summary of every message up to summarized_until
+            summarized_until (datetime): Timestamp of the newest summarized message
+        """
+        context = {'summary': summary, 'summarized_until': summarized_until}
+        return self._write("updating session context", 'set_context', (session_id, context), default=False) is not False
+
     def clear_history(self, session_id=None):
-        """Clear chat history for a specific session or all if no session specified"""
-        if self.use_mongodb:
+        """
+        Clear chat history for a specific session or all if no session specified
+
+        The sessions disappear right away. Their messages are deleted in the background
+        a chunk at a time; the returned Job reports progress. Returns None when everything
+        was cleared at once (in-memory storage).
+        """
+        storage = self.storage
+        if storage is not self.memory:
+            # Messages written after this are kept, even in a reused session
+            cutoff = datetime.now()
+            # Queue the deletion first, so a full queue (JobQueueFull) leaves everything in place;
+            # the job waits until the sessions are gone
+            sessions_deleted = threading.Event()
+            job = self.deletions.submit('clear-history', self._clear_messages, storage, session_id, cutoff,
+                                        sessions_deleted)
+            with self._clearing_lock:
+                self._clearing[session_id] = max(cutoff, self._clearing.get(session_id, cutoff))
             try:
-                if session_id:
-                    # Delete messages for this session
-                    result = self.chats.delete_many({'session_id': session_id})
-                    # Delete the session itself
-                    self.chat_sessions.delete_one({'session_id': session_id})
-                    print(f"Cleared session {session_id}: {result.deleted_count} messages")
-                else:
-                    # Delete all messages
-                    result = self.chats.delete_many({})
-                    # Delete all sessions
-                    self.chat_sessions.delete_many({})
-                    print(f"Cleared all chat history: {result.deleted_count} messages")
-                return True
+                storage.delete_sessions([session_id] if session_id else None)
             except Exception as e:
-                print(f"Error clearing chat history from MongoDB: {e}")
-                # Fall back to in-memory if MongoDB operation fails
-                self.use_mongodb = False
-                self._clear_in_memory_history(session_id)
-                return True
-        else:
-            return self._clear_in_memory_history(session_id)
-    
-    def _clear_in_memory_history(self, session_id=None):
-        """Helper method to clear history from in-memory storage"""
+                print(f"Error clearing chat sessions in {storage.name}: {e}")
+                self.deletions.cancel(job.job_id)
+                sessions_deleted.set()
+                self._end_clearing(session_id, cutoff)
+                self._degrade("Error clearing chat sessions")
+            else:
+                sessions_deleted.set()
+                self.list_cache.invalidate('sessions')
+                print(f"Clearing {'session ' + session_id if session_id else 'all chat history'} "
+                      f"in the background (job {job.job_id})")
+                return job
+        # Memory clears at once; while degraded the clear is journaled for replay like any other write
+        deleted = self._write("clearing chat history", 'clear', (session_id,), fall_back=True)
+        self.list_cache.invalidate('sessions')
         if session_id:
-            if hasattr(self, 'chat_history') and isinstance(self.chat_history, dict):
-                if session_id in self.chat_history:
-                    del self.chat_history[session_id]
-            if hasattr(self, 'sessions') and session_id in self.sessions:
-                del self.sessions[session_id]
-            print(f"Cleared in-memory chat history for session {session_id}")
+            print(f"Cleared session {session_id}: {deleted} messages")
         else:
-            self.chat_history = {}
-            self.sessions = {}
-            print("Cleared all in-memory chat history")
-        return True
+            print(f"Cleared all chat history: {deleted} messages")
+        return None
+
+    def _clear_messages(self, job, storage, session_id, cutoff, sessions_deleted):
+        job.progress = {'session_id': session_id, 'deleted_messages': 0}
+        try:
+            sessions_deleted.wait()
+            job.check_cancelled()
+            job.progress['deleted_messages'] = self._delete_messages(storage, session_id, cutoff, job)
+        finally:
+            self._end_clearing(session_id, cutoff)
+        print(f"Cleared {job.progress['deleted_messages']} messages" +
+              (f" from session {session_id}" if session_id else ""))
+        return job.progress
+
+    def _end_clearing(self, session_id, cutoff):
+        with self._clearing_lock:
+            # A later clear of the same session may have moved the cutoff on; that one is still running
+            if self._clearing.get(session_id) == cutoff:
+                del self._clearing[session_id]
+
+    def _being_cleared(self, message):
+        """True for a message a running clear_history is about to delete"""
+        with self._clearing_lock:
+            if not self._clearing:
+                return False
+            cutoffs = [self._clearing.get(None), self._clearing.get(message['session_id'])]
+        return any(cutoff is not None and message['timestamp'] < cutoff for cutoff in cutoffs)
+
+    def _delete_messages(self, storage, session_id=None, before=None, job=None):
+        """Delete matching messages CHAT_DELETE_BATCH_SIZE at a time; returns how many were removed"""
+        deleted = 0
+        while True:
+            if job:
+                job.check_cancelled()
+            count = storage.delete_messages(session_id, before, CHAT_DELETE_BATCH_SIZE)
+            deleted += count
+            if job:
+                job.progress['deleted_messages'] = deleted
+            if count == 0:
+                return deleted
+            time.sleep(CHAT_DELETE_PAUSE_SECONDS)
+
+    def _retention_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.sweep_retention()
+            except Exception as e:
+                print(f"Retention sweep failed: {e}")
+
+    def sweep_retention(self):
+        """
+        Delete what is past the retention limits from the primary backend
+
+        Returns a summary dict, or None while the primary is unavailable.
+        """
+        if self.degraded:
+            return None
+        storage = self.primary
+        started = datetime.now()
+        cutoff = started - timedelta(days=self.retention_days) if self.retention_days else None
+        deleted_sessions = deleted_messages = 0
+        if cutoff and not storage.expires_by_ttl:
+            # Only these sessions lose messages, so only their summary fields are recomputed
+            affected = storage.sessions_with_messages_before(cutoff)
+            if affected:
+                deleted_messages += self._delete_messages(storage, before=cutoff)
+                for start in range(0, len(affected), REBUILD_BATCH_SIZE):
+                    storage.rebuild_session_stats(affected[start:start + REBUILD_BATCH_SIZE])
+        while True:
+            session_ids = storage.expired_sessions(
+                None if storage.expires_by_ttl else cutoff, self.retention_max_sessions or None
+            )
+            if not session_ids:
+                break
+            # Messages first, so an interrupted sweep never leaves messages without a session
+            for session_id in session_ids:
+                deleted_messages += self._delete_messages(storage, session_id)
+            deleted_sessions += storage.delete_sessions(session_ids)
+        if deleted_sessions:
+            self.list_cache.invalidate('sessions')
+        self.last_sweep = {
+            'started_at': started.isoformat(),
+            'seconds': round((datetime.now() - started).total_seconds(), 3),
+            'deleted_sessions': deleted_sessions,
+            'deleted_messages': deleted_messages
+        }
+        if deleted_sessions or deleted_messages:
+            print(f"Retention sweep removed {deleted_sessions} sessions and {deleted_messages} messages")
+        return self.last_sweep
 
 # Create a singleton instance
-db = ChatDatabase()
\ No newline at end of file
+db = ChatDatabase()
@@ -0,0 +1,157 @@
+# Background jobs for SAHPAATHI
+# Runs slow work (question papers, PDF rendering) on a bounded in-process worker
+# pool so HTTP requests return immediately with a job id to poll.
+import logging
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+class JobQueueFull(Exception):
+    """Raised when too many jobs are already waiting"""
+
+class JobCancelled(Exception):
+    """Raised by a job function that noticed it was cancelled"""
+
+class Job:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+    def __init__(self, kind):
+        self.job_id = str(uuid.uuid4())
+        self.kind = kind
+        self.status = self.QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        # Optional dict a job function updates as it goes, reported while the job runs
+        self.progress = None
+        self.future = None
+        self._cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def check_cancelled(self):
+        """Job functions call this between steps to stop early once cancelled"""
+        if self.cancelled:
+            raise JobCancelled()
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'error': self.error,
+            'progress': self.progress
+        }
+
+class JobManager:
+    def __init__(self, max_workers=2, max_pending=32, result_ttl=3600):
+        """
+        Args:
+            max_workers (int): Jobs that run at the same time
+            max_pending (int): Queued jobs accepted before submit raises JobQueueFull
+            result_ttl (float): Seconds a finished job and its result are kept
+        """
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, fn, *args, **kwargs):
+        """
+        Queue fn(job, *args, **kwargs) and return the Job right away.
+
+        fn receives the Job so it can call job.check_cancelled() between steps.
+        Its return value becomes job.result.
+        """
+        self.expire()
+        with self._lock:
+            pending = sum(1 for job in self._jobs.values() if job.status == Job.QUEUED)
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"Too many queued jobs ({pending})")
+            job = Job(kind)
+            self._jobs[job.job_id] = job
+        job.future = self._executor.submit(self._run, job, fn, args, kwargs)
+        logger.info(f"Queued {kind} job {job.job_id}")
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        with self._lock:
+            if job.cancelled:
+                return
+            job.status = Job.RUNNING
+            job.started_at = time.time()
+        try:
+            result = fn(job, *args, **kwargs)
+            status, error = Job.SUCCEEDED, None
+        except JobCancelled:
+            result, status, error = None, Job.CANCELLED, None
+        except Exception as e:
+            logger.error(f"Job {job.job_id} failed: {str(e)}\n{traceback.format_exc()}")
+            result, status, error = None, Job.FAILED, str(e)
+        with self._lock:
+            job.result = result
+            job.error = error
+            # A cancel that arrived mid-run wins over the result
+            job.status = Job.CANCELLED if job.cancelled else status
+            job.finished_at = time.time()
+        logger.info(f"{job.kind} job {job.job_id} {job.status}")
+
+    def get(self, job_id):
+        self.expire()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns False if it had already finished"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in Job.FINISHED:
+                return False
+            job._cancel_event.set()
+            if job.status == Job.QUEUED:
+                job.future.cancel()
+                job.status = Job.CANCELLED
+                job.finished_at = time.time()
+        logger.info(f"Cancelled job {job_id}")
+        return True
+
+    def expire(self):
+        """Forget finished jobs older than result_ttl"""
+        cutoff = time.time() - self.result_ttl
+        with self._lock:
+            for job_id in [j.job_id for j in self._jobs.values()
+                           if j.status in Job.FINISHED and j.finished_at < cutoff]:
+                del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {'jobs': counts, 'max_pending': self.max_pending}
+
+# Shared job manager configured from the environment
+job_manager = JobManager(
+    max_workers=int(os.getenv("JOB_WORKERS", "2")),
+    max_pending=int(os.getenv("JOB_MAX_PENDING", "32")),
+    result_ttl=float(os.getenv("JOB_RESULT_TTL_SECONDS", "3600"))
+)
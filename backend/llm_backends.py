@@ -0,0 +1,229 @@
+# LLM backends for SAHPAATHI
+# generate_response talks to a backend chosen by LLM_BACKEND instead of calling
+# google.generativeai directly, so the server can run against a local stub.
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class LLMBackend:
+    """Interface every backend implements"""
+
+    name = "base"
+    model_name = None
+
+    def is_configured(self):
+        """Return True when the backend has what it needs to serve requests"""
+        raise NotImplementedError
+
+    def create_model(self, system_instruction):
+        """Return a model handle bound to a system instruction"""
+        raise NotImplementedError
+
+class LLMModel:
+    """A configured model handle returned by LLMBackend.create_model"""
+
+    def generate(self, prompt, timeout=None):
+        """Return the full response text for a prompt, giving up after timeout seconds"""
+        raise NotImplementedError
+
+    def stream(self, prompt, timeout=None):
+        """Yield response text in chunks as it is produced, giving up after timeout seconds"""
+        raise NotImplementedError
+
+class GeminiModel(LLMModel):
+    def __init__(self, genai_model):
+        self._model = genai_model
+
+    def generate(self, prompt, timeout=None):
+        request_options = {'timeout': timeout} if timeout else None
+        return self._model.generate_content(prompt, request_options=request_options).text
+
+    def stream(self, prompt, timeout=None):
+        request_options = {'timeout': timeout} if timeout else None
+        for chunk in self._model.generate_content(prompt, stream=True, request_options=request_options):
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunks without text parts (e.g. safety metadata) carry nothing to forward
+                continue
+            if text:
+                yield text
+
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+
+    def __init__(self, api_key, model_name="gemini-1.5-flash"):
+        import google.generativeai as genai
+        self._genai = genai
+        self.api_key = api_key
+        self.model_name = model_name
+        genai.configure(api_key=api_key)
+
+    def is_configured(self):
+        return self.api_key is not None
+
+    def create_model(self, system_instruction):
+        return GeminiModel(self._genai.GenerativeModel(self.model_name, system_instruction=system_instruction))
+
+class StubBackendError(RuntimeError):
+    """Failure injected by the stub backend"""
+
+class StubConfig:
+    """Knobs for the stub backend, read from LLM_STUB_* environment variables"""
+
+    def __init__(self, response_chars=600, latency_ms=300.0, latency_dist="fixed",
+                 latency_jitter=0.5, chunk_chars=40, chunk_delay_ms=30.0,
+                 failure_rate=0.0, seed=None):
+        self.response_chars = response_chars
+        self.latency_ms = latency_ms
+        self.latency_dist = latency_dist
+        self.latency_jitter = latency_jitter
+        self.chunk_chars = chunk_chars
+        self.chunk_delay_ms = chunk_delay_ms
+        self.failure_rate = failure_rate
+        self.seed = seed
+
+    @classmethod
+    def from_env(cls):
+        seed = os.getenv("LLM_STUB_SEED")
+        return cls(
+            response_chars=int(os.getenv("LLM_STUB_RESPONSE_CHARS", "600")),
+            latency_ms=float(os.getenv("LLM_STUB_LATENCY_MS", "300")),
+            latency_dist=os.getenv("LLM_STUB_LATENCY_DIST", "fixed"),
+            latency_jitter=float(os.getenv("LLM_STUB_LATENCY_JITTER", "0.5")),
+            chunk_chars=int(os.getenv("LLM_STUB_CHUNK_CHARS", "40")),
+            chunk_delay_ms=float(os.getenv("LLM_STUB_CHUNK_DELAY_MS", "30")),
+            failure_rate=float(os.getenv("LLM_STUB_FAILURE_RATE", "0")),
+            seed=int(seed) if seed else None
+        )
+
+_STUB_WORDS = (
+    "photosynthesis", "equation", "theorem", "history", "chapter", "concept", "energy",
+    "example", "student", "revision", "syllabus", "analysis", "formula", "summary",
+    "definition", "practice", "answer", "question", "method", "result"
+)
+
+class StubModel(LLMModel):
+    """Deterministic model: identical prompts always give identical text"""
+
+    def __init__(self, backend, system_instruction):
+        self._backend = backend
+        self._system_instruction = system_instruction or ''
+
+    def generate(self, prompt, timeout=None):
+        self._backend.sleep_latency(timeout)
+        self._backend.maybe_fail()
+        return self._render(prompt)
+
+    def stream(self, prompt, timeout=None):
+        config = self._backend.config
+        self._backend.sleep_latency(timeout)
+        self._backend.maybe_fail()
+        text = self._render(prompt)
+        for start in range(0, len(text), config.chunk_chars):
+            if start:
+                time.sleep(config.chunk_delay_ms / 1000.0)
+                self._backend.maybe_fail()
+            yield text[start:start + config.chunk_chars]
+
+    def _rng(self, prompt):
+        digest = hashlib.sha256((self._system_instruction + '\x00' + prompt).encode('utf-8')).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    def _render(self, prompt):
+        if re.search(r'multiple-choice quiz|"questions"\s*:|"quiz"\s*:', prompt):
+            return self._render_quiz(prompt)
+        rng = self._rng(prompt)
+        target = self._backend.config.response_chars
+        words = []
+        length = 0
+        while length < target:
+            word = rng.choice(_STUB_WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return ' '.join(words)[:target]
+
+    def _render_quiz(self, prompt):
+        rng = self._rng(prompt)
+        match = re.search(r'with (\d+) questions', prompt)
+        count = int(match.group(1)) if match else 5
+        list_key = "quiz" if '"quiz"' in prompt else "questions"
+        questions = []
+        for i in range(count):
+            topic = rng.choice(_STUB_WORDS)
+            options = [f"{topic} option {letter}" for letter in "ABCD"]
+            questions.append({
+                "question": f"Question {i + 1}: which statement about {topic} is correct?",
+                "options": options,
+                "correct": options[rng.randrange(4)]
+            })
+        return json.dumps({list_key: questions}, indent=2)
+
+class StubBackend(LLMBackend):
+    """Local backend for load testing: configurable size, latency and failures, no network"""
+
+    name = "stub"
+    model_name = "stub"
+
+    def __init__(self, config=None):
+        self.config = config or StubConfig.from_env()
+        # Latency and failure draws are random but reproducible when LLM_STUB_SEED is set
+        self._random = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+
+    def is_configured(self):
+        return True
+
+    def create_model(self, system_instruction):
+        return StubModel(self, system_instruction)
+
+    def sample_latency(self):
+        """Draw one latency in seconds from the configured distribution"""
+        base = self.config.latency_ms
+        jitter = self.config.latency_jitter
+        dist = self.config.latency_dist
+        with self._lock:
+            if dist == "uniform":
+                value = self._random.uniform(base * (1 - jitter), base * (1 + jitter))
+            elif dist == "exponential":
+                value = self._random.expovariate(1.0 / base) if base > 0 else 0.0
+            elif dist == "lognormal":
+                # latency_ms is the median, latency_jitter the sigma of the underlying normal
+                value = self._random.lognormvariate(math.log(base), jitter) if base > 0 else 0.0
+            else:
+                value = base
+        return max(value, 0.0) / 1000.0
+
+    def sleep_latency(self, timeout=None):
+        """Sleep for one sampled latency; like a real client, give up after timeout seconds"""
+        latency = self.sample_latency()
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"Stub request timed out after {timeout:.1f}s")
+        time.sleep(latency)
+
+    def maybe_fail(self):
+        if self.config.failure_rate <= 0:
+            return
+        with self._lock:
+            failed = self._random.random() < self.config.failure_rate
+        if failed:
+            raise StubBackendError("Injected stub backend failure")
+
+def load_backend(name, api_key=None, model_name="gemini-1.5-flash"):
+    """Instantiate the backend selected by name ('gemini' or 'stub')"""
+    name = (name or "gemini").lower()
+    if name == "stub":
+        logger.info("Using stub LLM backend")
+        return StubBackend()
+    if name == "gemini":
+        return GeminiBackend(api_key, model_name=model_name)
+    raise ValueError(f"Unknown LLM backend: {name}")
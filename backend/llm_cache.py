@@ -0,0 +1,162 @@
+# Response cache for SAHPAATHI
+# Keeps recent LLM responses in a bounded LRU map with a per-entry TTL,
+# optionally backed by a SQLite file so cached answers survive restarts.
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+def normalize_prompt(prompt):
+    """Collapse whitespace so trivially different prompts share a cache entry"""
+    return re.sub(r'\s+', ' ', prompt or '').strip()
+
+def make_cache_key(model_name, system_instruction, prompt):
+    """Build a stable key from the model name, system instruction and normalized prompt"""
+    digest = hashlib.sha256()
+    for part in (model_name or '', system_instruction or '', normalize_prompt(prompt)):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+class ResponseCache:
+    def __init__(self, max_entries=512, ttl_seconds=3600, persist_path=None):
+        """
+        Args:
+            max_entries (int): Maximum number of entries kept in memory
+            ttl_seconds (float): How long an entry stays valid after being stored
+            persist_path (str): Optional SQLite file used as a persistent second tier
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if persist_path:
+            self._init_store()
+
+    def _init_store(self):
+        """Create the SQLite table used for persistence"""
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            logger.info(f"Response cache persisted at {self.persist_path}")
+        except Exception as e:
+            logger.error(f"Could not open response cache store, using memory only: {str(e)}")
+            self.persist_path = None
+
+    def _connect(self):
+        return sqlite3.connect(self.persist_path, timeout=5)
+
+    def get(self, key):
+        """Return the cached value for key, or None if it is missing or expired"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at >= now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        value = self._load(key, now)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store_in_memory(key, value[1], value[0])
+            return value[1]
+
+    def set(self, key, value, ttl_seconds=None):
+        """Store a value under key"""
+        expires_at = time.time() + (ttl_seconds if ttl_seconds is not None else self.ttl_seconds)
+        with self._lock:
+            self._store_in_memory(key, value, expires_at)
+        self._save(key, value, expires_at)
+
+    def invalidate(self, key=None):
+        """Remove a single key, or every entry when no key is given"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+        if self.persist_path:
+            try:
+                with self._connect() as conn:
+                    if key is None:
+                        conn.execute("DELETE FROM responses")
+                    else:
+                        conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            except Exception as e:
+                logger.warning(f"Failed to invalidate persisted cache entry: {str(e)}")
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0,
+                'persistent': bool(self.persist_path)
+            }
+
+    def _store_in_memory(self, key, value, expires_at):
+        """Insert into the LRU map; caller must hold the lock"""
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self, key, now):
+        if not self.persist_path:
+            return None
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT expires_at, value FROM responses WHERE key = ? AND expires_at >= ?",
+                    (key, now)
+                ).fetchone()
+            return row
+        except Exception as e:
+            logger.warning(f"Failed to read persisted cache entry: {str(e)}")
+            return None
+
+    def _save(self, key, value, expires_at):
+        if not self.persist_path:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, value, expires_at)
+                )
+        except Exception as e:
+            logger.warning(f"Failed to persist cache entry: {str(e)}")
+
+# Shared cache configured from the environment
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "512")),
+    ttl_seconds=float(os.getenv("LLM_CACHE_TTL_SECONDS", "3600")),
+    persist_path=os.getenv("LLM_CACHE_PATH") or None
+)
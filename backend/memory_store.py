@@ -0,0 +1,438 @@
+# Bounded in-memory chat storage for SAHPAATHI
+# The memory backend, and the fallback when MongoDB fails. Sessions are kept in
+# updated_at order so listing them needs no sort, messages are stored as compact tuples, and cold
+# sessions are evicted once the configured memory cap is reached.
+import itertools
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from storage import ChatStorage, EMPTY_SESSION_STATS, message_preview
+from search_index import InvertedIndex
+
+logger = logging.getLogger(__name__)
+
+MEMORY_MAX_MESSAGES_PER_SESSION = int(os.getenv("MEMORY_MAX_MESSAGES_PER_SESSION", "1000"))
+MEMORY_MAX_BYTES = int(os.getenv("MEMORY_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Rough cost of one stored message beyond its content: tuple, datetime, seq and list slot
+MESSAGE_OVERHEAD_BYTES = 160
+SESSION_OVERHEAD_BYTES = 600
+
+# Message tuple layout
+TIMESTAMP, SEQ, ROLE, CONTENT = range(4)
+
+class _SessionEntry:
+    __slots__ = ('session', 'messages', 'bytes', 'context', 'import_ids')
+
+    def __init__(self, session):
+        self.session = dict(EMPTY_SESSION_STATS, **session)
+        self.messages = []  # (timestamp, seq, role, content), oldest first
+        self.bytes = SESSION_OVERHEAD_BYTES
+        self.context = None
+        self.import_ids = None  # set of import_ids, once anything is imported
+
+def _message_bytes(content):
+    # The content, plus roughly as much again for its search index postings
+    return 2 * sys.getsizeof(content) + MESSAGE_OVERHEAD_BYTES
+
+class InMemoryChatStore(ChatStorage):
+    name = 'memory'
+
+    def __init__(self, max_messages_per_session=MEMORY_MAX_MESSAGES_PER_SESSION, max_bytes=MEMORY_MAX_BYTES):
+        """
+        Args:
+            max_messages_per_session (int): Oldest messages are dropped past this many
+            max_bytes (int): Approximate memory cap; least recently used sessions are evicted above it
+        """
+        self.max_messages_per_session = max_messages_per_session
+        self.max_bytes = max_bytes
+        # Ordered by updated_at, oldest first; updating a session moves it to the end
+        self._sessions = OrderedDict()
+        # Ordered by last access (read or write), coldest first
+        self._lru = OrderedDict()
+        self._bytes = 0
+        self._seq = itertools.count()
+        self._teachers = {}
+        # Full-text index over every stored message, keyed by seq
+        self._index = InvertedIndex()
+        self._docs = {}  # seq -> (session_id, message tuple)
+        self._lock = threading.RLock()
+        self.evicted_sessions = 0
+        self.trimmed_messages = 0
+
+    def _touch(self, session_id, updated=False):
+        self._lru[session_id] = None
+        self._lru.move_to_end(session_id)
+        if updated:
+            self._sessions[session_id].session['updated_at'] = datetime.now()
+            self._sessions.move_to_end(session_id)
+
+    def _evict(self, keep=None):
+        """Drop the coldest sessions until the store is back under max_bytes"""
+        while self._bytes > self.max_bytes and len(self._lru) > 1:
+            session_id = next(iter(self._lru))
+            if session_id == keep:
+                # The active session is never evicted; move past it
+                self._lru.move_to_end(session_id)
+                session_id = next(iter(self._lru))
+            self._remove(session_id)
+            self.evicted_sessions += 1
+            logger.info(f"Evicted in-memory session {session_id} (memory cap {self.max_bytes} bytes)")
+
+    def _remove(self, session_id):
+        entry = self._sessions.pop(session_id, None)
+        self._lru.pop(session_id, None)
+        if entry:
+            self._bytes -= entry.bytes
+            self._unindex(entry.messages)
+        return entry
+
+    def _unindex(self, messages):
+        for msg in messages:
+            self._index.remove(msg[SEQ], msg[CONTENT])
+            self._docs.pop(msg[SEQ], None)
+
+    def _entry(self, session_id, create=False):
+        entry = self._sessions.get(session_id)
+        if entry is None and create:
+            now = datetime.now()
+            entry = _SessionEntry({'session_id': session_id, 'name': "New Chat", 'created_at': now, 'updated_at': now})
+            self._sessions[session_id] = entry
+            self._bytes += entry.bytes
+        return entry
+
+    def create_session(self, session):
+        with self._lock:
+            entry = _SessionEntry(dict(session))
+            self._remove(session['session_id'])
+            self._sessions[session['session_id']] = entry
+            self._bytes += entry.bytes
+            self._touch(session['session_id'])
+            self._evict(keep=session['session_id'])
+
+    def get_sessions(self):
+        """All sessions, most recently updated first"""
+        with self._lock:
+            return [dict(entry.session) for entry in reversed(self._sessions.values())]
+
+    def rename_session(self, session_id, name):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return False
+            entry.session['name'] = name
+            self._touch(session_id, updated=True)
+            return True
+
+    def _append(self, entry, session_id, role, content, timestamp, summarize=True):
+        """Store a message in entry, indexing it and trimming the session to its cap"""
+        msg = (timestamp, next(self._seq), role, content)
+        entry.messages.append(msg)
+        self._index.add(msg[SEQ], session_id, content)
+        self._docs[msg[SEQ]] = (session_id, msg)
+        size = _message_bytes(content)
+        entry.bytes += size
+        self._bytes += size
+        if summarize:
+            entry.session['message_count'] += 1
+            entry.session['total_chars'] += len(content)
+            entry.session['last_role'] = role
+            entry.session['last_message_preview'] = message_preview(content)
+        excess = len(entry.messages) - self.max_messages_per_session
+        if excess > 0:
+            self._drop_oldest(entry, excess)
+            self.trimmed_messages += excess
+
+    def _drop_oldest(self, entry, count):
+        """Remove a session's oldest count messages, keeping its summary fields in step"""
+        dropped = entry.messages[:count]
+        freed = sum(_message_bytes(msg[CONTENT]) for msg in dropped)
+        self._unindex(dropped)
+        del entry.messages[:count]
+        entry.bytes -= freed
+        self._bytes -= freed
+        entry.session['message_count'] -= len(dropped)
+        entry.session['total_chars'] -= sum(len(msg[CONTENT]) for msg in dropped)
+        if not entry.messages:
+            entry.session.update(last_role=None, last_message_preview=None)
+
+    def add_message(self, session_id, role, content, timestamp):
+        with self._lock:
+            self._append(self._entry(session_id, create=True), session_id, role, content, timestamp)
+            self._touch(session_id, updated=True)
+            self._evict(keep=session_id)
+
+    @staticmethod
+    def _message(msg):
+        return {'role': msg[ROLE], 'content': msg[CONTENT], 'timestamp': msg[TIMESTAMP]}
+
+    def history(self, session_id=None, limit=None):
+        with self._lock:
+            if session_id:
+                entry = self._sessions.get(session_id)
+                if entry is None:
+                    return []
+                self._touch(session_id)
+                messages = entry.messages[-limit:] if limit else list(entry.messages)
+                return [self._message(msg) for msg in messages]
+            messages = [msg for entry in self._sessions.values() for msg in entry.messages]
+        messages.sort(key=lambda msg: (msg[TIMESTAMP], msg[SEQ]))
+        if limit:
+            messages = messages[-limit:]
+        return [self._message(msg) for msg in messages]
+
+    def since(self, session_id, since=None):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return []
+            self._touch(session_id)
+            return [self._message(msg) for msg in entry.messages if since is None or msg[TIMESTAMP] > since]
+
+    def page(self, session_id, limit, cursor_value=None, newer=False):
+        """
+        One keyset page, oldest first. cursor_value is (timestamp, seq) or None.
+
+        Returns (rows, has_more) like the other ChatStorage backends.
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            messages = entry.messages if entry else []
+            if entry:
+                self._touch(session_id)
+            if cursor_value:
+                key = (cursor_value[0], int(cursor_value[1]))
+                # Messages are appended in time order, so binary search the keyset position
+                lo, hi = 0, len(messages)
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if (messages[mid][TIMESTAMP], messages[mid][SEQ]) <= key:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                # lo is the first message strictly newer than the cursor
+                if newer:
+                    start, end = lo, lo + limit
+                else:
+                    end = lo - 1 if lo > 0 and (messages[lo - 1][TIMESTAMP], messages[lo - 1][SEQ]) == key else lo
+                    start = max(0, end - limit)
+            elif newer:
+                start, end = 0, limit
+            else:
+                start, end = max(0, len(messages) - limit), len(messages)
+            has_more = end < len(messages) if newer else start > 0
+            rows = [
+                {'role': msg[ROLE], 'content': msg[CONTENT], 'timestamp': msg[TIMESTAMP], 'tiebreak': msg[SEQ]}
+                for msg in messages[start:end]
+            ]
+        return rows, has_more
+
+    def search(self, query, session_id=None, limit=20, offset=0):
+        with self._lock:
+            ranked = self._index.search(query, session_id)[offset:offset + limit + 1]
+            rows = []
+            for score, seq in ranked:
+                doc_session, msg = self._docs[seq]
+                rows.append({'session_id': doc_session, 'role': msg[ROLE], 'content': msg[CONTENT],
+                             'timestamp': msg[TIMESTAMP], 'score': score})
+        return rows[:limit], len(rows) > limit
+
+    def get_context(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            return entry.context if entry else None
+
+    def set_context(self, session_id, context):
+        with self._lock:
+            entry = self._entry(session_id, create=True)
+            entry.context = context
+            self._touch(session_id)
+
+    def clear(self, session_id=None):
+        with self._lock:
+            if session_id:
+                entry = self._remove(session_id)
+                return len(entry.messages) if entry else 0
+            removed = sum(len(entry.messages) for entry in self._sessions.values())
+            self._sessions.clear()
+            self._lru.clear()
+            self._bytes = 0
+            self._index.clear()
+            self._docs.clear()
+            return removed
+
+    def rebuild_session_stats(self, session_ids=None):
+        with self._lock:
+            if session_ids is None:
+                entries = list(self._sessions.values())
+            else:
+                entries = [self._sessions[session_id] for session_id in session_ids if session_id in self._sessions]
+            for entry in entries:
+                last = entry.messages[-1] if entry.messages else None
+                entry.session.update(
+                    message_count=len(entry.messages),
+                    total_chars=sum(len(msg[CONTENT]) for msg in entry.messages),
+                    last_role=last[ROLE] if last else None,
+                    last_message_preview=message_preview(last[CONTENT]) if last else None
+                )
+            return len(entries)
+
+    # Export / import
+
+    def export_sessions(self):
+        with self._lock:
+            entries = list(self._sessions.values())
+        for entry in entries:
+            session = dict(entry.session)
+            if entry.context:
+                session['context'] = dict(entry.context)
+            yield session
+
+    def export_messages(self):
+        with self._lock:
+            session_ids = sorted(self._sessions)
+        for session_id in session_ids:
+            # Copy one session at a time so the lock is never held while the consumer writes
+            with self._lock:
+                entry = self._sessions.get(session_id)
+                messages = list(entry.messages) if entry else []
+            for msg in messages:
+                yield dict(self._message(msg), session_id=session_id)
+
+    def export_teachers(self):
+        return iter(self.get_teachers())
+
+    def import_sessions(self, sessions):
+        with self._lock:
+            for session in sessions:
+                session = dict(session)
+                context = session.pop('context', None)
+                entry = self._sessions.get(session['session_id'])
+                if entry is None:
+                    self.create_session(session)
+                    entry = self._sessions[session['session_id']]
+                else:
+                    # Replacing the record keeps the session's messages, as in the other backends
+                    entry.session = dict(EMPTY_SESSION_STATS, **session)
+                    self._touch(session['session_id'])
+                entry.context = context
+
+    def import_messages(self, messages):
+        with self._lock:
+            for m in messages:
+                entry = self._entry(m['session_id'], create=True)
+                import_id = m.get('import_id')
+                if import_id:
+                    if entry.import_ids is None:
+                        entry.import_ids = set()
+                    elif import_id in entry.import_ids:
+                        continue
+                    entry.import_ids.add(import_id)
+                # The imported session records already carry their summary fields
+                self._append(entry, m['session_id'], m['role'], m['content'], m['timestamp'], summarize=False)
+                self._touch(m['session_id'])
+                self._evict(keep=m['session_id'])
+
+    def import_teachers(self, teachers):
+        for teacher in teachers:
+            self.create_teacher(teacher)
+
+    # Retention and chunked deletion
+
+    def expired_sessions(self, cutoff=None, keep_newest=None, limit=100):
+        with self._lock:
+            # _sessions is in order of use, which imports change without changing updated_at
+            entries = sorted(self._sessions.items(), key=lambda item: item[1].session['updated_at'])
+        beyond = len(entries) - keep_newest if keep_newest else 0
+        ids = [
+            session_id for index, (session_id, entry) in enumerate(entries)
+            if index < beyond or (cutoff is not None and entry.session['updated_at'] < cutoff)
+        ]
+        return ids[:limit]
+
+    def delete_sessions(self, session_ids=None):
+        # Messages live inside their session's entry, so they go with it
+        with self._lock:
+            if session_ids is None:
+                removed = len(self._sessions)
+                self.clear()
+                return removed
+            return sum(1 for session_id in session_ids if self._remove(session_id))
+
+    def sessions_with_messages_before(self, before):
+        with self._lock:
+            # Messages are oldest first
+            return [session_id for session_id, entry in self._sessions.items()
+                    if entry.messages and entry.messages[0][TIMESTAMP] < before]
+
+    def delete_messages(self, session_id=None, before=None, limit=1000):
+        with self._lock:
+            if session_id:
+                entries = [self._sessions[session_id]] if session_id in self._sessions else []
+            else:
+                entries = list(self._sessions.values())
+            removed = 0
+            for entry in entries:
+                # Messages are oldest first, so the expired ones are a prefix
+                count = 0
+                while count < len(entry.messages) and removed + count < limit and \
+                        (before is None or entry.messages[count][TIMESTAMP] < before):
+                    count += 1
+                if count:
+                    self._drop_oldest(entry, count)
+                    removed += count
+                if removed >= limit:
+                    break
+            return removed
+
+    def reset(self):
+        """Drop everything, teachers included"""
+        with self._lock:
+            self.clear()
+            self._teachers.clear()
+
+    # Teachers are few and small, so they are kept outside the memory cap
+
+    def count_teachers(self):
+        return len(self._teachers)
+
+    def create_teacher(self, teacher):
+        self._teachers[teacher['teacher_id']] = dict(teacher)
+
+    def get_teacher(self, teacher_id):
+        teacher = self._teachers.get(teacher_id)
+        return dict(teacher) if teacher else None
+
+    def get_teachers(self):
+        return sorted((dict(t) for t in self._teachers.values()), key=lambda t: t['name'])
+
+    def update_teacher_prompt(self, teacher_id, prompt, updated_at):
+        teacher = self._teachers.get(teacher_id)
+        if teacher is None:
+            return False
+        teacher['prompt'] = prompt
+        teacher['updated_at'] = updated_at
+        return True
+
+    def delete_teacher(self, teacher_id):
+        teacher = self._teachers.get(teacher_id)
+        if teacher is None or not teacher['is_custom']:
+            return False
+        del self._teachers[teacher_id]
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'messages': sum(len(entry.messages) for entry in self._sessions.values()),
+                'approx_bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'max_messages_per_session': self.max_messages_per_session,
+                'evicted_sessions': self.evicted_sessions,
+                'trimmed_messages': self.trimmed_messages,
+                'search_index': self._index.stats()
+            }
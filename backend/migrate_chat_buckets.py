@@ -0,0 +1,75 @@
+# Migrate chat messages from one-document-per-message (chats) to bucketed storage (chat_buckets)
+# Streams chats in session order, so memory use is bounded by one session's messages.
+# The last fully migrated session is checkpointed; re-running resumes after it.
+import argparse
+import pymongo
+from pymongo import ReplaceOne
+from bucket_store import BucketedMessageStore
+
+MIGRATION_ID = 'chat_buckets'
+
+def migrate(db, bucket_size=100, batch_size=1000, restart=False):
+    """
+    Copy every chats document into chat_buckets.
+
+    Buckets are written with ReplaceOne upserts keyed on the first message's _id, so
+    re-running over an already migrated session rewrites identical buckets.
+    Returns (sessions, messages) migrated by this run.
+    """
+    store = BucketedMessageStore(db['chat_buckets'], bucket_size=bucket_size)
+    store.ensure_indexes()
+    migrations = db['migrations']
+    if restart:
+        migrations.delete_one({'_id': MIGRATION_ID})
+    checkpoint = migrations.find_one({'_id': MIGRATION_ID}) or {}
+    last_session = checkpoint.get('last_session_id')
+
+    query = {'session_id': {'$gt': last_session}} if last_session else {}
+    cursor = db['chats'].find(query).sort(
+        [('session_id', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+    ).batch_size(batch_size)
+
+    sessions = 0
+    messages = 0
+
+    def write_session(session_id, session_messages):
+        buckets = store.build_buckets(session_id, session_messages)
+        store.buckets.bulk_write([ReplaceOne({'_id': b['_id']}, b, upsert=True) for b in buckets], ordered=False)
+        migrations.update_one(
+            {'_id': MIGRATION_ID},
+            {'$set': {'last_session_id': session_id, 'bucket_size': bucket_size}},
+            upsert=True
+        )
+
+    current_session = None
+    pending = []
+    for doc in cursor:
+        if doc.get('session_id') is None:
+            continue
+        if doc['session_id'] != current_session:
+            if pending:
+                write_session(current_session, pending)
+                sessions += 1
+                messages += len(pending)
+            current_session = doc['session_id']
+            pending = []
+        pending.append(doc)
+    if pending:
+        write_session(current_session, pending)
+        sessions += 1
+        messages += len(pending)
+    return sessions, messages
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate SAHPAATHI chat messages to bucketed storage')
+    parser.add_argument('--mongo-uri', type=str, default='mongodb://localhost:27017/', help='MongoDB connection string')
+    parser.add_argument('--database', type=str, default='sahpaathi', help='Database name')
+    parser.add_argument('--bucket-size', type=int, default=100, help='Messages per bucket (match CHAT_BUCKET_SIZE)')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Documents fetched per round trip')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and migrate every session again')
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(args.mongo_uri, serverSelectionTimeoutMS=5000)
+    sessions, messages = migrate(client[args.database], args.bucket_size, args.batch_size, args.restart)
+    print(f"Migrated {messages} messages in {sessions} sessions to chat_buckets")
+    print("Set CHAT_STORAGE_LAYOUT=bucketed to serve chat history from the buckets")
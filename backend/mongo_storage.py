@@ -0,0 +1,568 @@
+# MongoDB storage backend for SAHPAATHI
+import atexit
+import logging
+import os
+from datetime import datetime
+import pymongo
+import pymongo.errors
+from bson import ObjectId
+from pymongo import ReplaceOne, UpdateOne
+from storage import ChatStorage, EMPTY_SESSION_STATS, message_preview
+from search_index import tokenize
+from write_buffer import DUPLICATE_KEY, MessageWriteBuffer, session_update
+from bucket_store import BucketedMessageStore
+
+logger = logging.getLogger(__name__)
+
+MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017/")
+MONGODB_DATABASE = os.getenv("MONGODB_DATABASE", "sahpaathi")
+
+# "sync" writes each message before add_message returns; "batched" queues it for a write-behind flush
+DB_DURABILITY = os.getenv("DB_DURABILITY", "sync").lower()
+
+# "document" stores one chats document per message; "bucketed" packs messages into chat_buckets
+CHAT_STORAGE_LAYOUT = os.getenv("CHAT_STORAGE_LAYOUT", "document").lower()
+CHAT_BUCKET_SIZE = int(os.getenv("CHAT_BUCKET_SIZE", "100"))
+
+# Connection pool settings passed straight to MongoClient
+MONGODB_CLIENT_OPTIONS = {
+    'maxPoolSize': int(os.getenv("MONGODB_MAX_POOL_SIZE", "100")),
+    'minPoolSize': int(os.getenv("MONGODB_MIN_POOL_SIZE", "0")),
+    'maxIdleTimeMS': int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", "60000")),
+    'serverSelectionTimeoutMS': int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "2000")),
+    'connectTimeoutMS': int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "2000")),
+}
+
+# Documents fetched per round trip when streaming an export
+EXPORT_BATCH_SIZE = 1000
+
+# Session fields the sidebar list leaves out: the summary, and the write buffer's retry bookkeeping
+SESSION_LIST_PROJECTION = {'_id': 0, 'context': 0, 'applied_bumps': 0}
+
+class MongoChatStorage(ChatStorage):
+    name = 'mongodb'
+    lazy = True
+
+    # Indexes each collection needs for the queries below: (keys, options)
+    INDEXES = {
+        'chats': [
+            # history / page / since: filter by session, sort by (timestamp, _id) straight off the index
+            ([('session_id', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+             {'name': 'session_id_timestamp_id'}),
+            # Capped unscoped history reads the newest messages off the end of this index
+            ([('timestamp', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], {'name': 'timestamp_id'}),
+            # search: ranked full-text match (no prefix field, which would force a session filter)
+            ([('content', pymongo.TEXT)], {'name': 'content_text'}),
+        ],
+        'chat_sessions': [
+            # rename_session / add_message / get_context look sessions up by id
+            ([('session_id', pymongo.ASCENDING)], {'name': 'session_id_unique', 'unique': True}),
+            # get_sessions: newest first
+            ([('updated_at', pymongo.DESCENDING)], {'name': 'updated_at_desc'}),
+        ],
+        'teachers': [
+            ([('teacher_id', pymongo.ASCENDING)], {'name': 'teacher_id_unique', 'unique': True}),
+            # get_teachers sorts by name
+            ([('name', pymongo.ASCENDING)], {'name': 'name'}),
+        ],
+    }
+
+    # Replaced by the indexes above; dropped on startup so they stop costing writes
+    OBSOLETE_INDEXES = {'chats': ['session_id_timestamp']}
+
+    # Indexes that become TTL indexes when a retention age is set: the server then deletes expired
+    # documents itself. Bucketed chats expire a whole bucket once its newest message is too old.
+    TTL_INDEXES = {'chat_sessions': 'updated_at_desc'}
+    # TTL indexes must be single-field, so chats get their own, only while retention is on
+    CHATS_TTL_INDEX = ([('timestamp', pymongo.ASCENDING)], {'name': 'timestamp'})
+    BUCKET_TTL_INDEX = ([('last_ts', pymongo.ASCENDING)], {'name': 'last_ts_ttl'})
+
+    def __init__(self, uri=MONGODB_URI, database=MONGODB_DATABASE, durability=DB_DURABILITY,
+                 layout=CHAT_STORAGE_LAYOUT, retention_seconds=0, bucket_size=CHAT_BUCKET_SIZE):
+        """
+        Set up the client; nothing talks to the server until ping() or the first query.
+
+        With retention_seconds, messages and sessions older than that are expired by TTL indexes.
+        """
+        self.durability = durability
+        self.retention_seconds = int(retention_seconds)
+        self.expires_by_ttl = self.retention_seconds > 0
+        self.storage_layout = layout
+        self._write_buffer = None
+        self.bucket_store = None
+        self._indexes_ensured = False
+        # MongoClient connects in the background, so this never blocks
+        self.client = pymongo.MongoClient(uri, **MONGODB_CLIENT_OPTIONS)
+        self.db = self.client[database]
+        self.chats = self.db["chats"]
+        self.chat_sessions = self.db["chat_sessions"]
+        self.teachers = self.db["teachers"]
+        if self.storage_layout == 'bucketed':
+            self.bucket_store = BucketedMessageStore(self.db["chat_buckets"], bucket_size=bucket_size)
+            logger.info(f"Using bucketed message storage ({bucket_size} messages per bucket)")
+        if self.durability == 'batched':
+            self._write_buffer = MessageWriteBuffer(
+                self.chats,
+                self.chat_sessions,
+                max_batch=int(os.getenv("DB_WRITE_BATCH_SIZE", "100")),
+                flush_interval=float(os.getenv("DB_WRITE_FLUSH_SECONDS", "0.5")),
+                message_store=self.bucket_store
+            )
+            # Nothing queued is lost on a clean shutdown
+            atexit.register(self._write_buffer.close)
+            logger.info("Using batched (write-behind) message persistence")
+
+    def ensure_indexes(self):
+        """Create the declared indexes; safe to run on every startup."""
+        ok = True
+        for collection_name, indexes in self.INDEXES.items():
+            collection = self.db[collection_name]
+            for keys, options in indexes:
+                if options['name'] == self.TTL_INDEXES.get(collection_name) and self.retention_seconds:
+                    options = dict(options, expireAfterSeconds=self.retention_seconds)
+                try:
+                    self._create_index(collection, keys, options)
+                except Exception as e:
+                    ok = False
+                    logger.error(f"Error creating index {options.get('name')} on {collection_name}: {e}")
+        try:
+            for collection_name, names in self.OBSOLETE_INDEXES.items():
+                collection = self.db[collection_name]
+                for name in names:
+                    if name in collection.index_information():
+                        collection.drop_index(name)
+                        logger.info(f"Dropped obsolete index {name} on {collection_name}")
+            self._ensure_ttl_index(self.chats, self.CHATS_TTL_INDEX)
+        except Exception as e:
+            ok = False
+            logger.error(f"Error updating chats indexes: {e}")
+        if self.bucket_store:
+            try:
+                self.bucket_store.ensure_indexes()
+                self._ensure_ttl_index(self.bucket_store.buckets, self.BUCKET_TTL_INDEX)
+            except Exception as e:
+                ok = False
+                logger.error(f"Error creating chat_buckets indexes: {e}")
+        if ok:
+            logger.info("MongoDB indexes ensured")
+        return ok
+
+    def _ensure_ttl_index(self, collection, index):
+        """Create a TTL index while retention is on, and drop it once retention is turned off"""
+        keys, options = index
+        if self.retention_seconds:
+            self._create_index(collection, keys, dict(options, expireAfterSeconds=self.retention_seconds))
+        elif options['name'] in collection.index_information():
+            collection.drop_index(options['name'])
+
+    def _create_index(self, collection, keys, options):
+        try:
+            # create_index is a no-op when an identical index already exists
+            collection.create_index(keys, **options)
+        except pymongo.errors.OperationFailure as e:
+            # 85/86: the index exists with other options, i.e. the retention setting changed
+            if e.code not in (85, 86):
+                raise
+            if 'expireAfterSeconds' in options:
+                # Changing a TTL in place avoids rebuilding the index
+                self.db.command('collMod', collection.name, index={
+                    'name': options['name'], 'expireAfterSeconds': options['expireAfterSeconds']
+                })
+            else:
+                collection.drop_index(options['name'])
+                collection.create_index(keys, **options)
+            logger.info(f"Updated the expiry of index {options['name']} on {collection.name}")
+
+    def explain_hot_queries(self, session_id="explain-probe"):
+        """
+        Run explain on the queries history(), page() and since() issue, plus the session lookups,
+        and report which ones fall back to a COLLSCAN or sort in memory (a SORT stage).
+
+        Returns a dict keyed by the ChatDatabase method the query belongs to.
+        """
+        # A cursor as page() would get it from an earlier page
+        probe_cursor = (datetime.now(), str(ObjectId()))
+        if self.bucket_store:
+            chat_queries = self.bucket_store.hot_queries(session_id, probe_cursor[0])
+        else:
+            chat_queries = {
+                'get_chat_history': self._history_cursor(session_id),
+                'get_recent_history': self._history_cursor(session_id, 50),
+                'get_all_history': self._history_cursor(None, 50),
+                'get_messages_page': self._page_cursor(session_id, 50),
+                'get_older_messages_page': self._page_cursor(session_id, 50, probe_cursor),
+                'get_newer_messages_page': self._page_cursor(session_id, 50, probe_cursor, newer=True),
+                'get_messages_since': self._since_cursor(session_id, probe_cursor[0]),
+            }
+        hot_queries = dict(chat_queries, **{
+            'get_all_sessions': self.chat_sessions.find({}, SESSION_LIST_PROJECTION).sort('updated_at', -1),
+            'update_session_name': self.chat_sessions.find({'session_id': session_id}).limit(1),
+            # add_message's insert has no plan; its session bump is an update by session_id
+            'add_message': self.chat_sessions.find({'session_id': session_id}).limit(1),
+        })
+        report = {}
+        for name, cursor in hot_queries.items():
+            try:
+                plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+                stages = self._plan_stages(plan)
+                report[name] = {'stages': stages, 'collscan': 'COLLSCAN' in stages,
+                                'in_memory_sort': 'SORT' in stages}
+                if 'COLLSCAN' in stages:
+                    logger.warning(f"{name} query uses a COLLSCAN")
+                if 'SORT' in stages:
+                    logger.warning(f"{name} query sorts in memory")
+            except Exception as e:
+                report[name] = {'error': str(e)}
+        return report
+
+    @staticmethod
+    def _plan_stages(plan):
+        """Flatten a winning plan into its list of stage names"""
+        stages = []
+        pending = [plan]
+        while pending:
+            node = pending.pop()
+            if not isinstance(node, dict):
+                continue
+            if 'stage' in node:
+                stages.append(node['stage'])
+            # Newer servers wrap the classic plan in queryPlan; children live under inputStage(s)
+            for key in ('queryPlan', 'inputStage'):
+                if key in node:
+                    pending.append(node[key])
+            pending.extend(node.get('inputStages', []))
+        return stages
+
+    def ping(self):
+        self.client.admin.command('ping')
+        if not self._indexes_ensured:
+            logger.info("MongoDB connection successful")
+            # Indexes wait for the first successful ping so startup never blocks on the server
+            self._indexes_ensured = self.ensure_indexes()
+        return True
+
+    def _flush_pending(self, session_id=None):
+        """Write out buffered messages before a read that needs to see them"""
+        if self._write_buffer and self._write_buffer.has_pending(session_id):
+            self._write_buffer.flush()
+
+    def flush(self):
+        if self._write_buffer:
+            return self._write_buffer.flush()
+        return True
+
+    def stats(self):
+        return {
+            'durability': self.durability,
+            'layout': self.storage_layout,
+            'write_buffer': self._write_buffer.stats() if self._write_buffer else None
+        }
+
+    def close(self):
+        if self._write_buffer:
+            self._write_buffer.close()
+        self.client.close()
+
+    # Sessions
+
+    def create_session(self, session):
+        self.chat_sessions.insert_one(dict(EMPTY_SESSION_STATS, **session))
+
+    def get_sessions(self):
+        # Pending session bumps change the sort order
+        self._flush_pending()
+        return list(self.chat_sessions.find({}, SESSION_LIST_PROJECTION).sort('updated_at', -1))
+
+    def rename_session(self, session_id, name):
+        result = self.chat_sessions.update_one(
+            {'session_id': session_id},
+            {'$set': {'name': name, 'updated_at': datetime.now()}}
+        )
+        return result.matched_count > 0
+
+    def get_context(self, session_id):
+        session = self.chat_sessions.find_one({'session_id': session_id}, {'context': 1})
+        return (session or {}).get('context')
+
+    def set_context(self, session_id, context):
+        self.chat_sessions.update_one({'session_id': session_id}, {'$set': {'context': context}})
+
+    # Messages
+
+    def add_message(self, session_id, role, content, timestamp):
+        message = {'session_id': session_id, 'role': role, 'content': content, 'timestamp': timestamp}
+        if self._write_buffer:
+            # Batched durability: the insert and session update are written by the next flush
+            self._write_buffer.add(message)
+            return
+        if self.bucket_store:
+            self.bucket_store.append(message)
+        else:
+            self.chats.insert_one(message)
+        # Bump the session's last update time and summary in one atomic update
+        self.chat_sessions.update_one({'session_id': session_id}, session_update(timestamp, 1, len(content), message))
+
+    def history(self, session_id=None, limit=None):
+        self._flush_pending(session_id)
+        if self.bucket_store:
+            return [
+                {'role': row['role'], 'content': row['content'], 'timestamp': row['timestamp']}
+                for row in self.bucket_store.history(session_id, limit)
+            ]
+        cursor = self._history_cursor(session_id, limit)
+        # A limited read comes back newest first so the limit keeps the latest messages; flip it back
+        return list(cursor)[::-1] if limit else list(cursor)
+
+    def page(self, session_id, limit, cursor_value=None, newer=False):
+        self._flush_pending(session_id)
+        if self.bucket_store:
+            return self.bucket_store.page(session_id, limit, cursor_value, newer)
+        cursor = self._page_cursor(session_id, limit, cursor_value, newer)
+        rows = [
+            {'role': doc['role'], 'content': doc['content'], 'timestamp': doc['timestamp'], 'tiebreak': str(doc['_id'])}
+            for doc in cursor
+        ]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if not newer:
+            rows.reverse()
+        return rows, has_more
+
+    def since(self, session_id, since=None):
+        self._flush_pending(session_id)
+        if self.bucket_store:
+            return [
+                {'role': row['role'], 'content': row['content'], 'timestamp': row['timestamp']}
+                for row in self.bucket_store.since(session_id, since)
+            ]
+        return list(self._since_cursor(session_id, since))
+
+    # Cursors for the document layout, shared with explain_hot_queries so it explains exactly these
+
+    def _history_cursor(self, session_id=None, limit=None):
+        query = {'session_id': session_id} if session_id else {}
+        projection = {'_id': 0, 'role': 1, 'content': 1, 'timestamp': 1}
+        if limit:
+            # _id breaks ties, since Mongo stores timestamps at millisecond precision
+            return self.chats.find(query, projection).sort([('timestamp', -1), ('_id', -1)]).limit(limit)
+        return self.chats.find(query, projection).sort([('timestamp', 1), ('_id', 1)])
+
+    def _page_cursor(self, session_id, limit, cursor_value=None, newer=False):
+        query = {'session_id': session_id}
+        direction = pymongo.ASCENDING if newer else pymongo.DESCENDING
+        if cursor_value:
+            timestamp, tiebreak = cursor_value
+            op = '$gt' if newer else '$lt'
+            # The range gives the index scan a bound; the $or then drops the cursor row and its earlier ties
+            query['timestamp'] = {'$gte' if newer else '$lte': timestamp}
+            query['$or'] = [
+                {'timestamp': {op: timestamp}},
+                {'timestamp': timestamp, '_id': {op: ObjectId(tiebreak)}}
+            ]
+        return self.chats.find(query, {'role': 1, 'content': 1, 'timestamp': 1}) \
+            .sort([('timestamp', direction), ('_id', direction)]).limit(limit + 1)
+
+    def _since_cursor(self, session_id, since=None):
+        query = {'session_id': session_id}
+        if since is not None:
+            query['timestamp'] = {'$gt': since}
+        return self.chats.find(query, {'_id': 0, 'role': 1, 'content': 1, 'timestamp': 1}) \
+            .sort([('timestamp', 1), ('_id', 1)])
+
+    def search(self, query, session_id=None, limit=20, offset=0):
+        self._flush_pending(session_id)
+        if not tokenize(query):
+            return [], False
+        if self.bucket_store:
+            return self.bucket_store.search(query, session_id, limit, offset)
+        criteria = {'$text': {'$search': query}}
+        if session_id:
+            criteria['session_id'] = session_id
+        cursor = self.chats.find(
+            criteria,
+            {'_id': 0, 'session_id': 1, 'role': 1, 'content': 1, 'timestamp': 1, 'score': {'$meta': 'textScore'}}
+        ).sort([('score', {'$meta': 'textScore'})]).skip(offset).limit(limit + 1)
+        rows = list(cursor)
+        return rows[:limit], len(rows) > limit
+
+    def clear(self, session_id=None):
+        # Buffered messages must land before the delete, or they would reappear after it
+        self.flush()
+        query = {'session_id': session_id} if session_id else {}
+        deleted = self.chats.delete_many(query).deleted_count
+        if self.bucket_store:
+            deleted += self.bucket_store.delete(session_id)
+        self.chat_sessions.delete_many(query)
+        return deleted
+
+    # Retention and chunked deletion
+
+    def expired_sessions(self, cutoff=None, keep_newest=None, limit=100):
+        self._flush_pending()
+        ids = []
+        if cutoff is not None:
+            ids += [doc['session_id'] for doc in self.chat_sessions.find(
+                {'updated_at': {'$lt': cutoff}}, {'session_id': 1}
+            ).sort('updated_at', 1).limit(limit)]
+        if keep_newest:
+            ids += [doc['session_id'] for doc in self.chat_sessions.find(
+                {}, {'session_id': 1}
+            ).sort('updated_at', -1).skip(keep_newest).limit(limit)]
+        return list(dict.fromkeys(ids))[:limit]
+
+    def delete_sessions(self, session_ids=None):
+        query = {'session_id': {'$in': list(session_ids)}} if session_ids is not None else {}
+        return self.chat_sessions.delete_many(query).deleted_count
+
+    def sessions_with_messages_before(self, before):
+        # Buffered messages are new, so they never count here
+        if self.bucket_store:
+            source, query = self.bucket_store.buckets, {'first_ts': {'$lt': before}}
+        else:
+            source, query = self.chats, {'timestamp': {'$lt': before}}
+        # $group rather than distinct, whose result must fit in one 16MB document
+        pipeline = [{'$match': query}, {'$group': {'_id': '$session_id'}}]
+        return [group['_id'] for group in source.aggregate(pipeline, allowDiskUse=True, batchSize=EXPORT_BATCH_SIZE)]
+
+    def delete_messages(self, session_id=None, before=None, limit=1000):
+        # Buffered messages must land first, or they would outlive the delete
+        self._flush_pending(session_id)
+        if self.bucket_store:
+            return self.bucket_store.delete_chunk(session_id, before, limit)
+        query = {'session_id': session_id} if session_id else {}
+        if before is not None:
+            query['timestamp'] = {'$lt': before}
+        # Ids first, then one delete by _id: a bounded delete that holds no long-running operation open
+        ids = [doc['_id'] for doc in self.chats.find(query, {'_id': 1}).sort('timestamp', 1).limit(limit)]
+        if not ids:
+            return 0
+        return self.chats.delete_many({'_id': {'$in': ids}}).deleted_count
+
+    # Teachers
+
+    def count_teachers(self):
+        return self.teachers.count_documents({})
+
+    def create_teacher(self, teacher):
+        self.teachers.insert_one(dict(teacher))
+
+    def get_teacher(self, teacher_id):
+        return self.teachers.find_one({'teacher_id': teacher_id}, {'_id': 0})
+
+    def get_teachers(self):
+        return list(self.teachers.find({}, {'_id': 0}).sort('name', 1))
+
+    def update_teacher_prompt(self, teacher_id, prompt, updated_at):
+        result = self.teachers.update_one(
+            {'teacher_id': teacher_id},
+            {'$set': {'prompt': prompt, 'updated_at': updated_at}}
+        )
+        return result.matched_count > 0
+
+    def delete_teacher(self, teacher_id):
+        # Only custom teachers can be deleted
+        return self.teachers.delete_one({'teacher_id': teacher_id, 'is_custom': True}).deleted_count > 0
+
+    def rebuild_session_stats(self, session_ids=None, batch_size=EXPORT_BATCH_SIZE):
+        self.flush()
+        if session_ids is not None:
+            session_ids = list(session_ids)
+            if not session_ids:
+                return 0
+        # Limited to session_ids, the $match is a range on the session_id index
+        match = [{'$match': {'session_id': {'$in': session_ids}}}] if session_ids is not None else []
+        if self.bucket_store:
+            source = self.bucket_store.buckets
+            pipeline = match + [{'$sort': {'session_id': 1, 'first_ts': 1}}, {'$unwind': '$messages'}]
+            field = '$messages.'
+        else:
+            source = self.chats
+            pipeline = match + [{'$sort': {'session_id': 1, 'timestamp': 1}}]
+            field = '$'
+        # One pass over the session_id index order; $last relies on the sort above
+        pipeline.append({'$group': {
+            '_id': '$session_id',
+            'message_count': {'$sum': 1},
+            'total_chars': {'$sum': {'$strLenCP': field + 'content'}},
+            'last_role': {'$last': field + 'role'},
+            'last_content': {'$last': field + 'content'},
+        }})
+        seen = set()
+        updates = []
+        for group in source.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size):
+            seen.add(group['_id'])
+            updates.append(UpdateOne({'session_id': group['_id']}, {'$set': {
+                'message_count': group['message_count'],
+                'total_chars': group['total_chars'],
+                'last_role': group['last_role'],
+                'last_message_preview': message_preview(group['last_content']),
+            }}))
+            if len(updates) >= batch_size:
+                self.chat_sessions.bulk_write(updates, ordered=False)
+                updates = []
+        # Sessions without any messages left
+        query = match[0]['$match'] if match else {}
+        for doc in self.chat_sessions.find(query, {'session_id': 1}).batch_size(batch_size):
+            if doc['session_id'] not in seen:
+                updates.append(UpdateOne({'session_id': doc['session_id']}, {'$set': EMPTY_SESSION_STATS}))
+            if len(updates) >= batch_size:
+                self.chat_sessions.bulk_write(updates, ordered=False)
+                updates = []
+        if updates:
+            self.chat_sessions.bulk_write(updates, ordered=False)
+        return self.chat_sessions.count_documents(query)
+
+    # Export / import
+
+    def export_sessions(self):
+        self._flush_pending()
+        return self.chat_sessions.find({}, {'_id': 0, 'applied_bumps': 0}).sort('updated_at', 1) \
+            .batch_size(EXPORT_BATCH_SIZE)
+
+    def export_messages(self):
+        self.flush()
+        if self.bucket_store:
+            return self.bucket_store.iter_messages()
+        # Sorting on exactly the session_id_timestamp index keys streams without an in-memory sort
+        return self.chats.find({}, {'_id': 0, 'session_id': 1, 'role': 1, 'content': 1, 'timestamp': 1}) \
+            .sort([('session_id', 1), ('timestamp', 1)]).batch_size(EXPORT_BATCH_SIZE)
+
+    def export_teachers(self):
+        return self.teachers.find({}, {'_id': 0}).sort('name', 1)
+
+    def import_sessions(self, sessions):
+        if sessions:
+            self.chat_sessions.bulk_write(
+                [ReplaceOne({'session_id': s['session_id']}, dict(EMPTY_SESSION_STATS, **s), upsert=True)
+                 for s in sessions],
+                ordered=False
+            )
+
+    @staticmethod
+    def _imported(message):
+        """The message as stored, its import_id becoming the _id"""
+        doc = {key: value for key, value in message.items() if key != 'import_id'}
+        if message.get('import_id'):
+            doc['_id'] = ObjectId(message['import_id'])
+        return doc
+
+    def import_messages(self, messages):
+        if not messages:
+            return
+        docs = [self._imported(m) for m in messages]
+        if self.bucket_store:
+            self.bucket_store.append_many(docs, skip_applied=True)
+            return
+        try:
+            # Unordered is safe: timestamp ties are broken by _id, which follows the input order
+            self.chats.insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            # A repeated import_id means an earlier, interrupted attempt already stored the message
+            if any(err.get('code') != DUPLICATE_KEY for err in e.details.get('writeErrors', [])):
+                raise
+
+    def import_teachers(self, teachers):
+        if teachers:
+            self.teachers.bulk_write(
+                [ReplaceOne({'teacher_id': t['teacher_id']}, dict(t), upsert=True) for t in teachers], ordered=False
+            )
@@ -0,0 +1,204 @@
+# Content-addressed cache of rendered PDFs for SAHPAATHI
+# A PDF is stored under a hash of its normalised text, its title and the renderer
+# version, so exporting the same notes again returns the file already on disk.
+# The directory is bounded in size and the least recently used files go first.
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from pdf_renderer import paragraphs
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Hex digits of the content hash kept in file names
+KEY_CHARS = 24
+# Characters of the download name kept in file names
+NAME_CHARS = 80
+STALE_TMP_SECONDS = 3600
+
+def normalize_text(text):
+    """Reduce text to what the renderer lays out: trailing spaces and extra blank lines do not change the PDF"""
+    return '\n\n'.join(paragraphs(text or ''))
+
+def make_pdf_key(text, title, renderer_version):
+    """Build a stable key from the normalised text, the title and the renderer version"""
+    digest = hashlib.sha256()
+    for part in (renderer_version, title or '', normalize_text(text)):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()[:KEY_CHARS]
+
+class _Entry:
+    __slots__ = ('size', 'refs', 'last_used')
+
+    def __init__(self, size, last_used, refs=0):
+        self.size = size
+        self.last_used = last_used
+        self.refs = refs  # requests handed this file since the process started
+
+class PDFCache:
+    def __init__(self, directory, renderer, max_bytes=256 * 1024 * 1024, grace_seconds=600):
+        """
+        Args:
+            directory (str): Where cached PDFs are kept; nothing else should be written there
+            renderer (PDFRenderer): Renders misses; its version is part of every key
+            max_bytes (int): Size the directory is trimmed back to after each new file
+            grace_seconds (float): Files handed out this recently are never evicted,
+                so a URL just returned can still be downloaded
+        """
+        self.directory = directory
+        self.renderer = renderer
+        self.max_bytes = max_bytes
+        self.grace_seconds = grace_seconds
+        self._entries = OrderedDict()  # filename -> _Entry, least recently used first
+        self._lock = threading.Lock()
+        # Concurrent requests for the same PDF wait for one render
+        self._inflight = SingleFlight()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """Index the files already on disk, using mtime as the last use"""
+        found = []
+        for item in os.scandir(self.directory):
+            if not item.is_file():
+                continue
+            if item.name.endswith('.tmp'):
+                # Left behind by a write that never finished (newer ones may belong to another worker)
+                if time.time() - item.stat().st_mtime > STALE_TMP_SECONDS:
+                    os.remove(item.path)
+                continue
+            if item.name.endswith('.pdf'):
+                stat = item.stat()
+                found.append((stat.st_mtime, item.name, stat.st_size))
+        for mtime, name, size in sorted(found):
+            self._entries[name] = _Entry(size, mtime)
+            self.bytes += size
+        if found:
+            logger.info(f"PDF cache has {len(found)} files ({self.bytes} bytes) in {self.directory}")
+
+    def filename(self, name, title, text):
+        """The cache file name for a PDF of text titled title, named name for download"""
+        return f"{name[:NAME_CHARS]}_{make_pdf_key(text, title, self.renderer.version)}.pdf"
+
+    def get(self, name, title, text):
+        """
+        Return (filename, pdf_bytes) for the PDF of text titled title, rendering it on a miss.
+
+        filename is relative to the cache directory. pdf_bytes is the freshly rendered
+        PDF when this call rendered it (it is on disk too), else None and the file
+        should be read from the cache. Renderer errors propagate.
+        """
+        filename = self.filename(name, title, text)
+        if self._touch(filename):
+            with self._lock:
+                self.hits += 1
+            return filename, None
+
+        rendered = []
+
+        def render():
+            # Another worker process (or the call just finished) may have written it meanwhile
+            if not self._touch(filename):
+                pdf_bytes = self.renderer.render(title, text)
+                self._store(filename, pdf_bytes)
+                rendered.append(pdf_bytes)
+            return filename
+
+        self._inflight.do(filename, render)
+        pdf_bytes = rendered[0] if rendered else None
+        if pdf_bytes is None:
+            # Found on disk after all, or waited for another request's render
+            self._touch(filename)
+        with self._lock:
+            if pdf_bytes is None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return filename, pdf_bytes
+
+    def _touch(self, filename):
+        """Mark a cached file as used; returns False if it is not on disk"""
+        path = os.path.join(self.directory, filename)
+        now = time.time()
+        try:
+            # The mtime carries the LRU order across restarts
+            os.utime(path, (now, now))
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            with self._lock:
+                entry = self._entries.pop(filename, None)
+                if entry is not None:
+                    self.bytes -= entry.size
+            return False
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                entry = self._entries[filename] = _Entry(size, now)
+                self.bytes += size
+            self._entries.move_to_end(filename)
+            entry.last_used = now
+            entry.refs += 1
+        return True
+
+    def _store(self, filename, pdf_bytes):
+        path = os.path.join(self.directory, filename)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(pdf_bytes)
+        os.replace(tmp_path, path)
+        with self._lock:
+            previous = self._entries.pop(filename, None)
+            if previous is not None:
+                self.bytes -= previous.size
+            self._entries[filename] = _Entry(len(pdf_bytes), time.time(), refs=1)
+            self.bytes += len(pdf_bytes)
+            victims = self._pick_victims()
+        for victim in victims:
+            try:
+                os.remove(os.path.join(self.directory, victim))
+            except FileNotFoundError:
+                pass
+        if victims:
+            logger.info(f"Evicted {len(victims)} PDFs from the cache")
+
+    def _pick_victims(self):
+        """Drop least recently used entries until the cache fits; caller must hold the lock"""
+        victims = []
+        cutoff = time.time() - self.grace_seconds
+        for filename, entry in list(self._entries.items()):
+            if self.bytes <= self.max_bytes:
+                break
+            if entry.last_used >= cutoff:
+                # Everything after this one was used even more recently
+                break
+            del self._entries[filename]
+            self.bytes -= entry.size
+            victims.append(filename)
+        self.evictions += len(victims)
+        return victims
+
+    def stats(self):
+        """Return hit/miss counters, size and how often cached files were reused"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0,
+                'references': sum(entry.refs for entry in self._entries.values()),
+                'coalesced': self._inflight.stats()['coalesced']
+            }
@@ -0,0 +1,239 @@
+# PDF rendering for SAHPAATHI
+# Renders plain text to PDF bytes in memory with a Unicode TTF font, so Hindi and
+# Punjabi notes come out intact. Each font file is read and parsed once per process;
+# every document gets a cheap per-document copy of the parsed font.
+import copy
+import html
+import logging
+import os
+import re
+import threading
+from io import BytesIO
+
+from fontTools import ttLib
+from fpdf import FPDF, FPDF_VERSION
+from fpdf.enums import XPos, YPos
+from fpdf.fonts import SubsetMap, TTFFont
+
+logger = logging.getLogger(__name__)
+# fontTools logs every glyph it keeps while subsetting
+logging.getLogger('fontTools').setLevel(logging.WARNING)
+
+# Bump whenever a change alters the rendered output
+RENDERER_VERSION = 1
+
+# Tried in order when PDF_FONT_PATH / PDF_BOLD_FONT_PATH are not set
+DEFAULT_FONTS = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/TTF/DejaVuSans.ttf',
+    '/usr/share/fonts/truetype/noto/NotoSans-Regular.ttf',
+    '/Library/Fonts/Arial Unicode.ttf',
+    'C:/Windows/Fonts/arial.ttf',
+]
+DEFAULT_BOLD_FONTS = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
+    '/usr/share/fonts/TTF/DejaVuSans-Bold.ttf',
+    '/usr/share/fonts/truetype/noto/NotoSans-Bold.ttf',
+    'C:/Windows/Fonts/arialbd.ttf',
+]
+# Devanagari and Gurmukhi fonts used for characters the main font lacks
+DEFAULT_FALLBACK_FONTS = [
+    '/usr/share/fonts/truetype/noto/NotoSansDevanagari-Regular.ttf',
+    '/usr/share/fonts/truetype/noto/NotoSansGurmukhi-Regular.ttf',
+    '/usr/share/fonts/truetype/lohit-devanagari/Lohit-Devanagari.ttf',
+    '/usr/share/fonts/truetype/lohit-punjabi/Lohit-Gurmukhi.ttf',
+    'C:/Windows/Fonts/Nirmala.ttf',
+]
+
+try:
+    # fpdf2 shapes Indic text (matras, conjuncts) only with uharfbuzz
+    import uharfbuzz as hb
+    from fpdf.fonts import HarfBuzzFont
+    TEXT_SHAPING = True
+except ImportError:
+    TEXT_SHAPING = False
+
+# Characters that are only laid out correctly with a Devanagari/Gurmukhi font and shaping
+_INDIC = re.compile('[\u0900-\u0a7f]')
+
+def _paths(env_name, defaults):
+    """Font files from an os.pathsep separated env var, else the defaults that exist"""
+    configured = os.getenv(env_name)
+    if configured:
+        return [path for path in configured.split(os.pathsep) if path]
+    return [path for path in defaults if os.path.exists(path)]
+
+def html_to_text(html_content):
+    """Plain text of rendered Markdown: tags stripped, entities decoded"""
+    return html.unescape(re.sub(r'<[^>]*>', '', html_content))
+
+def paragraphs(text):
+    """Split text into runs of non-blank lines; each is laid out with one multi_cell call"""
+    block = []
+    for line in text.replace('\r\n', '\n').split('\n'):
+        if line.strip():
+            block.append(line.rstrip())
+        elif block:
+            yield '\n'.join(block)
+            block = []
+    if block:
+        yield '\n'.join(block)
+
+class FontCache:
+    """Parsed TTF fonts, loaded once per process and shared by every document"""
+
+    def __init__(self):
+        self._fonts = {}  # path -> (file bytes, parsed TTFFont template, HarfBuzz face or None)
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def _load(self, path):
+        with self._lock:
+            entry = self._fonts.get(path)
+            if entry is None:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                # Parsing the cmap and glyph widths is the expensive part; it happens here only
+                template = TTFFont(FPDF(), path, 'template', '')
+                template.close()
+                face = hb.Face(hb.Blob(data)) if TEXT_SHAPING else None
+                entry = self._fonts[path] = (data, template, face)
+                self.loads += 1
+                logger.info(f"Loaded PDF font {path}")
+            return entry
+
+    def add_to(self, pdf, family, path, style=''):
+        """
+        Register the font at path with pdf as family, like FPDF.add_font but without re-parsing it.
+
+        Glyph widths, the cmap and the HarfBuzz face are shared; the document gets its own
+        subset, font descriptor, fontTools object and HarfBuzz font, because laying out and
+        writing the PDF changes all four.
+        Relies on fpdf2 internals, so keep fpdf2 pinned in requirements.txt.
+        """
+        data, template, face = self._load(path)
+        font = copy.copy(template)
+        font.i = len(pdf.fonts) + 1
+        font.fontkey = f"{family.lower()}{style}"
+        font.desc = copy.copy(template.desc)
+        font.ttfont = ttLib.TTFont(BytesIO(data), recalcTimestamp=False, fontNumber=0, lazy=True)
+        font.missing_glyphs = []
+        font.hbfont = HarfBuzzFont(face) if face is not None else None
+        reserved = "\x00 \r\n"
+        if pdf.str_alias_nb_pages:
+            reserved += "0123456789" + pdf.str_alias_nb_pages
+        font.subset = SubsetMap(font, [ord(char) for char in reserved])
+        pdf.fonts[font.fontkey] = font
+
+    def stats(self):
+        with self._lock:
+            return {'fonts_loaded': self.loads, 'fonts_cached': len(self._fonts)}
+
+class PDFRenderer:
+    def __init__(self, font_path=None, bold_font_path=None, fallback_font_paths=None, font_cache=None):
+        """
+        Args:
+            font_path (str): Unicode TTF for body text; without one, core Helvetica is used
+                and characters outside Latin-1 are replaced with '?'
+            bold_font_path (str): TTF for the title (defaults to font_path)
+            fallback_font_paths (list): TTFs tried for characters font_path lacks
+            font_cache (FontCache): Where parsed fonts are kept
+        """
+        self.font_path = font_path
+        self.bold_font_path = bold_font_path or font_path
+        self.fallback_font_paths = fallback_font_paths or []
+        self.fonts = font_cache or FontCache()
+        self._lock = threading.Lock()
+        self.documents = 0
+        self.pages = 0
+        self.unshaped_documents = 0
+        self.indic_problem = self._indic_problem()
+        if self.indic_problem:
+            logger.warning(f"{self.indic_problem}; Hindi and Punjabi text in PDFs will not render correctly")
+
+    def _indic_problem(self):
+        """Why Devanagari/Gurmukhi text cannot be rendered properly, or None if it can"""
+        if not self.font_path:
+            return "No Unicode font found for PDF rendering (set PDF_FONT_PATH), so non-Latin text is replaced with '?'"
+        if not self.fallback_font_paths:
+            return ("No Devanagari/Gurmukhi font found (install fonts-noto-core or set PDF_FALLBACK_FONTS), "
+                    "so those characters are missing")
+        if not TEXT_SHAPING:
+            return "uharfbuzz is not installed, so vowel signs and conjuncts are not shaped"
+        return None
+
+    @property
+    def version(self):
+        """Identifies everything that shapes the output, for caches keyed on it"""
+        fonts = [self.font_path, self.bold_font_path] + self.fallback_font_paths
+        return f"{RENDERER_VERSION}:{FPDF_VERSION}:{TEXT_SHAPING}:" + os.pathsep.join(str(path) for path in fonts)
+
+    def _setup_fonts(self, pdf):
+        """Add the cached fonts to pdf; returns (body family, title family)"""
+        if not self.font_path:
+            return 'Helvetica', 'Helvetica'
+        self.fonts.add_to(pdf, 'body', self.font_path)
+        self.fonts.add_to(pdf, 'title', self.bold_font_path)
+        fallbacks = []
+        for index, path in enumerate(self.fallback_font_paths):
+            family = f"fallback{index}"
+            self.fonts.add_to(pdf, family, path)
+            fallbacks.append(family)
+        if fallbacks:
+            pdf.set_fallback_fonts(fallbacks)
+        if TEXT_SHAPING:
+            pdf.set_text_shaping(True)
+        return 'body', 'title'
+
+    def _encodable(self, text):
+        if self.font_path:
+            return text
+        return text.encode('latin-1', 'replace').decode('latin-1')
+
+    def build(self, title, text):
+        """Lay out title and text on a new FPDF document"""
+        pdf = FPDF()
+        body_family, title_family = self._setup_fonts(pdf)
+        pdf.set_title(title)
+        pdf.add_page()
+
+        pdf.set_font(title_family, 'B' if title_family == 'Helvetica' else '', 16)
+        pdf.multi_cell(0, 10, self._encodable(title), align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        pdf.ln(10)
+
+        pdf.set_font(body_family, size=12)
+        for index, block in enumerate(paragraphs(text)):
+            if index:
+                pdf.ln(5)
+            pdf.multi_cell(0, 10, self._encodable(block), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        return pdf
+
+    def render(self, title, text):
+        """Render title and text to PDF bytes without touching the disk"""
+        pdf = self.build(title, text)
+        data = bytes(pdf.output())
+        unshaped = bool(self.indic_problem) and bool(_INDIC.search(title) or _INDIC.search(text))
+        if unshaped:
+            logger.warning(f"Rendered Hindi/Punjabi text without proper fonts: {self.indic_problem}")
+        with self._lock:
+            self.documents += 1
+            self.pages += pdf.pages_count
+            self.unshaped_documents += unshaped
+        return data
+
+    def stats(self):
+        with self._lock:
+            rendered = {'documents': self.documents, 'pages': self.pages,
+                        'unshaped_documents': self.unshaped_documents}
+        return dict(self.fonts.stats(), **rendered,
+                    font=self.font_path, fallback_fonts=self.fallback_font_paths, text_shaping=TEXT_SHAPING)
+
+def _first(paths):
+    return paths[0] if paths else None
+
+# Shared renderer configured from the environment
+pdf_renderer = PDFRenderer(
+    font_path=_first(_paths("PDF_FONT_PATH", DEFAULT_FONTS)),
+    bold_font_path=_first(_paths("PDF_BOLD_FONT_PATH", DEFAULT_BOLD_FONTS)),
+    fallback_font_paths=_paths("PDF_FALLBACK_FONTS", DEFAULT_FALLBACK_FONTS)
+)
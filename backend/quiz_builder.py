@@ -0,0 +1,217 @@
+# Map-reduce quiz generation for large syllabi
+# Splits the syllabus into topic-sized chunks, generates questions for the chunks
+# in parallel, then merges them and drops near-duplicates.
+import logging
+import math
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from quiz_stream_parser import parse_quiz_text
+from resilience import LLMUpstreamError
+
+logger = logging.getLogger(__name__)
+
+CHUNK_CHARS = int(os.getenv("SYLLABUS_CHUNK_CHARS", "4000"))
+CHUNK_PARALLELISM = int(os.getenv("SYLLABUS_CHUNK_PARALLELISM", "4"))
+TOP_UP_ROUNDS = int(os.getenv("SYLLABUS_TOP_UP_ROUNDS", "3"))
+# Upper bound on the questions one syllabus quiz request may ask for
+MAX_QUESTIONS = int(os.getenv("SYLLABUS_MAX_QUESTIONS", "50"))
+DUPLICATE_THRESHOLD = 0.8
+
+class QuizShortfall(LLMUpstreamError):
+    """The model did not produce enough distinct, well-formed questions"""
+
+# Lines that usually start a new topic: markdown headings, "Unit 3", "Chapter 2:", "1." etc.
+_TOPIC_START = re.compile(r'^\s*(#{1,6}\s|(unit|chapter|module|topic|section|week)\b|\d+[.)]\s)', re.IGNORECASE)
+
+def split_syllabus(text, max_chars=CHUNK_CHARS):
+    """Split syllabus text into topic-sized chunks of at most roughly max_chars"""
+    blocks = []
+    current = []
+    for line in text.splitlines():
+        if (_TOPIC_START.match(line) or not line.strip()) and current:
+            blocks.append('\n'.join(current).strip())
+            current = []
+        if line.strip():
+            current.append(line)
+    if current:
+        blocks.append('\n'.join(current).strip())
+
+    # Pack neighbouring blocks together until a chunk is full
+    chunks = []
+    buffer = ''
+    for block in blocks:
+        while len(block) > max_chars:
+            # A single oversized block is cut at a sentence boundary where possible
+            cut = block.rfind('. ', 0, max_chars)
+            cut = cut + 1 if cut > max_chars // 2 else max_chars
+            pieces = (block[:cut].strip(), block[cut:].strip())
+            if buffer:
+                chunks.append(buffer)
+                buffer = ''
+            chunks.append(pieces[0])
+            block = pieces[1]
+        if buffer and len(buffer) + len(block) + 2 > max_chars:
+            chunks.append(buffer)
+            buffer = block
+        else:
+            buffer = f"{buffer}\n\n{block}" if buffer else block
+    if buffer:
+        chunks.append(buffer)
+    return [chunk for chunk in chunks if chunk]
+
+def allocate_questions(chunks, count):
+    """Share count questions across chunks in proportion to their length"""
+    total = sum(len(c) for c in chunks) or 1
+    shares = [count * len(c) / total for c in chunks]
+    allocation = [int(share) for share in shares]
+    # Hand out the remainder to the chunks with the largest fractional parts
+    order = sorted(range(len(chunks)), key=lambda i: shares[i] - allocation[i], reverse=True)
+    for i in order[:count - sum(allocation)]:
+        allocation[i] += 1
+    return allocation
+
+def merge_small_chunks(chunks, count):
+    """Combine adjacent chunks so there are never more chunks than questions"""
+    while len(chunks) > max(count, 1):
+        sizes = [len(chunks[i]) + len(chunks[i + 1]) for i in range(len(chunks) - 1)]
+        i = sizes.index(min(sizes))
+        chunks = chunks[:i] + [chunks[i] + "\n\n" + chunks[i + 1]] + chunks[i + 2:]
+    return chunks
+
+def build_quiz_prompt(text, count, avoid=None):
+    """Quiz prompt for text; avoid lists question texts the model must not repeat"""
+    prompt = f"""
+        Based on the following syllabus or study material, create a multiple-choice quiz with {count} questions.
+
+        SYLLABUS/STUDY MATERIAL:
+        {text}
+
+        INSTRUCTIONS:
+        1. Generate {count} multiple-choice questions based on factual information in the provided text.
+        2. Each question should have exactly 4 options.
+        3. Only one option should be correct.
+        4. Don't make questions too obvious or too difficult.
+        5. Focus on important concepts and key information.
+        6. Return your response in JSON format as follows:
+
+        {{
+            "questions": [
+                {{
+                    "question": "Question text goes here?",
+                    "options": ["Option A", "Option B", "Option C", "Option D"],
+                    "correct": "Exact text of the correct option"
+                }},
+                ...more questions...
+            ]
+        }}
+
+        Only return the JSON, nothing else.
+        """
+    if avoid:
+        listed = '\n'.join(f"        - {question}" for question in avoid)
+        prompt += f"""
+        Do not repeat or rephrase any of these questions:
+{listed}
+        """
+    return prompt
+
+def parse_questions(raw):
+    """Pull the well-formed questions out of a model response"""
+    return parse_quiz_text(raw)
+
+def _signature(question):
+    return set(re.findall(r'[a-z0-9]+', question['question'].lower()))
+
+def is_near_duplicate(a, b, threshold=DUPLICATE_THRESHOLD):
+    """Compare two question signatures by Jaccard similarity"""
+    if not a or not b:
+        return a == b
+    return len(a & b) / len(a | b) >= threshold
+
+def dedupe_questions(questions):
+    kept = []
+    signatures = []
+    for question in questions:
+        signature = _signature(question)
+        if any(is_near_duplicate(signature, other) for other in signatures):
+            continue
+        kept.append(question)
+        signatures.append(signature)
+    return kept
+
+def generate_chunked_quiz(text, count, generate, max_chars=CHUNK_CHARS, parallelism=CHUNK_PARALLELISM,
+                          top_up_rounds=TOP_UP_ROUNDS):
+    """
+    Generate a quiz for a large syllabus by fanning out one request per chunk.
+
+    Args:
+        text (str): The syllabus text
+        count (int): Number of questions wanted
+        generate (callable): Takes a prompt and returns raw model text; called from
+            up to parallelism threads at once
+        max_chars (int): Target chunk size in characters
+        parallelism (int): Maximum chunk requests in flight at once
+        top_up_rounds (int): Extra requests allowed to make up a shortfall
+
+    Returns a dict with exactly count 'questions', 'chunks' and 'timings'.
+    Raises QuizShortfall if the top-up rounds still leave it short.
+    LLM errors from any chunk propagate to the caller.
+    """
+    started = time.monotonic()
+    chunks = merge_small_chunks(split_syllabus(text, max_chars), count)
+    allocation = allocate_questions(chunks, count)
+    split_ms = (time.monotonic() - started) * 1000
+
+    def run_chunk(index):
+        chunk_started = time.monotonic()
+        # Ask for a little extra so near-duplicates can be dropped without running short
+        wanted = allocation[index] + max(1, math.ceil(allocation[index] * 0.25))
+        questions = parse_questions(generate(build_quiz_prompt(chunks[index], wanted)))
+        return questions, (time.monotonic() - chunk_started) * 1000
+
+    generate_started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(chunks)))) as executor:
+        results = list(executor.map(run_chunk, range(len(chunks))))
+    generate_ms = (time.monotonic() - generate_started) * 1000
+
+    # Take each chunk's share first so every topic is represented, then fill from the extras
+    per_chunk = [dedupe_questions(questions) for questions, _ in results]
+    primary = [q for i, questions in enumerate(per_chunk) for q in questions[:allocation[i]]]
+    extras = [q for i, questions in enumerate(per_chunk) for q in questions[allocation[i]:]]
+    merged = dedupe_questions(primary + extras)[:count]
+
+    # Chunks that came back short or malformed are made up one chunk at a time,
+    # largest first, telling the model which questions it already has
+    top_up_started = time.monotonic()
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]), reverse=True)
+    rounds = 0
+    while len(merged) < count and rounds < top_up_rounds:
+        source = chunks[order[rounds % len(order)]]
+        shortfall = count - len(merged)
+        rounds += 1
+        extra = parse_questions(generate(build_quiz_prompt(
+            source, shortfall * 2, avoid=[q['question'] for q in merged])))
+        found = len(merged)
+        merged = dedupe_questions(merged + extra)[:count]
+        if len(merged) == found and len(order) == 1:
+            # The same prompt again would only repeat itself
+            break
+    top_up_ms = (time.monotonic() - top_up_started) * 1000
+
+    if len(merged) < count:
+        raise QuizShortfall(f"Only {len(merged)} of {count} quiz questions could be generated, please retry")
+    return {
+        'questions': merged,
+        'chunks': len(chunks),
+        'timings': {
+            'split_ms': round(split_ms, 1),
+            'generate_ms': round(generate_ms, 1),
+            'chunk_ms': [round(ms, 1) for _, ms in results],
+            'top_up_rounds': rounds,
+            'top_up_ms': round(top_up_ms, 1),
+            'total_ms': round((time.monotonic() - started) * 1000, 1)
+        }
+    }
@@ -0,0 +1,84 @@
+# Incremental parser for quiz JSON produced by the model
+# Consumes model output chunk by chunk and emits each question object as soon as
+# it closes, so a broken tail never costs the questions that came before it.
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+def is_valid_question(question):
+    """Check a parsed object has the shape the quiz UI expects"""
+    return (
+        isinstance(question, dict)
+        and isinstance(question.get('question'), str)
+        and isinstance(question.get('options'), list)
+        and len(question['options']) >= 2
+        and question.get('correct') in question['options']
+    )
+
+class QuizStreamParser:
+    def __init__(self):
+        self._buffer = []      # characters of the current top-level value
+        self._starts = []      # buffer offsets of currently open '{'
+        self._in_string = False
+        self._escaped = False
+        self.questions = []
+        self.rejected = 0
+
+    def feed(self, text):
+        """Consume more model output and return the questions completed by it"""
+        completed = []
+        for char in text:
+            if self._starts:
+                self._buffer.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                if self._starts:
+                    self._in_string = True
+            elif char == '{':
+                if not self._starts:
+                    self._buffer = ['{']
+                self._starts.append(len(self._buffer) - 1)
+            elif char == '}' and self._starts:
+                start = self._starts.pop()
+                question = self._parse(''.join(self._buffer[start:]), nested=bool(self._starts))
+                if question is not None:
+                    completed.append(question)
+                    if len(self._starts) > 0:
+                        # Nothing inside a finished question is needed again
+                        del self._buffer[start:]
+                if not self._starts:
+                    self._buffer = []
+        self.questions.extend(completed)
+        return completed
+
+    def _parse(self, candidate, nested):
+        try:
+            value = json.loads(candidate)
+        except json.JSONDecodeError:
+            # The outer wrapper no longer parses once its questions are dropped from the buffer
+            if nested:
+                self.rejected += 1
+            return None
+        if is_valid_question(value):
+            return value
+        return None
+
+    def finish(self):
+        """Return every question found; anything still open at the end is discarded"""
+        if self._starts:
+            logger.warning(f"Quiz output ended inside an unfinished object; kept {len(self.questions)} questions")
+        return self.questions
+
+def parse_quiz_text(text):
+    """Parse a complete model response, keeping every well-formed question"""
+    parser = QuizStreamParser()
+    parser.feed(text or '')
+    return parser.finish()
@@ -0,0 +1,21 @@
+# Recompute the session summary fields (message_count, total_chars, last_role,
+# last_message_preview) from the stored messages. add_message keeps them current;
+# run this after upgrading, after importing an old export, or when retention or a
+# failed batched flush has left them out of step.
+import argparse
+from chat_transfer import open_backend
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild SAHPAATHI session summaries from chat messages')
+    parser.add_argument('--backend', choices=['mongodb', 'sqlite'], default='mongodb')
+    parser.add_argument('--mongo-uri', type=str, default='mongodb://localhost:27017/', help='MongoDB connection string')
+    parser.add_argument('--database', type=str, default='sahpaathi', help='MongoDB database name')
+    parser.add_argument('--sqlite-path', type=str, default=None, help='SQLite file (default: SQLITE_PATH)')
+    args = parser.parse_args()
+
+    storage = open_backend(args.backend, args)
+    try:
+        sessions = storage.rebuild_session_stats()
+    finally:
+        storage.close()
+    print(f"Rebuilt summaries for {sessions} sessions")
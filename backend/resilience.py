@@ -0,0 +1,271 @@
+# Resilience layer for SAHPAATHI's LLM calls
+# Wraps upstream calls with a deadline, jittered retries, optional hedging and a
+# circuit breaker, and reports failures as typed errors instead of message text.
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+class LLMError(Exception):
+    """Base class for failures surfaced to routes"""
+    status_code = 502
+
+class LLMTimeoutError(LLMError):
+    """The call did not finish within its deadline"""
+    status_code = 504
+
+class LLMUnavailableError(LLMError):
+    """The circuit breaker is open, so the call was rejected without trying"""
+    status_code = 503
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class LLMUpstreamError(LLMError):
+    """The upstream call failed and retries did not help"""
+    status_code = 502
+
+# Exception class names (from google.api_core and friends) worth retrying
+_TRANSIENT_NAMES = {
+    'ServiceUnavailable', 'ResourceExhausted', 'DeadlineExceeded', 'InternalServerError',
+    'TooManyRequests', 'GatewayTimeout', 'BadGateway', 'Aborted', 'RetryError',
+    'StubBackendError'
+}
+
+def is_transient(error):
+    """Return True for errors a retry could plausibly fix"""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ in _TRANSIENT_NAMES for cls in type(error).__mro__)
+
+# Deadline budgets per endpoint, in seconds
+ENDPOINT_DEADLINES = {
+    'chat': float(os.getenv("LLM_DEADLINE_CHAT_SECONDS", "30")),
+    'quiz': float(os.getenv("LLM_DEADLINE_QUIZ_SECONDS", "45")),
+    'paper': float(os.getenv("LLM_DEADLINE_PAPER_SECONDS", "90")),
+    'default': float(os.getenv("LLM_DEADLINE_SECONDS", "60")),
+}
+
+def deadline_for(endpoint):
+    """Return an absolute monotonic deadline for an endpoint's budget"""
+    budget = ENDPOINT_DEADLINES.get(endpoint or 'default', ENDPOINT_DEADLINES['default'])
+    return time.monotonic() + budget
+
+class CircuitBreaker:
+    """Classic closed / open / half-open breaker driven by consecutive failures"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise LLMUnavailableError if calls should fail fast right now"""
+        with self._lock:
+            if self.state == self.OPEN:
+                remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+                if remaining > 0:
+                    raise LLMUnavailableError("LLM service is temporarily unavailable", retry_after=remaining)
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    raise LLMUnavailableError("LLM service is recovering", retry_after=1.0)
+                self._probe_in_flight = True
+
+    def release(self):
+        """Give back a half-open probe slot taken by before_call for a call that was never sent"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Circuit breaker closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"Circuit breaker opened after {self.failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'consecutive_failures': self.failures}
+
+class ResilientCaller:
+    def __init__(self, breaker=None, max_workers=16, max_retries=2, backoff_base=0.5,
+                 backoff_cap=8.0, hedge_delay=2.0):
+        """
+        Args:
+            breaker (CircuitBreaker): Shared breaker for the upstream
+            max_workers (int): Threads available for upstream calls; once all are busy
+                new calls are rejected instead of queued
+            max_retries (int): Extra attempts made for transient errors
+            backoff_base (float): First backoff ceiling in seconds, doubled per attempt
+            backoff_cap (float): Upper bound on any single backoff
+            hedge_delay (float): Seconds to wait before sending a hedged duplicate
+        """
+        self.breaker = breaker or CircuitBreaker()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge_delay = hedge_delay
+        self.max_workers = max_workers
+        # Upstream calls run here so the caller never waits past its deadline; each call is
+        # also given the remaining time as its own request timeout, so the thread is freed too
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='llm-call')
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    def call(self, fn, deadline, hedge=False):
+        """
+        Run fn(timeout) with retries until it succeeds or the deadline passes.
+
+        timeout is the seconds left before the deadline; fn must pass it on as the
+        upstream request timeout, because a call still running here cannot be cancelled.
+        Raises LLMTimeoutError, LLMUnavailableError or LLMUpstreamError.
+        """
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                result = self._attempt(fn, deadline, hedge)
+            except LLMUnavailableError:
+                # Rejected locally before reaching the upstream; not a failure of the upstream
+                self.breaker.release()
+                raise
+            except LLMTimeoutError:
+                self.breaker.record_failure()
+                raise
+            except Exception as e:
+                if not is_transient(e):
+                    # A blocked response or a bad argument is about this prompt, not upstream health
+                    self.breaker.release()
+                    raise LLMUpstreamError(f"LLM request failed: {str(e)}") from e
+                self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise LLMUpstreamError(f"LLM request failed: {str(e)}") from e
+                # Full jitter keeps retries from concurrent requests spread out
+                backoff = random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+                if time.monotonic() + backoff >= deadline:
+                    raise LLMTimeoutError("Deadline exceeded while retrying LLM request") from e
+                logger.warning(f"Transient LLM error ({str(e)}), retrying in {backoff:.2f}s")
+                time.sleep(backoff)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    def _take_slot(self):
+        """Count one more upstream call; returns False if max_workers are already running"""
+        with self._lock:
+            if self.in_flight >= self.max_workers:
+                return False
+            self.in_flight += 1
+            return True
+
+    def _finished(self, future=None):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _reject(self):
+        with self._lock:
+            self.rejected += 1
+        raise LLMUnavailableError("All LLM call threads are busy", retry_after=1.0)
+
+    def _submit(self, fn, timeout):
+        """Start fn(timeout) on a free thread; returns None if every thread is busy"""
+        if not self._take_slot():
+            return None
+        future = self._executor.submit(fn, timeout)
+        future.add_done_callback(self._finished)
+        return future
+
+    @contextmanager
+    def slot(self):
+        """Hold one upstream call slot for a call made outside the executor, such as a stream"""
+        if not self._take_slot():
+            self._reject()
+        try:
+            yield
+        finally:
+            self._finished()
+
+    def _attempt(self, fn, deadline, hedge):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise LLMTimeoutError("Deadline exceeded before LLM request was sent")
+        primary = self._submit(fn, remaining)
+        if primary is None:
+            self._reject()
+        if not hedge or self.hedge_delay >= remaining:
+            try:
+                return primary.result(timeout=remaining)
+            except FutureTimeout:
+                # The call keeps its thread until its own request timeout expires
+                raise LLMTimeoutError(f"LLM request timed out after {remaining:.1f}s")
+
+        # Hedged request: if the first call is slow, race a duplicate and take whichever wins
+        done, _ = wait([primary], timeout=self.hedge_delay)
+        if done:
+            return primary.result()
+        hedged = self._submit(fn, deadline - time.monotonic())
+        if hedged is None:
+            # No spare thread for a duplicate; keep waiting on the primary alone
+            pending = {primary}
+        else:
+            logger.info("Primary LLM call is slow, sending hedged request")
+            pending = {primary, hedged}
+        error = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # The loser runs on until it finishes or its request timeout expires
+                    return future.result()
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        raise LLMTimeoutError("LLM request timed out (hedged)")
+
+    def stats(self):
+        with self._lock:
+            calls = {'in_flight': self.in_flight, 'max_workers': self.max_workers, 'rejected': self.rejected}
+        return {'circuit_breaker': self.breaker.stats(), 'upstream_calls': calls}
+
+# Shared caller used by utils.generate_response
+resilient_caller = ResilientCaller(
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+        reset_timeout=float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+    ),
+    max_workers=int(os.getenv("LLM_MAX_UPSTREAM_THREADS", "16")),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "2")),
+    hedge_delay=float(os.getenv("LLM_HEDGE_DELAY_SECONDS", "2.0"))
+)
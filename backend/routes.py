@@ -1,17 +1,32 @@
 import re
 import json
-from flask import Blueprint, render_template, request, jsonify, session, send_from_directory, url_for
+from flask import Blueprint, render_template, request, jsonify, session, send_file, send_from_directory, url_for, Response, stream_with_context
 import os
 import sys
 import uuid
+from datetime import datetime
 import markdown
 import tempfile
+from io import BytesIO
 import logging
 import traceback
+from functools import wraps
 from werkzeug.utils import secure_filename
 # Fix imports to use local modules
-from utils import generate_response, is_api_key_valid
+from utils import generate_response, generate_response_stream, is_api_key_valid, inflight, model_pool
+from llm_cache import response_cache
+from resilience import LLMError, LLMUnavailableError, resilient_caller
 from db import db
+from context_assembler import create_context_assembler
+from scheduler import scheduler, AdmissionRejected
+from quiz_builder import generate_chunked_quiz, CHUNK_CHARS, MAX_QUESTIONS
+from quiz_stream_parser import QuizStreamParser, parse_quiz_text
+from jobs import job_manager, Job, JobManager, JobQueueFull
+from pdf_renderer import pdf_renderer, html_to_text
+from pdf_cache import PDFCache
+
+# Drop pooled teacher models whenever a teacher's prompt changes or it is deleted
+db.add_teacher_listener(model_pool.invalidate)
 
 # Configure logging more thoroughly
 logging.basicConfig(level=logging.DEBUG, 
@@ -65,11 +80,108 @@ if not os.path.exists(UPLOAD_FOLDER):
 else:
     logger.info(f"Using existing uploads directory at {UPLOAD_FOLDER}")
 
+# Rendered PDFs are kept by content hash so re-exporting the same notes skips rendering
+PDF_CACHE_DIR = 'pdf-cache'
+pdf_cache = PDFCache(
+    os.path.join(UPLOAD_FOLDER, PDF_CACHE_DIR),
+    pdf_renderer,
+    max_bytes=int(float(os.getenv("PDF_CACHE_MAX_MB", "256")) * 1024 * 1024),
+    grace_seconds=float(os.getenv("PDF_CACHE_GRACE_SECONDS", "600"))
+)
+
+# Builds chat prompts from a rolling summary plus the most recent turns
+context_assembler = create_context_assembler(db, generate_response)
+# Context folds run one at a time on their own pool, so chat traffic never fills the shared job queue
+fold_jobs = JobManager(max_workers=1, max_pending=16, result_ttl=60)
+
+# Hedged chat requests trade extra upstream calls for lower tail latency
+HEDGE_CHAT_REQUESTS = os.getenv("LLM_HEDGE_CHAT", "false").lower() in ("1", "true", "yes")
+
+def llm_error_response(error):
+    """Turn a typed LLM error into a JSON error response"""
+    response = jsonify({'error': str(error), 'error_type': type(error).__name__})
+    response.status_code = error.status_code
+    if isinstance(error, LLMUnavailableError) and error.retry_after:
+        response.headers['Retry-After'] = str(max(1, int(error.retry_after + 0.999)))
+    return response
+
+def client_id():
+    """
+    Identify the calling client for per-client rate limiting.
+
+    Only the peer address is used; behind a reverse proxy, set TRUSTED_PROXIES so
+    ProxyFix (see app.py) resolves it from the hops those proxies appended.
+    """
+    return request.remote_addr
+
+def with_slot(priority_class, fn):
+    """Wrap fn so that every call waits for and holds its own scheduler slot"""
+    @wraps(fn)
+    def call(*args, **kwargs):
+        with scheduler.admit(priority_class):
+            return fn(*args, **kwargs)
+    return call
+
+def admission_controlled(priority_class):
+    """Run the view only once the scheduler admits it, shedding load with 503/429"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                with scheduler.admit(priority_class, client_id()):
+                    return view(*args, **kwargs)
+            except AdmissionRejected as e:
+                logger.warning(f"Rejected {request.path} ({priority_class}): {str(e)}")
+                return llm_error_response(e)
+        return wrapper
+    return decorator
+
 @routes.route('/')
 def index():
     """Render the main chat interface"""
     return render_template('index.html')
 
+def cached_pdf(name, title, text):
+    """
+    Render text into the PDF cache, or find it there already.
+
+    Returns (file info, PDF bytes); the bytes are only set when this call rendered them.
+    """
+    filename, pdf_bytes = pdf_cache.get(name, title, text)
+    return {
+        'pdf_url': f'/uploads/{PDF_CACHE_DIR}/{filename}',
+        'filename': filename,
+        'cached': pdf_bytes is None
+    }, pdf_bytes
+
+def pdf_download(pdf_info, pdf_bytes=None):
+    """
+    Send a PDF straight back as a download, named without its content hash.
+
+    Freshly rendered bytes are streamed from memory; cache hits are read from disk.
+    """
+    download_name = pdf_info['filename'].rsplit('_', 1)[0] + '.pdf'
+    if pdf_bytes is not None:
+        return send_file(BytesIO(pdf_bytes), mimetype='application/pdf',
+                         as_attachment=True, download_name=download_name)
+    return send_from_directory(pdf_cache.directory, pdf_info['filename'], mimetype='application/pdf',
+                               as_attachment=True, download_name=download_name)
+
+def pdf_name(title):
+    """A filesystem-safe base name for a PDF titled title"""
+    return secure_filename(title) or 'Document'
+
+def wants_download():
+    return request.args.get('download', '').lower() in ('1', 'true', 'yes')
+
+def render_text_to_pdf(text_content, title):
+    """Render plain text to a cached PDF; returns (file info, fresh bytes), or (None, None) on failure"""
+    try:
+        return cached_pdf(pdf_name(title), title, text_content)
+    except Exception as e:
+        logger.error(f"PDF rendering failed: {str(e)}\n{traceback.format_exc()}")
+        return None, None
+
 @routes.route('/api/convert-text-to-pdf', methods=['POST'])
 def convert_text_to_pdf():
     """Convert directly entered text to PDF"""
@@ -81,23 +193,12 @@ def convert_text_to_pdf():
         text_content = data.get('text', '')
         title = data.get('title', 'Document')
         
-        # Generate unique filename
-        unique_id = str(uuid.uuid4())[:8]
-        pdf_path = os.path.join(UPLOAD_FOLDER, f"{title}_{unique_id}.pdf")
-        pdf_filename = f"{title}_{unique_id}.pdf"
-        
-        # Convert text content to HTML - no markdown parsing needed
-        html = f"<pre>{text_content}</pre>"
+        pdf_info, pdf_bytes = render_text_to_pdf(text_content, title)
         
-        success = convert_html_to_pdf(html, pdf_path, title)
-        
-        if success:
-            # Fix the URL generation - use direct path instead
-            return jsonify({
-                'success': True,
-                'pdf_url': f'/uploads/{pdf_filename}',
-                'filename': pdf_filename
-            })
+        if pdf_info and wants_download():
+            return pdf_download(pdf_info, pdf_bytes)
+        if pdf_info:
+            return jsonify({'success': True, **pdf_info})
         else:
             return jsonify({
                 'error': 'Failed to convert text to PDF. See server logs for details.'
@@ -108,58 +209,51 @@ def convert_text_to_pdf():
         logger.error(f"Text to PDF conversion error: {str(e)}\n{error_details}")
         return jsonify({'error': str(e)}), 500
 
-@routes.route('/api/convert-md-to-pdf', methods=['POST'])
-def convert_md_to_pdf():
-    """Convert Markdown or Text file to PDF"""
+def validate_document_upload():
+    """Check the uploaded document; returns (file, error_response)"""
     if 'file' not in request.files:
-        return jsonify({'error': 'No file part'}), 400
+        return None, (jsonify({'error': 'No file part'}), 400)
     
     file = request.files['file']
     if file.filename == '':
-        return jsonify({'error': 'No selected file'}), 400
+        return None, (jsonify({'error': 'No selected file'}), 400)
     
     # Check if file is Markdown or Text
     if not (file.filename.endswith('.md') or file.filename.endswith('.txt')):
-        return jsonify({'error': 'File must be a Markdown (.md) or Text (.txt) file'}), 400
+        return None, (jsonify({'error': 'File must be a Markdown (.md) or Text (.txt) file'}), 400)
+    return file, None
+
+def document_text(filename, content):
+    """The text to render for an uploaded document: Markdown is converted and its markup stripped"""
+    if filename.endswith('.md'):
+        return html_to_text(markdown.markdown(content, extensions=['extra', 'codehilite']))
+    return content
+
+def render_document_to_pdf(original_filename, content):
+    """Render an uploaded Markdown/Text document to a cached PDF; returns (file info, fresh bytes), or (None, None) on failure"""
+    base_name = pdf_name(os.path.splitext(original_filename)[0])
+    try:
+        return cached_pdf(base_name, base_name, document_text(original_filename, content))
+    except Exception as e:
+        logger.error(f"PDF rendering failed: {str(e)}\n{traceback.format_exc()}")
+        return None, None
+
+@routes.route('/api/convert-md-to-pdf', methods=['POST'])
+def convert_md_to_pdf():
+    """Convert Markdown or Text file to PDF"""
+    file, error = validate_document_upload()
+    if error:
+        return error
     
     try:
-        # Create unique filename to avoid conflicts
-        filename = secure_filename(file.filename)
-        base_name = os.path.splitext(filename)[0]
-        unique_id = str(uuid.uuid4())[:8]  # Use shorter UUID
-        input_path = os.path.join(UPLOAD_FOLDER, f"{base_name}_{unique_id}{os.path.splitext(filename)[1]}")
-        pdf_path = os.path.join(UPLOAD_FOLDER, f"{base_name}_{unique_id}.pdf")
-        pdf_filename = f"{base_name}_{unique_id}.pdf"
+        content = file.read().decode('utf-8')
+        pdf_info, pdf_bytes = render_document_to_pdf(file.filename, content)
         
-        # Save the uploaded file
-        file.save(input_path)
-        logger.info(f"Saved uploaded file to {input_path}")
-        
-        # Read the content
-        with open(input_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # If it's a Markdown file, convert to HTML with markdown library
-        # If it's a text file, wrap in pre tags
-        if input_path.endswith('.md'):
-            logger.info("Converting markdown to HTML")
-            html = markdown.markdown(content, extensions=['extra', 'codehilite'])
-        else:  # Text file
-            logger.info("Processing text file")
-            html = f"<pre>{content}</pre>"
-        
-        success = convert_html_to_pdf(html, pdf_path, base_name)
-        
-        if success:
-            logger.info(f"PDF successfully created at {pdf_path}")
-            # Fix the URL generation - use direct path instead
-            return jsonify({
-                'success': True,
-                'pdf_url': f'/uploads/{pdf_filename}',
-                'filename': pdf_filename
-            })
+        if pdf_info and wants_download():
+            return pdf_download(pdf_info, pdf_bytes)
+        if pdf_info:
+            return jsonify({'success': True, **pdf_info})
         else:
-            logger.error("PDF conversion failed - see above logs for details")
             return jsonify({
                 'error': 'Failed to convert to PDF. See server logs for details.'
             }), 500
@@ -169,75 +263,8 @@ def convert_md_to_pdf():
         logger.error(f"PDF conversion error: {str(e)}\n{error_details}")
         return jsonify({'error': str(e)}), 500
 
-def convert_html_to_pdf(html_content, pdf_path, title="Document"):
-    """Helper function to convert HTML content to PDF - simplified for Unicode support"""
-    try:
-        from fpdf import FPDF
-        import re
-        
-        logger.info("Starting simplified Unicode-aware PDF conversion")
-        
-        # Remove HTML tags for simple text conversion
-        if html_content.startswith("<pre>") and html_content.endswith("</pre>"):
-            # It's pre-formatted text, just remove the tags
-            text = html_content[5:-6]  # Remove <pre> and </pre>
-        else:
-            # Simple HTML to text conversion
-            text = re.sub(r'<[^>]*>', '', html_content)
-        
-        # Try to save as plain text first (fallback)
-        txt_path = pdf_path.replace('.pdf', '.txt')
-        with open(txt_path, 'w', encoding='utf-8') as f:
-            f.write(text)
-        logger.info(f"Saved content as text file: {txt_path}")
-        
-        # Try a simple approach with standard fonts
-        try:
-            # Create PDF instance
-            pdf = FPDF()
-            pdf.add_page()
-            
-            # Set title
-            pdf.set_font("Arial", 'B', 16)
-            pdf.cell(0, 10, title, ln=True, align='C')
-            pdf.ln(10)
-            
-            # Process content safely
-            pdf.set_font("Arial", size=12)
-            
-            # Filter out problematic Unicode characters
-            filtered_text = ''.join(c for c in text if ord(c) < 128)
-            
-            # Split into lines and process each line
-            lines = filtered_text.split('\n')
-            for line in lines:
-                if line.strip():
-                    try:
-                        pdf.multi_cell(0, 10, line)
-                    except Exception as e:
-                        logger.warning(f"Skipping problematic line: {e}")
-                else:
-                    pdf.ln(5)
-            
-            # Output PDF
-            pdf.output(pdf_path)
-            logger.info(f"Successfully created PDF at {pdf_path}")
-            return True
-        except Exception as e:
-            logger.error(f"Basic PDF generation failed: {str(e)}")
-            logger.error(traceback.format_exc())
-            
-            # If we couldn't generate a PDF but have a text file, return False
-            # so the application can still provide the text file as a fallback
-            return False
-            
-    except Exception as e:
-        error_msg = f"PDF conversion error: {str(e)}"
-        logger.error(error_msg)
-        logger.error(traceback.format_exc())
-        return False
-
 @routes.route('/api/test-gemini')
+@admission_controlled('standard')
 def test_gemini():
     """Test endpoint to check if Gemini API is working"""
     if not is_api_key_valid():
@@ -246,7 +273,10 @@ def test_gemini():
         }), 500
     
     # Try a simple test prompt
-    test_result = generate_response("Say hello and confirm you're working")
+    try:
+        test_result = generate_response("Say hello and confirm you're working")
+    except LLMError as e:
+        return llm_error_response(e)
     
     return jsonify({
         'status': 'Gemini API test',
@@ -254,6 +284,34 @@ def test_gemini():
         'api_key_valid': is_api_key_valid()
     })
 
+@routes.route('/api/cache-stats')
+def cache_stats():
+    """Report hit/miss counters for the LLM response cache"""
+    stats = response_cache.stats()
+    stats['single_flight'] = inflight.stats()
+    stats.update(resilient_caller.stats())
+    return jsonify(stats)
+
+@routes.route('/api/scheduler-stats')
+def scheduler_stats():
+    """Report concurrency, queue depth and load-shedding counters"""
+    return jsonify(scheduler.stats())
+
+@routes.route('/api/job-stats')
+def job_stats():
+    """Report background job counts by status"""
+    return jsonify(dict(job_manager.stats(), context_folds=fold_jobs.stats()))
+
+@routes.route('/api/pdf-stats')
+def pdf_stats():
+    """Report renderer counters and PDF cache hit rate and size"""
+    return jsonify(dict(pdf_renderer.stats(), cache=pdf_cache.stats()))
+
+@routes.route('/api/db-diagnostics')
+def db_diagnostics():
+    """Explain the hot database queries and flag any collection scans"""
+    return jsonify(dict(db.stats(), queries=db.explain_hot_queries()))
+
 @routes.route('/api/sessions', methods=['GET'])
 def get_sessions():
     """Get all chat sessions"""
@@ -286,11 +344,13 @@ def update_session(session_id):
     })
 
 @routes.route('/api/chat', methods=['POST'])
+@admission_controlled('interactive')
 def chat():
     """Handle chat API requests"""
     data = request.json
     user_prompt = data.get('prompt', '')
     session_id = data.get('session_id')
+    teacher_id = data.get('teacher_id')
     
     if not user_prompt:
         return jsonify({'error': 'No prompt provided'}), 400
@@ -301,42 +361,242 @@ def chat():
             'error': 'API key not configured. Please set your Gemini API key in the .env file.'
         }), 500
     
+    # Route to a model configured with the teacher's prompt when one is selected
+    teacher = None
+    if teacher_id:
+        teacher = db.get_teacher(teacher_id)
+        if not teacher:
+            return jsonify({'error': 'Teacher not found'}), 404
+    
     # Create a new session if none provided
     if not session_id:
         session_id = db.create_new_session("New Chat")
     
+    # Assemble conversation context before the new message joins the history
+    model_prompt = context_assembler.build_prompt(session_id, user_prompt)
+    
     # Store user message in the session
     db.add_message(session_id, 'user', user_prompt)
     
-    # Generate response from Gemini
-    ai_response = generate_response(user_prompt)
+    # Generate response from Gemini - chat replies should never come from the cache
+    try:
+        ai_response = generate_response(model_prompt, use_cache=False, teacher=teacher,
+                                        endpoint='chat', hedge=HEDGE_CHAT_REQUESTS)
+    except LLMError as e:
+        # Errors are reported to the client but never stored as assistant messages
+        return llm_error_response(e)
     
     # Store AI response in the session
     db.add_message(session_id, 'assistant', ai_response)
+    fold_context_later(session_id)
     
     return jsonify({
         'response': ai_response,
         'session_id': session_id
     })
 
+def _fold_job(job, fold):
+    # Summaries queue behind interactive traffic for upstream capacity
+    with scheduler.admit('bulk'):
+        job.check_cancelled()
+        return fold()
+
+def fold_context_later(session_id):
+    """Update the session's rolling summary in the background so the reply is not held up by it"""
+    try:
+        context_assembler.fold_later(session_id, lambda fold: fold_jobs.submit('context-fold', _fold_job, fold))
+    except JobQueueFull as e:
+        # Still due, so the next turn queues it again
+        logger.warning(f"Deferred folding context for session {session_id}: {str(e)}")
+
+def _sse_event(payload, event=None):
+    """Format a payload as a single Server-Sent Events message"""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(payload)}\n\n"
+
+@routes.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Handle chat API requests, streaming the response as Server-Sent Events"""
+    data = request.json
+    user_prompt = data.get('prompt', '')
+    session_id = data.get('session_id')
+    teacher_id = data.get('teacher_id')
+    
+    if not user_prompt:
+        return jsonify({'error': 'No prompt provided'}), 400
+    
+    # Check if API key is configured
+    if not is_api_key_valid():
+        return jsonify({
+            'error': 'API key not configured. Please set your Gemini API key in the .env file.'
+        }), 500
+    
+    # Route to a model configured with the teacher's prompt when one is selected
+    teacher = None
+    if teacher_id:
+        teacher = db.get_teacher(teacher_id)
+        if not teacher:
+            return jsonify({'error': 'Teacher not found'}), 404
+    
+    # Create a new session if none provided
+    if not session_id:
+        session_id = db.create_new_session("New Chat")
+    
+    # Hold an interactive slot for as long as the stream is open
+    try:
+        scheduler.check_rate(client_id(), 'interactive')
+        scheduler.acquire('interactive')
+    except AdmissionRejected as e:
+        return llm_error_response(e)
+    
+    try:
+        # Assemble conversation context before the new message joins the history
+        model_prompt = context_assembler.build_prompt(session_id, user_prompt)
+        
+        # Store user message in the session
+        db.add_message(session_id, 'user', user_prompt)
+    except Exception:
+        scheduler.release()
+        raise
+    
+    def event_stream():
+        chunks = []
+        try:
+            yield _sse_event({'session_id': session_id}, event='start')
+            for chunk in generate_response_stream(model_prompt, teacher=teacher):
+                chunks.append(chunk)
+                yield _sse_event({'chunk': chunk})
+            yield _sse_event({'session_id': session_id}, event='done')
+        except LLMError as e:
+            yield _sse_event({'error': str(e), 'error_type': type(e).__name__}, event='error')
+        finally:
+            # Persist whatever was generated, even if the client disconnected mid-stream
+            if chunks:
+                db.add_message(session_id, 'assistant', ''.join(chunks))
+                fold_context_later(session_id)
+    
+    response = Response(
+        stream_with_context(event_stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Released when the response closes, even if the stream was never consumed
+    response.call_on_close(scheduler.release)
+    return response
+
 @routes.route('/api/history', methods=['GET'])
 def get_history():
-    """Get chat history for all sessions or a specific session"""
+    """Get chat history for all sessions or a specific session
+    
+    Pass limit and optionally before/after cursors to page through a session's history.
+    """
     session_id = request.args.get('session_id')
+    limit = request.args.get('limit', type=int)
+    before = request.args.get('before')
+    after = request.args.get('after')
+    
+    if session_id and (limit or before or after):
+        if before and after:
+            return jsonify({'error': 'Use either before or after, not both'}), 400
+        try:
+            page = db.get_chat_history_page(session_id, limit=limit or 50, before=before, after=after)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({
+            'history': page['messages'],
+            'session_id': session_id,
+            'has_more': page['has_more'],
+            'before': page['before_cursor'],
+            'after': page['after_cursor']
+        })
+    
     return jsonify({
-        'history': db.get_chat_history(session_id),
+        'history': db.get_chat_history(session_id, limit=limit),
         'session_id': session_id
     })
 
+@routes.route('/api/search', methods=['GET'])
+def search_history():
+    """Search chat messages by keyword
+    
+    Query params: q (required), session_id, limit and offset for paging.
+    """
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({'error': 'No search query provided'}), 400
+    page = db.search_messages(
+        query,
+        session_id=request.args.get('session_id'),
+        limit=request.args.get('limit', 20, type=int),
+        offset=request.args.get('offset', 0, type=int)
+    )
+    return jsonify(dict(page, query=query))
+
+@routes.route('/api/export', methods=['GET'])
+def export_history():
+    """Stream every teacher, session and message as NDJSON"""
+    filename = f"sahpaathi-export-{datetime.now():%Y%m%d-%H%M%S}.ndjson"
+    return Response(
+        stream_with_context(db.export_ndjson()),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+@routes.route('/api/import', methods=['POST'])
+def import_history():
+    """Load an NDJSON export sent as the request body
+    
+    Query params: batch_size, and resume_from (a line number from an earlier failed import's response).
+    """
+    progress = {'line': request.args.get('resume_from', 0, type=int)}
+
+    def checkpoint(line_number, counts):
+        progress['line'] = line_number
+    
+    try:
+        counts, complete = db.import_ndjson(
+            request.stream,
+            batch_size=max(1, request.args.get('batch_size', 1000, type=int)),
+            start_line=progress['line'],
+            on_checkpoint=checkpoint
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e), 'resume_from': progress['line']}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e), 'resume_from': progress['line']}), 503
+    except Exception as e:
+        logger.error(f"Import failed after line {progress['line']}: {e}")
+        return jsonify({'error': 'Import failed', 'resume_from': progress['line']}), 500
+    return jsonify({'success': True, 'counts': counts, 'complete': complete, 'lines': progress['line']})
+
 @routes.route('/api/clear', methods=['POST'])
 def clear_history():
     """Clear chat history for all sessions or a specific session"""
     data = request.json
     session_id = data.get('session_id')
-    db.clear_history(session_id)
+    try:
+        job = db.clear_history(session_id)
+    except JobQueueFull as e:
+        return jsonify({'error': f'Too many deletions in progress, please retry shortly ({str(e)})'}), 503
+    if job is None:
+        return jsonify({
+            'success': True
+        })
+    # Sessions are gone already; messages are deleted in the background
     return jsonify({
-        'success': True
-    })
+        'success': True,
+        'job_id': job.job_id,
+        'status': job.status,
+        'status_url': f'/api/clear/{job.job_id}'
+    }), 202
+
+@routes.route('/api/clear/<job_id>', methods=['GET'])
+def clear_history_status(job_id):
+    """Report the progress of a background history deletion"""
+    job = db.deletions.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    return jsonify(job.to_dict())
 
 # Teacher Management Routes
 @routes.route('/api/teachers', methods=['GET'])
@@ -395,6 +655,7 @@ def uploaded_file(filename):
     return send_from_directory(UPLOAD_FOLDER, filename)
 
 @routes.route('/api/generate-quiz', methods=['POST'])
+@admission_controlled('standard')
 def generate_quiz():
     """Generate a quiz based on chat history"""
     data = request.json
@@ -436,43 +697,42 @@ Ensure your response is ONLY the JSON object, with no additional text or explana
     
     try:
         # Generate response from the AI
-        raw_response = generate_response(prompt)
+        raw_response = generate_response(prompt, endpoint='quiz')
         
-        # Extract JSON from response (in case there's any extra text)
-        import re
-        import json
-        
-        # Look for JSON pattern in the response
-        json_match = re.search(r'({[\s\S]*})', raw_response)
-        if json_match:
-            json_str = json_match.group(1)
-            try:
-                quiz_data = json.loads(json_str)
-                return jsonify(quiz_data)
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse quiz JSON: {e}")
-                return jsonify({'error': 'Failed to generate valid quiz format'}), 500
-        else:
-            logger.error("No JSON found in response")
-            return jsonify({'error': 'Failed to generate quiz in correct format'}), 500
+        # Keep every well-formed question, even if the tail of the output is broken
+        questions = parse_quiz_text(raw_response)
+        if questions:
+            return jsonify({'quiz': questions})
+        logger.error("No valid quiz questions found in response")
+        return jsonify({'error': 'Failed to generate quiz in correct format'}), 500
             
+    except LLMError as e:
+        logger.error(f"Quiz generation error: {str(e)}")
+        return llm_error_response(e)
     except Exception as e:
         logger.error(f"Quiz generation error: {str(e)}")
         return jsonify({'error': f'Error generating quiz: {str(e)}'}), 500
 
-@routes.route('/generate-quiz', methods=['GET'])
-def generate_quiz_endpoint():
-    """Generate a quiz based on the current chat session"""
-    # Get the current session ID if available
-    session_id = request.args.get('session_id')
-    
+# Shown when the model's output contains no usable question at all
+FALLBACK_SESSION_QUIZ = {
+    "questions": [
+        {
+            "question": "What's a common challenge when working with AI models?",
+            "options": ["They never fail", "Output format inconsistency", "They're too slow", "They require no prompting"],
+            "correct": "Output format inconsistency"
+        }
+    ]
+}
+
+def build_session_quiz_prompt(session_id):
+    """Build the quiz prompt for a chat session; returns (prompt, error_response)"""
     if not session_id:
         # Try to find the most recent session
         all_sessions = db.get_all_sessions()
         if all_sessions and len(all_sessions) > 0:
             session_id = all_sessions[0]['session_id']
         else:
-            return jsonify({'error': 'No active session found'}), 400
+            return None, (jsonify({'error': 'No active session found'}), 400)
     
     # Get the chat history for this session
     chat_history = db.get_chat_history(session_id)
@@ -485,7 +745,7 @@ def generate_quiz_endpoint():
     
     # Ensure we have messages to work with
     if not messages:
-        return jsonify({'error': 'No messages found to generate quiz'}), 400
+        return None, (jsonify({'error': 'No messages found to generate quiz'}), 400)
     
     # Create a prompt to generate the quiz
     prompt = f"""Based on these questions/topics from the user: 
@@ -504,56 +764,84 @@ Format your response as a JSON object with this structure:
   ]
 }}
 Ensure your response is ONLY the JSON object, with no additional text or explanation."""
+    return prompt, None
+
+@routes.route('/generate-quiz', methods=['GET'])
+@admission_controlled('standard')
+def generate_quiz_endpoint():
+    """Generate a quiz based on the current chat session"""
+    prompt, error = build_session_quiz_prompt(request.args.get('session_id'))
+    if error:
+        return error
     
     logger.info(f"Generating quiz from prompt: {prompt[:100]}...")
     
     try:
         # Generate response from the AI
-        raw_response = generate_response(prompt)
+        raw_response = generate_response(prompt, endpoint='quiz')
         
-        # Extract JSON from response (in case there's any extra text)
-        import re
-        import json
+        # Keep every well-formed question, even if the tail of the output is broken
+        questions = parse_quiz_text(raw_response)
+        if questions:
+            return jsonify({'questions': questions})
         
-        # Look for JSON pattern in the response
-        json_match = re.search(r'({[\s\S]*})', raw_response)
-        if json_match:
-            json_str = json_match.group(1)
-            try:
-                quiz_data = json.loads(json_str)
-                
-                # Ensure it has the expected format
-                if "questions" not in quiz_data and "quiz" in quiz_data:
-                    # Handle alternate format if model returned "quiz" instead of "questions"
-                    quiz_data["questions"] = quiz_data["quiz"]
-                    del quiz_data["quiz"]
-                
-                return jsonify(quiz_data)
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse quiz JSON: {e}")
-                
-                # Fallback to a simple quiz if JSON parsing fails
-                return jsonify({
-                    "questions": [
-                        {
-                            "question": "What's a common challenge when working with AI models?",
-                            "options": ["They never fail", "Output format inconsistency", "They're too slow", "They require no prompting"],
-                            "correct": "Output format inconsistency"
-                        }
-                    ]
-                })
-        else:
-            logger.error("No JSON found in response")
-            return jsonify({'error': 'Failed to generate quiz in correct format'}), 500
+        # Fallback to a simple quiz if no question could be parsed
+        logger.error("No valid quiz questions found in response, using fallback quiz")
+        return jsonify(FALLBACK_SESSION_QUIZ)
             
+    except LLMError as e:
+        logger.error(f"Quiz generation error: {str(e)}")
+        return llm_error_response(e)
     except Exception as e:
         logger.error(f"Quiz generation error: {str(e)}")
         return jsonify({'error': f'Error generating quiz: {str(e)}'}), 500
 
+@routes.route('/generate-quiz/stream', methods=['GET'])
+def generate_quiz_stream():
+    """Generate a session quiz, pushing each question as Server-Sent Events as soon as it is complete"""
+    prompt, error = build_session_quiz_prompt(request.args.get('session_id'))
+    if error:
+        return error
+    
+    # Hold a standard slot for as long as the stream is open
+    try:
+        scheduler.check_rate(client_id(), 'standard')
+        scheduler.acquire('standard')
+    except AdmissionRejected as e:
+        return llm_error_response(e)
+    
+    def event_stream():
+        parser = QuizStreamParser()
+        try:
+            for chunk in generate_response_stream(prompt, endpoint='quiz'):
+                for question in parser.feed(chunk):
+                    yield _sse_event({'index': len(parser.questions) - 1, 'question': question}, event='question')
+            questions = parser.finish()
+            if not questions:
+                logger.error("No valid quiz questions found in streamed response, using fallback quiz")
+                for index, question in enumerate(FALLBACK_SESSION_QUIZ['questions']):
+                    yield _sse_event({'index': index, 'question': question}, event='question')
+            yield _sse_event({'count': len(questions) or len(FALLBACK_SESSION_QUIZ['questions'])}, event='done')
+        except LLMError as e:
+            yield _sse_event({'error': str(e), 'error_type': type(e).__name__,
+                              'count': len(parser.questions)}, event='error')
+    
+    response = Response(
+        stream_with_context(event_stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(scheduler.release)
+    return response
+
 @routes.route('/generate-syllabus-quiz', methods=['POST'])
 def generate_quiz_from_syllabus():
     """Generate a quiz based on syllabus text."""
     try:
+        # Charged once per request; every model call below holds its own scheduler slot,
+        # so a chunked quiz takes as many slots as it has calls in flight
+        scheduler.check_rate(client_id(), 'standard')
+        
         # First, log the raw request to debug
         logger.info(f"Received syllabus quiz request: Content-Type={request.content_type}")
         
@@ -575,6 +863,14 @@ def generate_quiz_from_syllabus():
         
         text = data.get('text')
         count = data.get('count', 5)  # Default to 5 questions instead of 10
+        try:
+            count = int(count)
+        except (TypeError, ValueError):
+            return jsonify({"error": "count must be a whole number"}), 400
+        if not 1 <= count <= MAX_QUESTIONS:
+            # Each question costs model output, and chunked quizzes fan out per chunk
+            return jsonify({"error": f"count must be between 1 and {MAX_QUESTIONS}"}), 400
+        fresh = bool(data.get('fresh', False))  # Skip the response cache when set
         
         # Log the text length to help diagnose issues
         text_length = len(text.strip()) if text else 0
@@ -585,6 +881,18 @@ def generate_quiz_from_syllabus():
             logger.error(f"Syllabus text too short: {text_length} characters")
             return jsonify({"error": "Syllabus text is too short (minimum 20 characters)"}), 400
         
+        # Large syllabi are split into chunks that are quizzed in parallel and merged
+        if data.get('mode') == 'map_reduce' or text_length > CHUNK_CHARS:
+            logger.info(f"Using chunked quiz generation for {text_length} characters")
+            result = generate_chunked_quiz(
+                text,
+                count,
+                with_slot('standard', lambda chunk_prompt: generate_response(chunk_prompt, use_cache=not fresh, endpoint='quiz'))
+            )
+            logger.info(f"Chunked quiz: {len(result['questions'])} questions from {result['chunks']} chunks "
+                        f"in {result['timings']['total_ms']}ms")
+            return jsonify(result)
+        
         # Generate the quiz using Gemini
         prompt = f"""
         Based on the following syllabus or study material, create a multiple-choice quiz with {count} questions.
@@ -616,76 +924,55 @@ def generate_quiz_from_syllabus():
         
         # Make API call to Gemini
         logger.info(f"Sending prompt to Gemini, length: {len(prompt)} characters")
-        generated_quiz = generate_response(prompt)
+        with scheduler.admit('standard'):
+            generated_quiz = generate_response(prompt, use_cache=not fresh, endpoint='quiz')
         logger.info(f"Received response from Gemini, length: {len(generated_quiz)} characters")
         
-        # Parse the JSON response
-        try:
-            # Try direct JSON parsing first
-            quiz_data = json.loads(generated_quiz)
-            logger.info("Successfully parsed JSON response directly")
-            return jsonify(quiz_data)
-        except json.JSONDecodeError as e:
-            logger.warning(f"JSON parsing failed: {e}, trying to extract JSON from text")
-            
-            # If the response isn't valid JSON, try to extract just the JSON part
-            match = re.search(r'({[\s\S]*})', generated_quiz, re.DOTALL)
-            if match:
-                try:
-                    json_str = match.group(1)
-                    quiz_data = json.loads(json_str)
-                    logger.info("Successfully extracted and parsed JSON from response")
-                    return jsonify(quiz_data)
-                except json.JSONDecodeError as e2:
-                    logger.error(f"Extracted JSON parsing failed: {e2}")
-            
-            # If all JSON parsing fails, create a simple fallback quiz
-            logger.error("All JSON parsing attempts failed, using fallback quiz")
-            return jsonify({
-                "questions": [
-                    {
-                        "question": "What can be challenging when working with AI-generated content?",
-                        "options": [
-                            "Getting consistent formatting", 
-                            "AI never makes mistakes", 
-                            "Processing is too fast", 
-                            "Files are too small"
-                        ],
-                        "correct": "Getting consistent formatting"
-                    }
-                ]
-            })
+        # Keep every well-formed question, even if the tail of the output is broken
+        questions = parse_quiz_text(generated_quiz)
+        if questions:
+            logger.info(f"Parsed {len(questions)} questions from response")
+            return jsonify({'questions': questions})
+        
+        # If no question could be parsed, create a simple fallback quiz
+        logger.error("No valid quiz questions found in response, using fallback quiz")
+        return jsonify({
+            "questions": [
+                {
+                    "question": "What can be challenging when working with AI-generated content?",
+                    "options": [
+                        "Getting consistent formatting", 
+                        "AI never makes mistakes", 
+                        "Processing is too fast", 
+                        "Files are too small"
+                    ],
+                    "correct": "Getting consistent formatting"
+                }
+            ]
+        })
     
+    except LLMError as e:
+        logger.error(f"Syllabus quiz generation error: {str(e)}")
+        return llm_error_response(e)
     except Exception as e:
         logger.error(f"Unexpected error in generate_quiz_from_syllabus: {str(e)}")
         logger.error(traceback.format_exc())
         return jsonify({"error": f"Server error: {str(e)}"}), 500
 
-@routes.route('/api/generate-question-paper', methods=['POST'])
-def generate_question_paper():
-    """Generate a question paper based on syllabus without PDF conversion"""
-    try:
-        data = request.json
-        if not data or 'syllabus' not in data:
-            return jsonify({'error': 'No syllabus provided'}), 400
-        
-        syllabus = data.get('syllabus', '')
-        question_count = data.get('questionCount', 10)
-        difficulty_level = data.get('difficultyLevel', 'medium')
-        session_id = data.get('sessionId', '')
-        
-        # Create the prompt for the AI
-        prompt = f"""Generate a previous year question paper with exactly {question_count} questions based on the following syllabus:
+def build_question_paper(syllabus, question_count, difficulty_level, fresh=False):
+    """Generate the full question paper text; raises LLMError when generation fails"""
+    # Create the prompt for the AI
+    prompt = f"""Generate a previous year question paper with exactly {question_count} questions based on the following syllabus:
 
 {syllabus}
 
 Each question should be numbered and have a clear answer. Difficulty level: {difficulty_level}. Just provide the questions and answers without any introduction or conclusion."""
-        
-        # Generate response from Gemini
-        ai_response = generate_response(prompt)
-        
-        # Create the paper header
-        paper_header = f"""# Practice Paper - {difficulty_level.capitalize()} Level
+    
+    # Generate response from Gemini
+    ai_response = generate_response(prompt, use_cache=not fresh, endpoint='paper')
+    
+    # Create the paper header
+    paper_header = f"""# Practice Paper - {difficulty_level.capitalize()} Level
 
 ## Syllabus Coverage
 {syllabus}
@@ -696,9 +983,26 @@ Each question should be numbered and have a clear answer. Difficulty level: {dif
 - All questions are compulsory
 
 """
+    
+    # Combine header and AI-generated questions
+    return paper_header + ai_response
+
+@routes.route('/api/generate-question-paper', methods=['POST'])
+@admission_controlled('bulk')
+def generate_question_paper():
+    """Generate a question paper based on syllabus without PDF conversion"""
+    try:
+        data = request.json
+        if not data or 'syllabus' not in data:
+            return jsonify({'error': 'No syllabus provided'}), 400
         
-        # Combine header and AI-generated questions
-        complete_content = paper_header + ai_response
+        syllabus = data.get('syllabus', '')
+        question_count = data.get('questionCount', 10)
+        difficulty_level = data.get('difficultyLevel', 'medium')
+        session_id = data.get('sessionId', '')
+        fresh = bool(data.get('fresh', False))  # Skip the response cache when set
+        
+        complete_content = build_question_paper(syllabus, question_count, difficulty_level, fresh)
         
         # Return the complete paper content
         return jsonify({
@@ -706,7 +1010,113 @@ Each question should be numbered and have a clear answer. Difficulty level: {dif
             'paperContent': complete_content
         })
         
+    except LLMError as e:
+        logger.error(f"Question paper generation error: {str(e)}")
+        return llm_error_response(e)
     except Exception as e:
         error_details = traceback.format_exc()
         logger.error(f"Question paper generation error: {str(e)}\n{error_details}")
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+# Background job routes: submit returns a job id right away, clients poll for the result
+def _job_accepted(job):
+    return jsonify({
+        'success': True,
+        'job_id': job.job_id,
+        'status': job.status,
+        'status_url': f'/api/jobs/{job.job_id}',
+        'result_url': f'/api/jobs/{job.job_id}/result'
+    }), 202
+
+def _submit_job(kind, fn, *args):
+    try:
+        return _job_accepted(job_manager.submit(kind, fn, *args))
+    except JobQueueFull as e:
+        response = jsonify({'error': f'Server is busy, please retry shortly ({str(e)})'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '10'
+        return response
+
+def _question_paper_job(job, syllabus, question_count, difficulty_level, fresh):
+    # Paper jobs still queue behind interactive traffic for upstream capacity
+    with scheduler.admit('bulk'):
+        job.check_cancelled()
+        return {'paperContent': build_question_paper(syllabus, question_count, difficulty_level, fresh)}
+
+def _pdf_job(job, render, *args):
+    job.check_cancelled()
+    # The file stays in the cache for the result URL, so the fresh bytes are not kept
+    pdf_info, _ = render(*args)
+    if not pdf_info:
+        raise RuntimeError('Failed to convert to PDF. See server logs for details.')
+    return pdf_info
+
+@routes.route('/api/jobs/question-paper', methods=['POST'])
+def submit_question_paper_job():
+    """Queue question paper generation and return a job id"""
+    data = request.json
+    if not data or 'syllabus' not in data:
+        return jsonify({'error': 'No syllabus provided'}), 400
+    try:
+        scheduler.check_rate(client_id(), 'bulk')
+    except AdmissionRejected as e:
+        return llm_error_response(e)
+    return _submit_job(
+        'question-paper',
+        _question_paper_job,
+        data.get('syllabus', ''),
+        data.get('questionCount', 10),
+        data.get('difficultyLevel', 'medium'),
+        bool(data.get('fresh', False))
+    )
+
+@routes.route('/api/jobs/convert-text-to-pdf', methods=['POST'])
+def submit_text_pdf_job():
+    """Queue text to PDF conversion and return a job id"""
+    data = request.json
+    if not data or 'text' not in data:
+        return jsonify({'error': 'No text provided'}), 400
+    return _submit_job('text-to-pdf', _pdf_job, render_text_to_pdf,
+                       data.get('text', ''), data.get('title', 'Document'))
+
+@routes.route('/api/jobs/convert-md-to-pdf', methods=['POST'])
+def submit_md_pdf_job():
+    """Queue Markdown/Text file to PDF conversion and return a job id"""
+    file, error = validate_document_upload()
+    if error:
+        return error
+    # The upload is read now; the request stream is gone by the time the job runs
+    content = file.read().decode('utf-8')
+    return _submit_job('md-to-pdf', _pdf_job, render_document_to_pdf, file.filename, content)
+
+@routes.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Get the status of a background job"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    return jsonify(job.to_dict())
+
+@routes.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """Get the result of a finished background job"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    if job.status == Job.SUCCEEDED:
+        return jsonify({'success': True, **job.result})
+    if job.status == Job.FAILED:
+        return jsonify({'error': job.error, 'status': job.status}), 500
+    if job.status == Job.CANCELLED:
+        return jsonify({'error': 'Job was cancelled', 'status': job.status}), 410
+    # Still queued or running
+    return jsonify({'status': job.status}), 202
+
+@routes.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a queued or running background job"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    cancelled = job_manager.cancel(job_id)
+    return jsonify({'success': cancelled, 'status': job_manager.get(job_id).status})
@@ -0,0 +1,186 @@
+# Admission control for SAHPAATHI's LLM-bound endpoints
+# Caps concurrent upstream work, orders waiting requests by priority class,
+# rate-limits each client with a token bucket and sheds load when queues fill.
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from resilience import LLMUnavailableError
+
+logger = logging.getLogger(__name__)
+
+# Lower number wins: interactive chat beats quizzes, which beat bulk paper generation
+PRIORITY_CLASSES = {
+    'interactive': 0,
+    'standard': 1,
+    'bulk': 2,
+}
+
+# Token-bucket cost of one request in each class
+CLASS_COSTS = {
+    'interactive': 1.0,
+    'standard': 2.0,
+    'bulk': 4.0,
+}
+
+class AdmissionRejected(LLMUnavailableError):
+    """The request was shed because the queue for its class is full or it waited too long"""
+    status_code = 503
+
+class RateLimited(AdmissionRejected):
+    """The client has used up its token bucket"""
+    status_code = 429
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, cost):
+        """Take cost tokens; return 0 on success or the seconds until enough are available"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate if self.rate > 0 else 60.0
+
+class PriorityScheduler:
+    def __init__(self, max_concurrent=8, queue_limits=None, max_wait=20.0,
+                 client_rate=0.5, client_burst=10.0, max_clients=10000):
+        """
+        Args:
+            max_concurrent (int): Upstream calls allowed at once across all classes
+            queue_limits (dict): Maximum waiting requests per priority class
+            max_wait (float): Seconds a request may wait for a slot before it is shed
+            client_rate (float): Tokens per second refilled into each client's bucket
+            client_burst (float): Bucket capacity per client
+            max_clients (int): Bucket entries kept before idle ones are pruned
+        """
+        self.max_concurrent = max_concurrent
+        self.queue_limits = queue_limits or {'interactive': 64, 'standard': 32, 'bulk': 8}
+        self.max_wait = max_wait
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.max_clients = max_clients
+
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._queued = {name: 0 for name in PRIORITY_CLASSES}
+        self._admitted = {name: 0 for name in PRIORITY_CLASSES}
+        self._shed = {name: 0 for name in PRIORITY_CLASSES}
+        self._rate_limited = 0
+
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+
+    def check_rate(self, client_id, priority_class):
+        """Charge the client's token bucket, raising RateLimited when it is empty"""
+        if not client_id or self.client_rate <= 0:
+            return
+        with self._buckets_lock:
+            bucket = self._buckets.get(client_id)
+            if bucket is None:
+                if len(self._buckets) >= self.max_clients:
+                    self._prune_buckets()
+                bucket = self._buckets[client_id] = TokenBucket(self.client_rate, self.client_burst)
+            wait_seconds = bucket.take(CLASS_COSTS.get(priority_class, 1.0))
+        if wait_seconds:
+            with self._cond:
+                self._rate_limited += 1
+            raise RateLimited("Too many requests, please slow down", retry_after=wait_seconds)
+
+    def _prune_buckets(self):
+        """Drop buckets idle long enough to have refilled completely; caller holds the lock"""
+        now = time.monotonic()
+        refill_time = self.client_burst / self.client_rate
+        for key in [k for k, b in self._buckets.items() if now - b.updated >= refill_time]:
+            del self._buckets[key]
+        if len(self._buckets) >= self.max_clients:
+            self._buckets.clear()
+
+    def acquire(self, priority_class):
+        """Block until a slot is free for this class, or raise AdmissionRejected"""
+        priority = PRIORITY_CLASSES[priority_class]
+        with self._cond:
+            if self._active < self.max_concurrent and not self._waiting:
+                self._active += 1
+                self._admitted[priority_class] += 1
+                return
+            if self._queued[priority_class] >= self.queue_limits.get(priority_class, 0):
+                self._shed[priority_class] += 1
+                raise AdmissionRejected("Server is busy, please retry shortly", retry_after=self._retry_after())
+
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            self._queued[priority_class] += 1
+            deadline = time.monotonic() + self.max_wait
+            try:
+                while not (self._active < self.max_concurrent and self._waiting[0] == entry):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._waiting.remove(entry)
+                        heapq.heapify(self._waiting)
+                        self._shed[priority_class] += 1
+                        self._cond.notify_all()
+                        raise AdmissionRejected("Server is busy, please retry shortly", retry_after=self._retry_after())
+                    self._cond.wait(remaining)
+                heapq.heappop(self._waiting)
+                self._active += 1
+                self._admitted[priority_class] += 1
+                # The next waiter may be able to run too
+                self._cond.notify_all()
+            finally:
+                self._queued[priority_class] -= 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def admit(self, priority_class, client_id=None):
+        """Rate-limit the client, then hold a slot for the duration of the block"""
+        self.check_rate(client_id, priority_class)
+        self.acquire(priority_class)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _retry_after(self):
+        # Rough hint: one queue's worth of work spread across the available slots
+        return max(1.0, self.max_wait * len(self._waiting) / max(self.max_concurrent, 1))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'active': self._active,
+                'max_concurrent': self.max_concurrent,
+                'queued': dict(self._queued),
+                'admitted': dict(self._admitted),
+                'shed': dict(self._shed),
+                'rate_limited': self._rate_limited
+            }
+
+# Shared scheduler configured from the environment
+scheduler = PriorityScheduler(
+    max_concurrent=int(os.getenv("LLM_MAX_CONCURRENT", "8")),
+    queue_limits={
+        'interactive': int(os.getenv("LLM_QUEUE_INTERACTIVE", "64")),
+        'standard': int(os.getenv("LLM_QUEUE_STANDARD", "32")),
+        'bulk': int(os.getenv("LLM_QUEUE_BULK", "8")),
+    },
+    max_wait=float(os.getenv("LLM_QUEUE_MAX_WAIT_SECONDS", "20")),
+    client_rate=float(os.getenv("CLIENT_RATE_PER_SECOND", "0.5")),
+    client_burst=float(os.getenv("CLIENT_BURST", "10"))
+)
@@ -0,0 +1,130 @@
+# Full-text search helpers for chat history
+# Tokenising, snippets and an incremental in-process inverted index (BM25 ranked),
+# used by the memory backend and for ranking messages inside MongoDB buckets.
+import math
+import re
+import threading
+from collections import defaultdict
+
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have i in is it its of on or that the this to was were what when "
+    "where which who why will with you your".split()
+)
+SNIPPET_CHARS = 160
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    """Lowercased word tokens without stopwords or single characters"""
+    return [t for t in _TOKEN.findall((text or '').lower()) if len(t) > 1 and t not in STOPWORDS]
+
+def make_snippet(content, terms, width=SNIPPET_CHARS):
+    """A window of content around the first matching term, with ellipses where it was cut"""
+    lowered = content.lower()
+    positions = [lowered.find(term) for term in terms]
+    positions = [p for p in positions if p >= 0]
+    start = max(0, min(positions) - width // 3) if positions else 0
+    end = min(len(content), start + width)
+    start = max(0, end - width)
+    snippet = content[start:end].strip()
+    return ('…' if start > 0 else '') + snippet + ('…' if end < len(content) else '')
+
+def score_documents(query_terms, documents, k1=1.2, b=0.75):
+    """
+    BM25-score an ad-hoc list of (doc_id, text) pairs against query_terms.
+
+    Returns [(score, doc_id)] for documents matching at least one term, best first.
+    """
+    tokenized = [(doc_id, tokenize(text)) for doc_id, text in documents]
+    if not tokenized:
+        return []
+    avg_length = sum(len(tokens) for _, tokens in tokenized) / len(tokenized) or 1
+    doc_freq = defaultdict(int)
+    for _, tokens in tokenized:
+        for term in set(tokens) & set(query_terms):
+            doc_freq[term] += 1
+    scored = []
+    for doc_id, tokens in tokenized:
+        counts = defaultdict(int)
+        for token in tokens:
+            counts[token] += 1
+        score = 0.0
+        for term in query_terms:
+            tf = counts.get(term, 0)
+            if tf:
+                idf = math.log(1 + (len(tokenized) - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+                score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(tokens) / avg_length))
+        if score > 0:
+            scored.append((score, doc_id))
+    scored.sort(key=lambda item: item[0], reverse=True)
+    return scored
+
+class InvertedIndex:
+    """Term -> {doc_id: term frequency}, updated as messages are added and removed"""
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = defaultdict(dict)
+        self._lengths = {}             # doc_id -> token count
+        self._sessions = {}            # doc_id -> session_id
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def add(self, doc_id, session_id, text):
+        tokens = tokenize(text)
+        counts = defaultdict(int)
+        for token in tokens:
+            counts[token] += 1
+        with self._lock:
+            for token, count in counts.items():
+                self._postings[token][doc_id] = count
+            self._lengths[doc_id] = len(tokens)
+            self._sessions[doc_id] = session_id
+            self._total_length += len(tokens)
+
+    def remove(self, doc_id, text):
+        """Remove a document; text must be what was indexed so its postings can be found"""
+        with self._lock:
+            if doc_id not in self._lengths:
+                return
+            for token in set(tokenize(text)):
+                postings = self._postings.get(token)
+                if postings is not None:
+                    postings.pop(doc_id, None)
+                    if not postings:
+                        del self._postings[token]
+            self._total_length -= self._lengths.pop(doc_id)
+            self._sessions.pop(doc_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._lengths.clear()
+            self._sessions.clear()
+            self._total_length = 0
+
+    def search(self, query, session_id=None):
+        """[(score, doc_id)] for documents matching any query term, best first"""
+        terms = set(tokenize(query))
+        with self._lock:
+            count = len(self._lengths)
+            if not terms or not count:
+                return []
+            avg_length = self._total_length / count or 1
+            scores = defaultdict(float)
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    if session_id and self._sessions.get(doc_id) != session_id:
+                        continue
+                    length = self._lengths[doc_id]
+                    scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avg_length))
+        return sorted(((score, doc_id) for doc_id, score in scores.items()), key=lambda item: item[0], reverse=True)
+
+    def stats(self):
+        with self._lock:
+            return {'documents': len(self._lengths), 'terms': len(self._postings)}
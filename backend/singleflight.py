@@ -0,0 +1,70 @@
+# Request coalescing for SAHPAATHI
+# Concurrent callers asking for the same key share one in-flight call instead
+# of each issuing their own upstream request.
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class SingleFlightTimeout(TimeoutError):
+    """Raised when a waiter gives up on an in-flight call"""
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn, timeout=None):
+        """
+        Run fn() once per key at a time, sharing its result with concurrent callers.
+
+        Args:
+            key (str): Identifies equivalent calls
+            fn (callable): The work to run when no call for key is in flight
+            timeout (float): Seconds a waiter will wait for the leader's result
+
+        Returns the result of fn(), or re-raises the exception fn() raised, for
+        the leader and for every waiter alike.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            logger.info(f"Joining in-flight call for key {key[:12]}")
+            if not call.done.wait(timeout):
+                raise SingleFlightTimeout(f"Timed out after {timeout}s waiting for in-flight call")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """Return the number of in-flight keys and how many calls were coalesced"""
+        with self._lock:
+            return {'in_flight': len(self._calls), 'coalesced': self.coalesced}
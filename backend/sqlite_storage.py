@@ -0,0 +1,519 @@
+# SQLite storage backend for SAHPAATHI
+# Durable local storage without a MongoDB server. WAL mode lets several worker
+# processes share one database file; each thread gets its own connection, closed when the thread exits.
+import logging
+import os
+import sqlite3
+import threading
+import weakref
+from datetime import datetime
+from storage import ChatStorage, EMPTY_SESSION_STATS, message_preview
+from search_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sahpaathi.db"))
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        context_summary TEXT,
+        context_until TEXT,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        total_chars INTEGER NOT NULL DEFAULT 0,
+        last_role TEXT,
+        last_message_preview TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        import_id TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS teachers (
+        teacher_id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        prompt TEXT NOT NULL,
+        is_custom INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )""",
+    # history / page / since: filter by session, sort by time
+    "CREATE INDEX IF NOT EXISTS messages_session_ts ON messages (session_id, timestamp, id)",
+    # Capped unscoped history sorts every message by time
+    "CREATE INDEX IF NOT EXISTS messages_ts ON messages (timestamp, id)",
+    # get_sessions: newest first
+    "CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)",
+    # get_teachers sorts by name
+    "CREATE INDEX IF NOT EXISTS teachers_name ON teachers (name)",
+]
+
+# Session summary columns added after the first release: (name, declaration)
+SESSION_STATS_COLUMNS = [
+    ('message_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('total_chars', 'INTEGER NOT NULL DEFAULT 0'),
+    ('last_role', 'TEXT'),
+    ('last_message_preview', 'TEXT'),
+]
+
+# Full-text search: an FTS5 index over messages.content, kept in step by triggers
+FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+]
+
+def _ts(value):
+    # Fixed width so text order matches time order
+    return value.isoformat(timespec='microseconds') if value is not None else None
+
+def _dt(value):
+    return datetime.fromisoformat(value) if value is not None else None
+
+class _ThreadConnection:
+    """Holds one thread's connection; the thread-local drops it when the thread exits"""
+    __slots__ = ('conn', '__weakref__')
+
+    def __init__(self, conn):
+        self.conn = conn
+
+class SQLiteChatStorage(ChatStorage):
+    name = 'sqlite'
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        # Live per-thread connections, for close() and stats; exited threads drop out on their own
+        self._connections = weakref.WeakSet()
+        conn = self._conn()
+        with conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            # Databases created before the summary columns existed get them added
+            existing = {row['name'] for row in conn.execute("PRAGMA table_info(sessions)")}
+            for column, declaration in SESSION_STATS_COLUMNS:
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE sessions ADD COLUMN {column} {declaration}")
+            if 'import_id' not in {row['name'] for row in conn.execute("PRAGMA table_info(messages)")}:
+                conn.execute("ALTER TABLE messages ADD COLUMN import_id TEXT")
+            # Lets a resumed import skip the messages it already wrote
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS messages_import_id ON messages (import_id) "
+                         "WHERE import_id IS NOT NULL")
+        self.full_text = self._create_fts(conn)
+        logger.info(f"SQLite storage ready at {path}")
+
+    def _create_fts(self, conn):
+        """Create the FTS5 index, filling it from existing messages the first time"""
+        try:
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+            with conn:
+                for statement in FTS_SCHEMA:
+                    conn.execute(statement)
+                if not exists:
+                    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            return True
+        except sqlite3.OperationalError as e:
+            # Some SQLite builds lack FTS5; search falls back to a LIKE scan
+            logger.warning(f"SQLite full-text search unavailable: {e}")
+            return False
+
+    def _conn(self):
+        """This thread's connection, opened on first use"""
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            # sqlite3 keeps compiled statements per connection, so the fixed SQL below is prepared once
+            conn = sqlite3.connect(self.path, timeout=5.0, cached_statements=256, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            holder = _ThreadConnection(conn)
+            # Request threads are short-lived; close the connection once its thread is gone
+            weakref.finalize(holder, conn.close)
+            self._local.holder = holder
+            self._connections.add(holder)
+        return holder.conn
+
+    def close(self):
+        for holder in list(self._connections):
+            holder.conn.close()
+        self._local = threading.local()
+
+    # Sessions
+
+    @staticmethod
+    def _session(row):
+        return {
+            'session_id': row['session_id'],
+            'name': row['name'],
+            'created_at': _dt(row['created_at']),
+            'updated_at': _dt(row['updated_at']),
+            'message_count': row['message_count'],
+            'total_chars': row['total_chars'],
+            'last_role': row['last_role'],
+            'last_message_preview': row['last_message_preview']
+        }
+
+    def create_session(self, session):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO sessions (session_id, name, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (session['session_id'], session['name'], _ts(session['created_at']), _ts(session['updated_at']))
+            )
+
+    def get_sessions(self):
+        rows = self._conn().execute(
+            "SELECT session_id, name, created_at, updated_at, message_count, total_chars, last_role, "
+            "last_message_preview FROM sessions ORDER BY updated_at DESC"
+        ).fetchall()
+        return [self._session(row) for row in rows]
+
+    def rename_session(self, session_id, name):
+        with self._conn() as conn:
+            cursor = conn.execute(
+                "UPDATE sessions SET name = ?, updated_at = ? WHERE session_id = ?",
+                (name, _ts(datetime.now()), session_id)
+            )
+        return cursor.rowcount > 0
+
+    def get_context(self, session_id):
+        row = self._conn().execute(
+            "SELECT context_summary, context_until FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None or row['context_summary'] is None:
+            return None
+        return {'summary': row['context_summary'], 'summarized_until': _dt(row['context_until'])}
+
+    def set_context(self, session_id, context):
+        with self._conn() as conn:
+            conn.execute(
+                "UPDATE sessions SET context_summary = ?, context_until = ? WHERE session_id = ?",
+                (context['summary'], _ts(context['summarized_until']), session_id)
+            )
+
+    # Messages
+
+    @staticmethod
+    def _message(row):
+        return {'role': row['role'], 'content': row['content'], 'timestamp': _dt(row['timestamp'])}
+
+    def add_message(self, session_id, role, content, timestamp):
+        # Insert, session bump and summary update commit together
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO messages (session_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                (session_id, role, content, _ts(timestamp))
+            )
+            conn.execute(
+                "UPDATE sessions SET updated_at = ?, message_count = message_count + 1, "
+                "total_chars = total_chars + ?, last_role = ?, last_message_preview = ? WHERE session_id = ?",
+                (_ts(timestamp), len(content), role, message_preview(content), session_id)
+            )
+
+    def history(self, session_id=None, limit=None):
+        conn = self._conn()
+        if session_id and limit:
+            rows = conn.execute(
+                "SELECT role, content, timestamp FROM messages WHERE session_id = ? "
+                "ORDER BY timestamp DESC, id DESC LIMIT ?", (session_id, limit)
+            ).fetchall()[::-1]
+        elif session_id:
+            rows = conn.execute(
+                "SELECT role, content, timestamp FROM messages WHERE session_id = ? ORDER BY timestamp, id",
+                (session_id,)
+            ).fetchall()
+        elif limit:
+            rows = conn.execute(
+                "SELECT role, content, timestamp FROM messages ORDER BY timestamp DESC, id DESC LIMIT ?", (limit,)
+            ).fetchall()[::-1]
+        else:
+            rows = conn.execute("SELECT role, content, timestamp FROM messages ORDER BY timestamp, id").fetchall()
+        return [self._message(row) for row in rows]
+
+    def page(self, session_id, limit, cursor_value=None, newer=False):
+        conn = self._conn()
+        order = "ASC" if newer else "DESC"
+        if cursor_value:
+            op = ">" if newer else "<"
+            timestamp = _ts(cursor_value[0])
+            rows = conn.execute(
+                f"SELECT id, role, content, timestamp FROM messages WHERE session_id = ? "
+                f"AND (timestamp {op} ? OR (timestamp = ? AND id {op} ?)) "
+                f"ORDER BY timestamp {order}, id {order} LIMIT ?",
+                (session_id, timestamp, timestamp, int(cursor_value[1]), limit + 1)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                f"SELECT id, role, content, timestamp FROM messages WHERE session_id = ? "
+                f"ORDER BY timestamp {order}, id {order} LIMIT ?",
+                (session_id, limit + 1)
+            ).fetchall()
+        has_more = len(rows) > limit
+        rows = [dict(self._message(row), tiebreak=row['id']) for row in rows[:limit]]
+        if not newer:
+            rows.reverse()
+        return rows, has_more
+
+    def since(self, session_id, since=None):
+        rows = self._conn().execute(
+            "SELECT role, content, timestamp FROM messages WHERE session_id = ? AND timestamp > ? "
+            "ORDER BY timestamp, id",
+            (session_id, _ts(since) if since is not None else '')
+        ).fetchall()
+        return [self._message(row) for row in rows]
+
+    def search(self, query, session_id=None, limit=20, offset=0):
+        terms = tokenize(query)
+        if not terms:
+            return [], False
+        session_filter = "AND m.session_id = ? " if session_id else ""
+        params = [session_id] if session_id else []
+        if self.full_text:
+            # Quote each term so user input is never parsed as FTS query syntax
+            match = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+            rows = self._conn().execute(
+                "SELECT m.session_id, m.role, m.content, m.timestamp, bm25(messages_fts) AS rank "
+                "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                f"WHERE messages_fts MATCH ? {session_filter}ORDER BY rank LIMIT ? OFFSET ?",
+                [match] + params + [limit + 1, offset]
+            ).fetchall()
+            # bm25() is lower for better matches
+            scores = [-row['rank'] for row in rows]
+        else:
+            like = " OR ".join("m.content LIKE ?" for _ in terms)
+            rows = self._conn().execute(
+                f"SELECT m.session_id, m.role, m.content, m.timestamp FROM messages m WHERE ({like}) "
+                f"{session_filter}ORDER BY m.timestamp DESC LIMIT ? OFFSET ?",
+                [f"%{term}%" for term in terms] + params + [limit + 1, offset]
+            ).fetchall()
+            scores = [1.0] * len(rows)
+        results = [
+            dict(self._message(row), session_id=row['session_id'], score=score)
+            for row, score in zip(rows[:limit], scores)
+        ]
+        return results, len(rows) > limit
+
+    def clear(self, session_id=None):
+        with self._conn() as conn:
+            if session_id:
+                deleted = conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,)).rowcount
+                conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            else:
+                deleted = conn.execute("DELETE FROM messages").rowcount
+                conn.execute("DELETE FROM sessions")
+        return deleted
+
+    # Retention and chunked deletion
+
+    def expired_sessions(self, cutoff=None, keep_newest=None, limit=100):
+        conn = self._conn()
+        ids = []
+        if cutoff is not None:
+            ids += [row[0] for row in conn.execute(
+                "SELECT session_id FROM sessions WHERE updated_at < ? ORDER BY updated_at LIMIT ?", (_ts(cutoff), limit)
+            )]
+        if keep_newest:
+            ids += [row[0] for row in conn.execute(
+                "SELECT session_id FROM sessions ORDER BY updated_at DESC LIMIT ? OFFSET ?", (limit, keep_newest)
+            )]
+        return list(dict.fromkeys(ids))[:limit]
+
+    def delete_sessions(self, session_ids=None):
+        with self._conn() as conn:
+            if session_ids is None:
+                return conn.execute("DELETE FROM sessions").rowcount
+            return conn.executemany(
+                "DELETE FROM sessions WHERE session_id = ?", [(session_id,) for session_id in session_ids]
+            ).rowcount
+
+    def sessions_with_messages_before(self, before):
+        # A range on messages_ts covering only the expired rows
+        return [row[0] for row in self._conn().execute(
+            "SELECT DISTINCT session_id FROM messages WHERE timestamp < ?", (_ts(before),)
+        )]
+
+    def delete_messages(self, session_id=None, before=None, limit=1000):
+        conditions, params = [], []
+        if session_id:
+            conditions.append("session_id = ?")
+            params.append(session_id)
+        if before is not None:
+            conditions.append("timestamp < ?")
+            params.append(_ts(before))
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        # The oldest rows first, through messages_session_ts or messages_ts, so each chunk is a short range scan
+        with self._conn() as conn:
+            return conn.execute(
+                f"DELETE FROM messages WHERE id IN (SELECT id FROM messages {where}ORDER BY timestamp, id LIMIT ?)",
+                params + [limit]
+            ).rowcount
+
+    # Teachers
+
+    @staticmethod
+    def _teacher(row):
+        return {
+            'teacher_id': row['teacher_id'],
+            'name': row['name'],
+            'prompt': row['prompt'],
+            'is_custom': bool(row['is_custom']),
+            'created_at': _dt(row['created_at']),
+            'updated_at': _dt(row['updated_at'])
+        }
+
+    def count_teachers(self):
+        return self._conn().execute("SELECT COUNT(*) FROM teachers").fetchone()[0]
+
+    def create_teacher(self, teacher):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO teachers (teacher_id, name, prompt, is_custom, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (teacher['teacher_id'], teacher['name'], teacher['prompt'], int(teacher['is_custom']),
+                 _ts(teacher['created_at']), _ts(teacher['updated_at']))
+            )
+
+    def get_teacher(self, teacher_id):
+        row = self._conn().execute("SELECT * FROM teachers WHERE teacher_id = ?", (teacher_id,)).fetchone()
+        return self._teacher(row) if row else None
+
+    def get_teachers(self):
+        return [self._teacher(row) for row in self._conn().execute("SELECT * FROM teachers ORDER BY name")]
+
+    def update_teacher_prompt(self, teacher_id, prompt, updated_at):
+        with self._conn() as conn:
+            cursor = conn.execute(
+                "UPDATE teachers SET prompt = ?, updated_at = ? WHERE teacher_id = ?",
+                (prompt, _ts(updated_at), teacher_id)
+            )
+        return cursor.rowcount > 0
+
+    def delete_teacher(self, teacher_id):
+        # Only custom teachers can be deleted
+        with self._conn() as conn:
+            cursor = conn.execute("DELETE FROM teachers WHERE teacher_id = ? AND is_custom = 1", (teacher_id,))
+        return cursor.rowcount > 0
+
+    def rebuild_session_stats(self, session_ids=None):
+        conn = self._conn()
+        conn.create_function('message_preview', 1, message_preview, deterministic=True)
+        where, params = "", []
+        if session_ids is not None:
+            session_ids = list(session_ids)
+            if not session_ids:
+                return 0
+            where = f" WHERE session_id IN ({', '.join('?' * len(session_ids))})"
+            params = session_ids
+        # Each subquery is a range on messages_session_ts
+        with conn:
+            return conn.execute(
+                """UPDATE sessions SET
+                    message_count = (SELECT COUNT(*) FROM messages m WHERE m.session_id = sessions.session_id),
+                    total_chars = (SELECT COALESCE(SUM(LENGTH(m.content)), 0) FROM messages m
+                                   WHERE m.session_id = sessions.session_id),
+                    last_role = (SELECT m.role FROM messages m WHERE m.session_id = sessions.session_id
+                                 ORDER BY m.timestamp DESC, m.id DESC LIMIT 1),
+                    last_message_preview = (SELECT message_preview(m.content) FROM messages m
+                                            WHERE m.session_id = sessions.session_id
+                                            ORDER BY m.timestamp DESC, m.id DESC LIMIT 1)""" + where,
+                params
+            ).rowcount
+
+    # Export / import
+
+    def export_sessions(self):
+        # Iterating the cursor fetches rows as they are consumed
+        for row in self._conn().execute("SELECT * FROM sessions ORDER BY updated_at"):
+            session = self._session(row)
+            if row['context_summary'] is not None:
+                session['context'] = {'summary': row['context_summary'], 'summarized_until': _dt(row['context_until'])}
+            yield session
+
+    def export_messages(self):
+        for row in self._conn().execute(
+            "SELECT session_id, role, content, timestamp FROM messages ORDER BY session_id, timestamp, id"
+        ):
+            yield dict(self._message(row), session_id=row['session_id'])
+
+    def export_teachers(self):
+        for row in self._conn().execute("SELECT * FROM teachers ORDER BY name"):
+            yield self._teacher(row)
+
+    def import_sessions(self, sessions):
+        rows = []
+        for s in sessions:
+            context = s.get('context') or {}
+            stats = {key: s.get(key) or default for key, default in EMPTY_SESSION_STATS.items()}
+            rows.append((s['session_id'], s['name'], _ts(s['created_at']), _ts(s['updated_at']),
+                         context.get('summary'), _ts(context.get('summarized_until')), stats['message_count'],
+                         stats['total_chars'], stats['last_role'], stats['last_message_preview']))
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sessions (session_id, name, created_at, updated_at, context_summary, "
+                "context_until, message_count, total_chars, last_role, last_message_preview) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def import_messages(self, messages):
+        # One transaction per batch; the FTS trigger indexes each row as it goes in
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT INTO messages (session_id, role, content, timestamp, import_id) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (import_id) WHERE import_id IS NOT NULL DO NOTHING",
+                [(m['session_id'], m['role'], m['content'], _ts(m['timestamp']), m.get('import_id'))
+                 for m in messages]
+            )
+
+    def import_teachers(self, teachers):
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO teachers (teacher_id, name, prompt, is_custom, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(t['teacher_id'], t['name'], t['prompt'], int(t['is_custom']), _ts(t['created_at']),
+                  _ts(t['updated_at'])) for t in teachers]
+            )
+
+    # Maintenance
+
+    def ping(self):
+        self._conn().execute("SELECT 1").fetchone()
+        return True
+
+    def explain_hot_queries(self, session_id="explain-probe"):
+        """Run EXPLAIN QUERY PLAN on the hot queries and flag full table scans"""
+        hot_queries = {
+            'get_chat_history': ("SELECT role, content, timestamp FROM messages WHERE session_id = ? "
+                                 "ORDER BY timestamp, id", (session_id,)),
+            'get_all_sessions': ("SELECT session_id FROM sessions ORDER BY updated_at DESC", ()),
+            'update_session_name': ("SELECT name FROM sessions WHERE session_id = ?", (session_id,)),
+            'add_message': ("SELECT updated_at FROM sessions WHERE session_id = ?", (session_id,)),
+        }
+        report = {}
+        for name, (sql, params) in hot_queries.items():
+            try:
+                details = [row['detail'] for row in self._conn().execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+                # "SCAN table" without an index is SQLite's collection scan
+                scan = any(d.startswith('SCAN') and 'USING' not in d for d in details)
+                report[name] = {'stages': details, 'collscan': scan}
+                if scan:
+                    logger.warning(f"{name} query scans a whole table")
+            except Exception as e:
+                report[name] = {'error': str(e)}
+        return report
+
+    def stats(self):
+        conn = self._conn()
+        return {
+            'path': self.path,
+            'journal_mode': conn.execute("PRAGMA journal_mode").fetchone()[0],
+            'connections': len(self._connections)
+        }
@@ -0,0 +1,179 @@
+# Storage backend interface for SAHPAATHI
+# ChatDatabase (db.py) delegates to one of these: MongoDB, SQLite or in-memory.
+# Backends raise on failure; ChatDatabase decides whether to fall back or return a default.
+
+# Characters of the newest message kept on its session for the sidebar
+PREVIEW_CHARS = 120
+
+# Summary fields of a session with no messages
+EMPTY_SESSION_STATS = {'message_count': 0, 'total_chars': 0, 'last_role': None, 'last_message_preview': None}
+
+def message_preview(content):
+    """The start of a message on one line, as stored in a session's last_message_preview"""
+    return ' '.join((content or '').split())[:PREVIEW_CHARS]
+
+class ChatStorage:
+    """
+    Interface every chat storage backend implements.
+
+    Sessions and teachers are plain dicts with datetime created_at / updated_at.
+    Sessions also carry summary fields that add_message keeps current: message_count,
+    total_chars, last_role and last_message_preview (see message_preview).
+    Messages are dicts with 'role', 'content' and 'timestamp', always oldest first.
+    """
+    name = None
+    # Lazy backends connect in the background; ChatDatabase serves from memory until ping() succeeds
+    lazy = False
+
+    # Sessions
+    def create_session(self, session):
+        raise NotImplementedError
+
+    def get_sessions(self):
+        """All sessions, most recently updated first, without their context"""
+        raise NotImplementedError
+
+    def rename_session(self, session_id, name):
+        """Returns False if the session does not exist"""
+        raise NotImplementedError
+
+    def get_context(self, session_id):
+        """The session's rolling summary dict, or None"""
+        raise NotImplementedError
+
+    def set_context(self, session_id, context):
+        raise NotImplementedError
+
+    # Messages
+    def add_message(self, session_id, role, content, timestamp):
+        """Store a message and, in the same write, bump the session's updated_at and summary fields"""
+        raise NotImplementedError
+
+    def history(self, session_id=None, limit=None):
+        """A session's (or every session's) messages; only the newest `limit` if given"""
+        raise NotImplementedError
+
+    def page(self, session_id, limit, cursor_value=None, newer=False):
+        """
+        One keyset page. cursor_value is (timestamp, tiebreak) from a row of an earlier page.
+
+        Returns (rows, has_more); rows carry 'timestamp' and 'tiebreak' for the next cursor.
+        """
+        raise NotImplementedError
+
+    def since(self, session_id, since=None):
+        """A session's messages strictly newer than since"""
+        raise NotImplementedError
+
+    def search(self, query, session_id=None, limit=20, offset=0):
+        """
+        Full-text search over messages, best match first.
+
+        Returns (rows, has_more); rows have 'session_id', 'role', 'content', 'timestamp' and 'score'.
+        """
+        raise NotImplementedError
+
+    def clear(self, session_id=None):
+        """Delete a session and its messages (or everything); returns the messages removed"""
+        raise NotImplementedError
+
+    # Teachers
+    def count_teachers(self):
+        raise NotImplementedError
+
+    def create_teacher(self, teacher):
+        raise NotImplementedError
+
+    def get_teacher(self, teacher_id):
+        raise NotImplementedError
+
+    def get_teachers(self):
+        """All teachers sorted by name"""
+        raise NotImplementedError
+
+    def update_teacher_prompt(self, teacher_id, prompt, updated_at):
+        """Returns False if the teacher does not exist"""
+        raise NotImplementedError
+
+    def delete_teacher(self, teacher_id):
+        """Delete a custom teacher; built-in teachers are kept. Returns False if nothing was deleted"""
+        raise NotImplementedError
+
+    # Retention and chunked deletion
+    # True when the backend itself expires messages and sessions past the retention age (MongoDB TTL indexes)
+    expires_by_ttl = False
+
+    def expired_sessions(self, cutoff=None, keep_newest=None, limit=100):
+        """Ids of up to limit sessions last updated before cutoff or beyond the newest keep_newest"""
+        raise NotImplementedError
+
+    def delete_sessions(self, session_ids=None):
+        """
+        Delete sessions (or every session) but not necessarily their messages; returns the sessions removed.
+
+        Messages are removed separately with delete_messages, a chunk at a time.
+        """
+        raise NotImplementedError
+
+    def delete_messages(self, session_id=None, before=None, limit=1000):
+        """
+        Delete up to about limit of the oldest messages older than before; returns the number removed.
+
+        Session summary fields are not adjusted; rebuild_session_stats recomputes them.
+        """
+        raise NotImplementedError
+
+    def sessions_with_messages_before(self, before):
+        """Ids of the sessions holding messages older than before, i.e. those an age-based delete_messages touches"""
+        raise NotImplementedError
+
+    def rebuild_session_stats(self, session_ids=None):
+        """Recompute the summary fields of session_ids (default every session) from their messages; returns the sessions updated"""
+        raise NotImplementedError
+
+    # Export / import: iterators stream from the backend, imports write one batch at a time
+    def export_sessions(self):
+        """Every session, least recently updated first, with its 'context' if it has one"""
+        raise NotImplementedError
+
+    def export_messages(self):
+        """Every message with its 'session_id', grouped by session and oldest first within one"""
+        raise NotImplementedError
+
+    def export_teachers(self):
+        raise NotImplementedError
+
+    def import_sessions(self, sessions):
+        """Insert or replace sessions (keyed by session_id), context included"""
+        raise NotImplementedError
+
+    def import_messages(self, messages):
+        """
+        Append messages (dicts with 'session_id') without touching their sessions' updated_at or summary.
+
+        A message may carry an 'import_id' (24 hex digits); one whose import_id is already
+        stored is skipped, so a resumed import can safely repeat a batch.
+        """
+        raise NotImplementedError
+
+    def import_teachers(self, teachers):
+        """Insert or replace teachers (keyed by teacher_id)"""
+        raise NotImplementedError
+
+    # Maintenance
+    def ping(self):
+        """Return True if the backend is reachable; may raise instead of returning False"""
+        return True
+
+    def flush(self):
+        """Write out anything buffered; returns False if the write failed"""
+        return True
+
+    def explain_hot_queries(self):
+        return {'error': f'explain is not available for {self.name} storage'}
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
@@ -0,0 +1,314 @@
+# Conformance checks shared by every ChatStorage backend
+# Runs the same scenarios against memory, SQLite and (when reachable) MongoDB, so a
+# backend change that breaks ordering, pagination, concurrent appends, search,
+# export/import, retention, session summaries or teacher rules shows up here.
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from storage import message_preview
+
+def _session(name):
+    now = datetime.now()
+    return {'session_id': str(uuid.uuid4()), 'name': name, 'created_at': now, 'updated_at': now}
+
+def _teacher(name, is_custom):
+    now = datetime.now()
+    return {'teacher_id': str(uuid.uuid4()), 'name': name, 'prompt': f"You are {name}.",
+            'is_custom': is_custom, 'created_at': now, 'updated_at': now}
+
+def check_sessions(storage):
+    first, second = _session("first"), _session("second")
+    storage.create_session(first)
+    storage.create_session(second)
+    storage.add_message(first['session_id'], 'user', 'hello', datetime.now() + timedelta(seconds=1))
+    order = [s['session_id'] for s in storage.get_sessions()]
+    assert order[:2] == [first['session_id'], second['session_id']], "sessions are not newest first"
+    assert storage.rename_session(second['session_id'], "renamed")
+    assert not storage.rename_session(str(uuid.uuid4()), "missing")
+    assert storage.get_context(first['session_id']) is None
+    until = datetime.now()
+    storage.set_context(first['session_id'], {'summary': 'so far', 'summarized_until': until})
+    context = storage.get_context(first['session_id'])
+    assert context['summary'] == 'so far'
+    assert abs((context['summarized_until'] - until).total_seconds()) < 0.01
+
+def check_messages(storage):
+    session = _session("messages")
+    storage.create_session(session)
+    sid = session['session_id']
+    base = datetime.now()
+    # Two messages share a timestamp, so ordering relies on the tie-breaker
+    stamps = [base, base + timedelta(seconds=1), base + timedelta(seconds=1), base + timedelta(seconds=2)]
+    for i, stamp in enumerate(stamps):
+        storage.add_message(sid, 'user' if i % 2 == 0 else 'assistant', f"m{i}", stamp)
+    assert [m['content'] for m in storage.history(sid)] == ['m0', 'm1', 'm2', 'm3']
+    assert [m['content'] for m in storage.history(sid, 2)] == ['m2', 'm3']
+    assert [m['content'] for m in storage.since(sid, base)] == ['m1', 'm2', 'm3']
+    assert [m['content'] for m in storage.since(sid)] == ['m0', 'm1', 'm2', 'm3']
+    assert 'm0' in [m['content'] for m in storage.history(None, 1000)]
+
+    rows, has_more = storage.page(sid, 3)
+    assert [r['content'] for r in rows] == ['m1', 'm2', 'm3'] and has_more
+    older, has_more = storage.page(sid, 3, (rows[0]['timestamp'], rows[0]['tiebreak']))
+    assert [r['content'] for r in older] == ['m0'] and not has_more
+    newer, has_more = storage.page(sid, 2, (older[0]['timestamp'], older[0]['tiebreak']), newer=True)
+    assert [r['content'] for r in newer] == ['m1', 'm2'] and has_more
+
+    assert storage.clear(sid) == 4
+    assert storage.history(sid) == []
+    assert sid not in [s['session_id'] for s in storage.get_sessions()]
+
+def check_concurrent_appends(storage, writers=8, per_writer=25):
+    session = _session("concurrent")
+    storage.create_session(session)
+    sid = session['session_id']
+    start = threading.Barrier(writers)
+
+    def write(writer):
+        start.wait()
+        for i in range(per_writer):
+            storage.add_message(sid, 'user', f"w{writer}-{i}", datetime.now())
+
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    storage.flush()
+    everything = [m['content'] for m in storage.history(sid)]
+    assert sorted(everything) == sorted(f"w{w}-{i}" for w in range(writers) for i in range(per_writer)), \
+        "concurrent appends lost or duplicated messages"
+    for writer in range(writers):
+        mine = [c for c in everything if c.startswith(f"w{writer}-")]
+        assert mine == [f"w{writer}-{i}" for i in range(per_writer)], "one writer's messages are out of order"
+    assert [m['content'] for m in storage.history(sid, 30)] == everything[-30:]
+    # Walking back page by page must visit every message once, in history order
+    walked, cursor = [], None
+    while True:
+        rows, has_more = storage.page(sid, 7, cursor)
+        walked[:0] = [r['content'] for r in rows]
+        if not has_more:
+            break
+        cursor = (rows[0]['timestamp'], rows[0]['tiebreak'])
+    assert walked == everything, "paging back does not match history"
+
+def check_search(storage):
+    session, other = _session("search"), _session("search elsewhere")
+    storage.create_session(session)
+    storage.create_session(other)
+    sid = session['session_id']
+    # A made-up word, so messages left by other checks never match
+    word = f"quasar{uuid.uuid4().hex[:8]}"
+    base = datetime.now()
+    storage.add_message(sid, 'user', f"{word} {word} orbit", base)
+    storage.add_message(sid, 'assistant', "nothing relevant here", base + timedelta(seconds=1))
+    storage.add_message(sid, 'user', f"{word} appears once in this much longer message about orbits",
+                        base + timedelta(seconds=2))
+    storage.add_message(other['session_id'], 'user', f"{word} in another session", base + timedelta(seconds=3))
+
+    rows, has_more = storage.search(word, sid)
+    assert len(rows) == 2 and not has_more, "search did not find exactly the matching messages"
+    assert all(row['session_id'] == sid for row in rows), "search ignored session_id"
+    assert all({'role', 'content', 'timestamp', 'score'} <= set(row) for row in rows)
+    scores = [row['score'] for row in rows]
+    assert scores == sorted(scores, reverse=True), "search results are not best match first"
+    assert len(storage.search(word)[0]) == 3
+    first, has_more = storage.search(word, limit=2)
+    assert len(first) == 2 and has_more
+    rest, has_more = storage.search(word, limit=2, offset=2)
+    assert len(rest) == 1 and not has_more
+    assert storage.search(f"missing{uuid.uuid4().hex[:8]}") == ([], False)
+
+    storage.clear(sid)
+    storage.clear(other['session_id'])
+    assert storage.search(word) == ([], False), "cleared messages are still searchable"
+
+def check_export_import(storage):
+    session = _session("export")
+    storage.create_session(session)
+    sid = session['session_id']
+    base = datetime.now()
+    for i, stamp in enumerate([base, base + timedelta(seconds=1), base + timedelta(seconds=1)]):
+        storage.add_message(sid, 'user' if i % 2 == 0 else 'assistant', f"m{i}", stamp)
+    storage.set_context(sid, {'summary': 'so far', 'summarized_until': base})
+    teacher = _teacher("Export Tutor", True)
+    storage.create_teacher(teacher)
+
+    sessions = [s for s in storage.export_sessions() if s['session_id'] == sid]
+    messages = [m for m in storage.export_messages() if m['session_id'] == sid]
+    teachers = [t for t in storage.export_teachers() if t['teacher_id'] == teacher['teacher_id']]
+    assert len(sessions) == 1 and sessions[0]['context']['summary'] == 'so far'
+    assert [m['content'] for m in messages] == ['m0', 'm1', 'm2'], "export is not oldest first"
+    assert len(teachers) == 1
+
+    storage.clear(sid)
+    storage.delete_teacher(teacher['teacher_id'])
+    # Increasing import_ids, as chat_transfer assigns them, so timestamp ties keep their order
+    prefix = uuid.uuid4().hex[:16]
+    messages = [dict(m, import_id=f"{prefix}{i:08x}") for i, m in enumerate(messages)]
+    storage.import_sessions(sessions)
+    storage.import_messages(messages[:2])
+    storage.import_teachers(teachers)
+    # A resumed import repeats the batch it was writing; keyed records are replaced, not duplicated
+    storage.import_sessions(sessions)
+    storage.import_messages(messages)
+    storage.import_teachers(teachers)
+
+    assert [s['session_id'] for s in storage.get_sessions()].count(sid) == 1
+    assert [m['content'] for m in storage.history(sid)] == ['m0', 'm1', 'm2']
+    assert storage.get_context(sid)['summary'] == 'so far'
+    assert storage.get_teacher(teacher['teacher_id'])['prompt'] == teacher['prompt']
+    assert [t['teacher_id'] for t in storage.export_teachers()].count(teacher['teacher_id']) == 1
+
+    storage.clear(sid)
+    storage.delete_teacher(teacher['teacher_id'])
+
+def check_retention(storage):
+    now = datetime.now()
+    old, older = now - timedelta(days=9), now - timedelta(days=10)
+    cutoff = now - timedelta(days=5)
+    stale, staler, mixed = _session("stale"), _session("staler"), _session("mixed")
+    stale.update(created_at=old, updated_at=old)
+    staler.update(created_at=older, updated_at=older)
+    for session in (stale, staler, mixed):
+        storage.create_session(session)
+    # import_messages leaves updated_at alone, so these sessions keep their ages
+    storage.import_messages([{'session_id': staler['session_id'], 'role': 'user', 'content': f"s{i}",
+                              'timestamp': older + timedelta(minutes=i)} for i in range(5)])
+    storage.import_messages([{'session_id': mixed['session_id'], 'role': 'user', 'content': f"x{i}",
+                              'timestamp': older + timedelta(minutes=i)} for i in range(3)])
+    storage.import_messages([{'session_id': mixed['session_id'], 'role': 'user', 'content': 'recent',
+                              'timestamp': now}])
+
+    assert set(storage.sessions_with_messages_before(cutoff)) == {staler['session_id'], mixed['session_id']}
+    assert storage.expired_sessions(cutoff) == [staler['session_id'], stale['session_id']], \
+        "expired sessions are not oldest first"
+    assert storage.expired_sessions(cutoff, limit=1) == [staler['session_id']]
+    everyone = len(storage.get_sessions())
+    assert set(storage.expired_sessions(keep_newest=everyone - 2)) == {staler['session_id'], stale['session_id']}
+
+    assert storage.delete_messages(mixed['session_id'], None, 2) == 2
+    assert [m['content'] for m in storage.history(mixed['session_id'])] == ['x2', 'recent'], \
+        "delete_messages did not remove the oldest first"
+    assert storage.delete_messages(None, cutoff, 1000) == 6
+    assert storage.history(staler['session_id']) == []
+    assert [m['content'] for m in storage.history(mixed['session_id'])] == ['recent']
+    assert storage.sessions_with_messages_before(cutoff) == []
+
+    assert storage.delete_sessions([staler['session_id'], stale['session_id']]) == 2
+    remaining = [s['session_id'] for s in storage.get_sessions()]
+    assert staler['session_id'] not in remaining and stale['session_id'] not in remaining
+    storage.clear(mixed['session_id'])
+
+def _listed(storage, session_id):
+    return next(s for s in storage.get_sessions() if s['session_id'] == session_id)
+
+def check_session_summary(storage):
+    session = _session("summary")
+    storage.create_session(session)
+    sid = session['session_id']
+    listed = _listed(storage, sid)
+    assert (listed['message_count'], listed['total_chars'], listed['last_role'], listed['last_message_preview']) \
+        == (0, 0, None, None), "a new session does not have empty summary fields"
+
+    base = datetime.now()
+    long_reply = "Photosynthesis\n  turns light into  chemical energy. " * 10
+    storage.add_message(sid, 'user', "What is photosynthesis?", base)
+    storage.add_message(sid, 'assistant', long_reply, base + timedelta(seconds=1))
+    listed = _listed(storage, sid)
+    assert listed['message_count'] == 2
+    assert listed['total_chars'] == len("What is photosynthesis?") + len(long_reply)
+    assert listed['last_role'] == 'assistant'
+    assert listed['last_message_preview'] == message_preview(long_reply)
+
+    # Imported messages leave the summary alone until it is rebuilt
+    storage.import_messages([{'session_id': sid, 'role': 'user', 'content': 'Thanks',
+                              'timestamp': base + timedelta(seconds=2)}])
+    assert _listed(storage, sid)['message_count'] == 2
+    assert storage.rebuild_session_stats([sid]) == 1
+    listed = _listed(storage, sid)
+    assert (listed['message_count'], listed['last_role'], listed['last_message_preview']) == (3, 'user', 'Thanks')
+    assert listed['total_chars'] == len("What is photosynthesis?") + len(long_reply) + len('Thanks')
+    assert storage.rebuild_session_stats([]) == 0
+    storage.rebuild_session_stats()
+    assert _listed(storage, sid)['message_count'] == 3, "a full rebuild disagrees with a targeted one"
+    storage.clear(sid)
+
+def check_teachers(storage):
+    builtin, custom = _teacher("Aardvark Tutor", False), _teacher("Zebra Tutor", True)
+    before = storage.count_teachers()
+    storage.create_teacher(custom)
+    storage.create_teacher(builtin)
+    assert storage.count_teachers() == before + 2
+    names = [t['name'] for t in storage.get_teachers()]
+    assert names == sorted(names), "teachers are not sorted by name"
+    assert storage.get_teacher(custom['teacher_id'])['is_custom'] is True
+    assert storage.get_teacher(str(uuid.uuid4())) is None
+    assert storage.update_teacher_prompt(custom['teacher_id'], "New prompt", datetime.now())
+    assert storage.get_teacher(custom['teacher_id'])['prompt'] == "New prompt"
+    assert not storage.update_teacher_prompt(str(uuid.uuid4()), "x", datetime.now())
+    assert not storage.delete_teacher(builtin['teacher_id']), "built-in teachers must not be deleted"
+    assert storage.delete_teacher(custom['teacher_id'])
+    assert storage.get_teacher(custom['teacher_id']) is None
+
+CHECKS = [check_sessions, check_messages, check_concurrent_appends, check_search, check_export_import, check_retention,
+          check_session_summary, check_teachers]
+
+def run_checks(storage):
+    """Run every check against a backend; returns the number of failures"""
+    failures = 0
+    for check in CHECKS:
+        try:
+            check(storage)
+            print(f"  ok    {check.__name__}")
+        except Exception as e:
+            failures += 1
+            print(f"  FAIL  {check.__name__}: {e!r}")
+    return failures
+
+def open_backends(names, mongo_uri):
+    for name in names:
+        if name == 'memory':
+            from memory_store import InMemoryChatStore
+            yield name, InMemoryChatStore(), None
+        elif name == 'sqlite':
+            from sqlite_storage import SQLiteChatStorage
+            directory = tempfile.mkdtemp()
+            yield name, SQLiteChatStorage(os.path.join(directory, 'conformance.db')), None
+        elif name in ('mongodb', 'mongodb-bucketed'):
+            from mongo_storage import MongoChatStorage
+            database = f"sahpaathi_conformance_{uuid.uuid4().hex[:8]}"
+            try:
+                if name == 'mongodb':
+                    storage = MongoChatStorage(uri=mongo_uri, database=database, durability='sync', layout='document')
+                else:
+                    # Small buckets, so the checks cross many bucket boundaries
+                    storage = MongoChatStorage(uri=mongo_uri, database=database, durability='sync',
+                                               layout='bucketed', bucket_size=4)
+                storage.ping()
+            except Exception as e:
+                print(f"mongodb: skipped ({e})")
+                continue
+            yield name, storage, lambda: storage.client.drop_database(database)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the storage conformance checks')
+    parser.add_argument('--backends', type=str, default='memory,sqlite,mongodb',
+                        help='Comma-separated backends; mongodb-bucketed also runs MongoDB with the bucketed layout, '
+                             'whose retention deletes whole buckets and so fails check_retention')
+    parser.add_argument('--mongo-uri', type=str, default='mongodb://localhost:27017/', help='MongoDB connection string')
+    args = parser.parse_args()
+
+    total = 0
+    for name, storage, cleanup in open_backends(args.backends.split(','), args.mongo_uri):
+        print(f"{name}:")
+        total += run_checks(storage)
+        if cleanup:
+            cleanup()
+        storage.close()
+    sys.exit(1 if total else 0)
@@ -1,7 +1,10 @@
 import os
-import google.generativeai as genai
+import time
 from dotenv import load_dotenv
 import logging
+import hashlib
+import threading
+from collections import OrderedDict
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -10,12 +13,23 @@ logger = logging.getLogger(__name__)
 # Load environment variables from .env file
 load_dotenv()
 
+# Imported after load_dotenv so the cache picks up its settings from .env
+from llm_cache import response_cache, make_cache_key
+from singleflight import SingleFlight, SingleFlightTimeout
+from llm_backends import load_backend
+from resilience import resilient_caller, deadline_for, is_transient, LLMError, LLMTimeoutError, LLMUpstreamError
+
+# Shared across request threads so identical concurrent prompts make one upstream call
+inflight = SingleFlight()
+INFLIGHT_WAIT_SECONDS = float(os.getenv("LLM_INFLIGHT_WAIT_SECONDS", "120"))
+
 # Get the API key from environment variables
 api_key = os.getenv("GOOGLE_API_KEY")  # Changed from gemini_api_key to GOOGLE_API_KEY
 logger.info(f"API key loaded: {'Successfully loaded' if api_key else 'Failed to load'}")
 
-# Set up Gemini API
-genai.configure(api_key=api_key)
+# Set up the LLM backend (Gemini by default, "stub" for offline load testing)
+MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash")
+backend = load_backend(os.getenv("LLM_BACKEND", "gemini"), api_key=api_key, model_name=MODEL_NAME)
 
 # Try to read instruction file if it exists
 instruction = "You are SAHPAATHI, an AI assistant designed to help students with their studies."
@@ -30,25 +44,148 @@ except FileNotFoundError:
 
 # Initialize the model (1.5 flash is fast and efficient)
 try:
-    model = genai.GenerativeModel("gemini-1.5-flash", system_instruction=instruction)
+    model = backend.create_model(instruction)
     logger.info("Model initialized successfully")
 except Exception as e:
     logger.error(f"Error initializing model: {str(e)}")
     model = None
 
-def generate_response(prompt):
+class ModelPool:
+    """Bounded LRU pool of per-teacher models keyed by teacher id and prompt version"""
+
+    def __init__(self, max_models=16):
+        self.max_models = max_models
+        self._models = OrderedDict()  # (teacher_id, prompt_version) -> (model, system_instruction)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def prompt_version(prompt):
+        return hashlib.sha1((prompt or '').encode('utf-8')).hexdigest()[:12]
+
+    def get(self, teacher):
+        """Return (model, system_instruction) configured with the teacher's prompt"""
+        key = (teacher['teacher_id'], self.prompt_version(teacher.get('prompt')))
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+
+        system_instruction = f"{instruction}\n\n{teacher.get('prompt', '')}".strip()
+        teacher_model = backend.create_model(system_instruction)
+        logger.info(f"Initialized model for teacher {teacher['teacher_id']}")
+        with self._lock:
+            self._models[key] = (teacher_model, system_instruction)
+            self._models.move_to_end(key)
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+            return self._models[key]
+
+    def invalidate(self, teacher_id):
+        """Drop every pooled model built for this teacher"""
+        with self._lock:
+            for key in [k for k in self._models if k[0] == teacher_id]:
+                del self._models[key]
+        logger.info(f"Invalidated pooled models for teacher {teacher_id}")
+
+model_pool = ModelPool(max_models=int(os.getenv("TEACHER_MODEL_POOL_SIZE", "16")))
+
+def get_model(teacher=None):
+    """Return (model, system_instruction) for a teacher record, or the default model"""
+    if teacher:
+        return model_pool.get(teacher)
+    return model, instruction
+
+def generate_response(prompt, use_cache=True, teacher=None, endpoint='default', hedge=False):
     """
-    Generate a response from the Gemini model based on the provided prompt.
+    Generate a response from the configured LLM backend based on the provided prompt.
+    
+    Args:
+        prompt (str): The prompt to send to the model
+        use_cache (bool): Serve identical prompts from the response cache; pass False
+            for endpoints that need fresh output
+        teacher (dict): Optional teacher record whose prompt configures the model
+        endpoint (str): Selects the deadline budget ('chat', 'quiz', 'paper' or 'default')
+        hedge (bool): Send a duplicate request if the first one is slow
+    
+    Raises:
+        LLMError: LLMTimeoutError, LLMUnavailableError or LLMUpstreamError on failure
     """
     try:
-        # Generate a response using the model
-        response = model.generate_content(prompt)
-        logger.info("Response generated successfully")
-        return response.text
+        active_model, system_instruction = get_model(teacher)
     except Exception as e:
+        logger.error(f"Error initializing teacher model: {str(e)}")
+        raise LLMUpstreamError(f"Could not initialize model: {str(e)}") from e
+    deadline = deadline_for(endpoint)
+    cache_key = make_cache_key(f"{backend.name}:{backend.model_name}", system_instruction, prompt)
+    if use_cache:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Response served from cache")
+            return cached
+    def call_model():
+        # Generate a response using the model, within the endpoint's deadline
+        text = resilient_caller.call(lambda timeout: active_model.generate(prompt, timeout=timeout), deadline, hedge=hedge)
+        logger.info("Response generated successfully")
+        # Fresh responses still refresh the cache so later cached calls benefit
+        response_cache.set(cache_key, text)
+        return text
+
+    try:
+        if use_cache:
+            # Concurrent callers with the same prompt wait on a single upstream call
+            wait_seconds = max(0.0, min(INFLIGHT_WAIT_SECONDS, deadline - time.monotonic()))
+            return inflight.do(cache_key, call_model, timeout=wait_seconds)
+        return call_model()
+    except SingleFlightTimeout as e:
         logger.error(f"Error generating response: {str(e)}")
-        return f"Error generating response: {str(e)}"
+        raise LLMTimeoutError(str(e)) from e
+    except LLMError as e:
+        logger.error(f"Error generating response: {str(e)}")
+        raise
+
+def generate_response_stream(prompt, teacher=None, endpoint='chat'):
+    """
+    Stream a response from the configured LLM backend, yielding text chunks as they arrive.
+    
+    Raises LLMError subclasses like generate_response. The upstream request is bounded by
+    the deadline, which is also checked between chunks, and the circuit breaker sees the
+    outcome of every stream. Streams count against the same call limit as generate_response.
+    """
+    with resilient_caller.slot():
+        yield from _stream_within_deadline(prompt, teacher, deadline_for(endpoint))
+
+def _stream_within_deadline(prompt, teacher, deadline):
+    breaker = resilient_caller.breaker
+    breaker.before_call()
+    try:
+        active_model, _ = get_model(teacher)
+        for text in active_model.stream(prompt, timeout=deadline - time.monotonic()):
+            if time.monotonic() > deadline:
+                raise LLMTimeoutError("Streaming response exceeded its deadline")
+            yield text
+    except GeneratorExit:
+        # The client went away; that says nothing about upstream health, but a
+        # half-open probe slot taken above must be given back
+        breaker.release()
+        raise
+    except LLMError as e:
+        breaker.record_failure()
+        logger.error(f"Error streaming response: {str(e)}")
+        raise
+    except Exception as e:
+        if is_transient(e):
+            breaker.record_failure()
+        else:
+            # Only errors that say the upstream is unhealthy count against the breaker
+            breaker.release()
+        logger.error(f"Error streaming response: {str(e)}")
+        if isinstance(e, TimeoutError) or type(e).__name__ == 'DeadlineExceeded':
+            # The upstream request hit the timeout derived from the deadline
+            raise LLMTimeoutError("Streaming response exceeded its deadline") from e
+        raise LLMUpstreamError(f"LLM request failed: {str(e)}") from e
+    breaker.record_success()
+    logger.info("Streamed response generated successfully")
 
 def is_api_key_valid():
     """Check if the API key is valid and configured properly"""
-    return api_key is not None and model is not None
\ No newline at end of file
+    return backend.is_configured() and model is not None
\ No newline at end of file
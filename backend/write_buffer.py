@@ -0,0 +1,185 @@
+# Write-behind buffer for chat messages
+# Collects message inserts and session updated_at bumps and writes them to
+# MongoDB in batches, off the request path.
+import logging
+import threading
+import uuid
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from storage import message_preview
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+# Ids of the latest bumps applied to a session, kept so a retried bump is recognised
+APPLIED_BUMPS_KEPT = 16
+
+class _SessionBump:
+    """What a batch of messages changes on one session document"""
+    __slots__ = ('bump_id', 'updated_at', 'count', 'chars', 'last')
+
+    def __init__(self):
+        self.bump_id = uuid.uuid4().hex
+        self.updated_at = None
+        self.count = 0
+        self.chars = 0
+        self.last = None  # the newest message
+
+    def add(self, message):
+        self.count += 1
+        self.chars += len(message['content'])
+        if self.updated_at is None or message['timestamp'] >= self.updated_at:
+            self.updated_at = message['timestamp']
+            self.last = message
+
+    def write(self, session_id):
+        """
+        The UpdateOne for the session, safe to retry.
+
+        It records bump_id on the session and matches nothing once bump_id is there, so a
+        bump that MongoDB applied before an error is not counted again.
+        """
+        update = session_update(self.updated_at, self.count, self.chars, self.last)
+        update['$push'] = {'applied_bumps': {'$each': [self.bump_id], '$slice': -APPLIED_BUMPS_KEPT}}
+        return UpdateOne({'session_id': session_id, 'applied_bumps': {'$ne': self.bump_id}}, update)
+
+def session_update(updated_at, count, chars, last):
+    """
+    Bump a session's updated_at and summary fields after count messages, the newest being last.
+
+    $max keeps a later bump from being overwritten by an older one; $inc keeps concurrent writers additive.
+    """
+    return {
+        '$max': {'updated_at': updated_at},
+        '$inc': {'message_count': count, 'total_chars': chars},
+        '$set': {'last_role': last['role'], 'last_message_preview': message_preview(last['content'])},
+    }
+
+class MessageWriteBuffer:
+    def __init__(self, chats, chat_sessions, max_batch=100, flush_interval=0.5, max_pending=10000,
+                 message_store=None):
+        """
+        Args:
+            chats: The chats collection
+            chat_sessions: The chat_sessions collection
+            max_batch (int): Flush as soon as this many messages are waiting
+            flush_interval (float): Flush at least this often, in seconds
+            max_pending (int): Messages kept for retry while MongoDB is failing
+            message_store (BucketedMessageStore): Write messages here instead of into chats
+        """
+        self.chats = chats
+        self.chat_sessions = chat_sessions
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.message_store = message_store
+        self._messages = []
+        self._bumps = {}  # session_id -> _SessionBump still collecting messages
+        # (session_id, _SessionBump) from failed flushes; never merged, so each keeps its bump_id
+        self._retry_bumps = []
+        # Set when a failed batch is requeued: some of its messages may already be stored
+        self._retrying = False
+        self._lock = threading.Lock()
+        # Serialises flushes so batches reach MongoDB in order
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self.flushed_batches = 0
+        self.flushed_messages = 0
+        self.dropped_messages = 0
+        self._thread = threading.Thread(target=self._run, name='message-write-buffer', daemon=True)
+        self._thread.start()
+
+    def add(self, message):
+        """Queue a message; its session's updated_at and summary are bumped in the same batch"""
+        # A stable id, so a retried batch can tell which messages an earlier attempt stored
+        message.setdefault('_id', ObjectId())
+        with self._lock:
+            self._messages.append(message)
+            self._bumps.setdefault(message['session_id'], _SessionBump()).add(message)
+            full = len(self._messages) >= self.max_batch
+        if full:
+            self._wake.set()
+
+    def has_pending(self, session_id=None):
+        with self._lock:
+            if session_id is None:
+                return bool(self._messages or self._bumps or self._retry_bumps)
+            return session_id in self._bumps or any(sid == session_id for sid, _ in self._retry_bumps)
+
+    def flush(self):
+        """Write everything queued so far; returns False if MongoDB rejected the batch"""
+        with self._flush_lock:
+            with self._lock:
+                messages, self._messages = self._messages, []
+                bumps = self._retry_bumps + list(self._bumps.items())
+                self._retry_bumps, self._bumps = [], {}
+                retrying, self._retrying = self._retrying, False
+            if not messages and not bumps:
+                return True
+            try:
+                if messages:
+                    self._insert(messages, retrying)
+                if bumps:
+                    self.chat_sessions.bulk_write([bump.write(sid) for sid, bump in bumps], ordered=False)
+            except Exception as e:
+                logger.error(f"Error flushing {len(messages)} buffered messages to MongoDB: {e}")
+                self._requeue(messages, bumps)
+                return False
+            self.flushed_batches += 1
+            self.flushed_messages += len(messages)
+            return True
+
+    def _insert(self, messages, retrying=False):
+        """Insert a batch; messages already stored by an earlier attempt are skipped"""
+        if self.message_store is not None:
+            # Bucket pushes are not idempotent, so a retried batch is checked against what is stored
+            self.message_store.append_many(messages, skip_applied=retrying)
+            return
+        try:
+            # Unordered, so one bad document does not hold back the rest of the batch
+            self.chats.insert_many(messages, ordered=False)
+        except BulkWriteError as e:
+            # Each message keeps its _id across retries, so duplicates mean "already written"
+            failed = [err for err in e.details.get('writeErrors', []) if err.get('code') != DUPLICATE_KEY]
+            if failed:
+                raise
+
+    def _requeue(self, messages, bumps):
+        with self._lock:
+            self._messages = messages + self._messages
+            self._retry_bumps = bumps + self._retry_bumps
+            self._retrying = True
+            overflow = len(self._messages) - self.max_pending
+            if overflow > 0:
+                self._messages = self._messages[overflow:]
+                self.dropped_messages += overflow
+                logger.warning(f"Write buffer full, dropped {overflow} oldest messages")
+            if len(self._retry_bumps) > self.max_pending:
+                # Their sessions' summaries drift; rebuild_session_stats.py corrects them
+                self._retry_bumps = self._retry_bumps[-self.max_pending:]
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        """Stop the background thread and flush whatever is left"""
+        self._stopped = True
+        self._wake.set()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._messages)
+        return {
+            'pending_messages': pending,
+            'flushed_batches': self.flushed_batches,
+            'flushed_messages': self.flushed_messages,
+            'dropped_messages': self.dropped_messages
+        }
@@ -725,9 +725,10 @@ document.addEventListener('DOMContentLoaded', function() {
         // Show typing indicator
         const typingIndicator = showTypingIndicator();
         
-        let finalMessage = message;
-        if (isTeacherModeGloballyActive && currentActiveTeacher && currentActiveTeacher.prompt) {
-            finalMessage = `System Prompt (Follow these instructions for your persona): ${currentActiveTeacher.prompt}\\n\\nUser question: ${message}`;
+        // The server applies the teacher's prompt as the model's system instruction
+        let teacherId = null;
+        if (isTeacherModeGloballyActive && currentActiveTeacher && currentActiveTeacher.teacher_id) {
+            teacherId = currentActiveTeacher.teacher_id;
             console.log("Using teacher prompt for:", currentActiveTeacher.name);
         }
 
@@ -741,8 +742,9 @@ document.addEventListener('DOMContentLoaded', function() {
                     'Content-Type': 'application/json',
                 },
                 body: JSON.stringify({
-                    prompt: finalMessage, // Use finalMessage
-                    session_id: currentSessionId
+                    prompt: message,
+                    session_id: currentSessionId,
+                    teacher_id: teacherId
                 }),
             });
             
@@ -1024,6 +1026,17 @@ document.addEventListener('DOMContentLoaded', function() {
                             <span>${session.name}</span>
                         `;
                         
+                        // Session summaries come with the list, so no per-session history request is needed
+                        if (session.message_count) {
+                            const countBadge = document.createElement('span');
+                            countBadge.classList.add('chat-history-count');
+                            countBadge.textContent = session.message_count;
+                            chatItem.appendChild(countBadge);
+                        }
+                        if (session.last_message_preview) {
+                            chatItem.title = session.last_message_preview;
+                        }
+                        
                         // Add click event to load this chat session
                         chatItem.addEventListener('click', () => {
                             loadSession(session.session_id);